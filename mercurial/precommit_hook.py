@@ -1,46 +1,309 @@
 # -*- coding: utf-8 -*-
-import sys, subprocess as proc
-from tkinter import Tk, messagebox
+#
+# Warns before committing when the server has changesets on the current branch
+# that were not pulled yet. Use it in .hg/hgrc as an in-process hook (needs
+# Mercurial running on Python 3):
+#   [hooks]
+#   precommit.incoming = python:/path/to/precommit_hook.py:hook
+#   [precommit-hook]
+#   ttl = 300
+#   timeout = 3
+#   source = default
+# or as an external script, which costs a Python start and two hg processes
+# per commit:
+#   [hooks]
+#   precommit = python /path/to/precommit_hook.py [--ttl=300] [--timeout=3] [--source=default]
+#
+# Asking the server takes a full round-trip, so the heads of the remote branches
+# are cached in .hg/precommit-heads.json: every head of the branch on the server
+# that was missing locally at the time. The commit asks while any of them is
+# still missing. A cached entry younger than --ttl seconds is trusted.
+# Otherwise a refresh process asks the server. The commit waits --timeout
+# seconds for it at most, then it goes on with the cached state and the
+# refresh finishes in the background for the next commit.
+# A packaged Mercurial (hg.exe, TortoiseHg) is no Python interpreter that could
+# run the refresh process. Without python on PATH the in-process hook refreshes
+# in a thread instead. That refresh cannot outlive the commit: when the server
+# does not answer within --timeout the commit goes on with the cached state, and
+# the next commit asks the server again.
+# --source can be any repository, e.g. a local clone to test the hook.
+import json, os, shutil, sys, threading, time, subprocess as proc
 
 SUCCESS = 0
 ERROR   = 1
+BUSY    = 2     # another refresh is running
 
-def main():
+TTL     = 300   # seconds
+TIMEOUT = 3     # seconds
+SOURCE  = 'default'
+
+# relative to the repository root
+CACHE_FILE = os.path.join('.hg', 'precommit-heads.json')
+LOCK_FILE  = os.path.join('.hg', 'precommit-refresh.lock')
+
+INCOMING_MSG    = ('You did not pull before trying to commit but there are\n'
+                   'new changesets waiting on the server.\n\n'
+                   'Commit anyway?')
+NOT_CHECKED_MSG = 'precommit: %s did not answer within %g seconds. Incoming changesets not checked.'
+
+REFRESH_TIMEOUT = 60    # a background refresh gives up after this many seconds
+LOCK_MAX_AGE    = REFRESH_TIMEOUT + 30
+
+def main(args):
     if (sys.version_info.major < 3):
         error_box('Python too old. Precommit script needs at least Python v3.x.\n'
                   'You have v%s'%(sys.version))
-    
+
+    ttl, timeout, source, refresh_branch = TTL, TIMEOUT, SOURCE, None
     try:
-        hgbranch = proc.check_output(['hg', 'branch'], universal_newlines=True)
+        for arg in args:
+            if arg.startswith('--ttl='):
+                ttl = int(arg[len('--ttl='):])
+            elif arg.startswith('--timeout='):
+                timeout = float(arg[len('--timeout='):])
+            elif arg.startswith('--source='):
+                source = arg[len('--source='):]
+            elif arg.startswith('--refresh='):
+                refresh_branch = arg[len('--refresh='):]
+            else:
+                raise ValueError('unknown argument ' + arg)
+    except ValueError as err:
+        error_box('Wrong precommit hook configuration. Commit aborted.\nDetails:\n%s'%(str(err)))
+        return ERROR
+
+    if refresh_branch is not None:
+        return refresh(refresh_branch, source)
+
+    try:
+        hgbranch = proc.check_output(['hg', 'branch'], universal_newlines=True, env=hg_env())
         hgbranch = hgbranch.strip()
-        
-        proc.check_call(['hg', 'incoming', '-b', hgbranch])
-    
-    except proc.CalledProcessError as err:
-        if err.returncode == 1:
-            # no incoming changesets found, so this is in fact a success ;)
-            return SUCCESS
-        else:
-            error_box('An error occurred while checking for incoming changesets. Commit aborted.\n'
-                      'Details:\n%s'%(str(err)))
-            return err.returncode
-    
-    if yesno_box('You did not pull before trying to commit but there are\n'
-                 'new changesets waiting on the server.\n\n'
-                 'Commit anyway?'):
+    except (OSError, proc.CalledProcessError) as err:
+        error_box('An error occurred while checking for incoming changesets. Commit aborted.\n'
+                  'Details:\n%s'%(str(err)))
+        return ERROR
+
+    entry, failure = remote_heads('.', hgbranch, source, ttl, timeout)
+    if failure is not None:
+        error_box('An error occurred while checking for incoming changesets. Commit aborted.\n'
+                  'Details:\n%s'%(failure))
+        return ERROR
+
+    if entry is None:
+        print(NOT_CHECKED_MSG%(source, timeout), file=sys.stderr)
+        return SUCCESS
+
+    if len(unknown_heads('.', entry['heads'])) == 0:
+        return SUCCESS
+
+    if yesno_box(INCOMING_MSG):
         return SUCCESS
     else:
         return ERROR
 
 
+def hook(ui, repo, **kwargs):
+    # In-process version of main(). Branch and local changesets come straight
+    # from the repository object, no process is started while the cache is
+    # fresh. Returns True to abort the commit.
+    if (sys.version_info.major < 3):
+        ui.warn(b'precommit hook needs Mercurial running on Python 3.\n')
+        return True
+
+    root = os.fsdecode(repo.root)
+    hgbranch = repo[None].branch().decode('utf-8', 'replace')
+    from mercurial import error
+    try:
+        ttl = ui.configint(b'precommit-hook', b'ttl', TTL)
+        timeout = float(ui.config(b'precommit-hook', b'timeout', b'%d'%(TIMEOUT)))
+    except (ValueError, error.ConfigError) as err:
+        ui.warn(b'Wrong precommit hook configuration. Commit aborted.\n%s\n'%(str(err).encode('utf-8')))
+        return True
+    source = ui.config(b'precommit-hook', b'source', SOURCE.encode('utf-8')).decode('utf-8')
+
+    entry, failure = remote_heads(root, hgbranch, source, ttl, timeout)
+    if failure is not None:
+        ui.warn(b'An error occurred while checking for incoming changesets. Commit aborted.\n'
+                b'Details:\n%s\n'%(failure.encode('utf-8', 'replace')))
+        return True
+
+    if entry is None:
+        ui.warn((NOT_CHECKED_MSG%(source, timeout) + '\n').encode('utf-8'))
+        return False
+
+    if all(len(repo.revs(b'id(%s)', node.encode('ascii'))) > 0 for node in entry['heads']):
+        return False
+
+    if ui.interactive():
+        return ui.promptchoice(INCOMING_MSG.replace('\n\n', '\n').encode('utf-8') + b' $$ &Yes $$ &No', 1) != 0
+    try:
+        return not yesno_box(INCOMING_MSG)
+    except ImportError:
+        # no tkinter in this Mercurial and nobody to ask on the console
+        ui.warn(b'precommit: new changesets are waiting on the server. Pull first. Commit aborted.\n')
+        return True
+
+
+def remote_heads(root, branch, source, ttl, timeout):
+    # Returns the cache entry of the remote branch (None when unknown) and
+    # the error message of a refresh that failed just now.
+    entry = cached_heads(root, branch, source, ttl)
+    if entry is None:
+        if start_refresh(root, branch, source, timeout):
+            entry = cached_heads(root, branch, source)
+            if entry is not None and 'error' in entry:
+                return None, entry['error']
+        else:
+            # no answer in time: the last known state is better than nothing
+            entry = cached_heads(root, branch, source, float('inf'))
+    return entry, None
+
+
+def cached_heads(root, branch, source, max_age=None):
+    # Cache entry of a remote branch: heads (the heads on the server that were
+    # missing locally, empty if there were none or the branch is not on the
+    # server), checked (time of the refresh) and error (only if it failed).
+    # With max_age entries that are older or failed do not count.
+    try:
+        with open(os.path.join(root, CACHE_FILE)) as cachefile:
+            entry = json.load(cachefile)[source][branch]
+        entry['heads']      # entries of older versions of the hook only have one head
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    if max_age is not None and ('error' in entry or time.time() - entry['checked'] > max_age):
+        return None
+    return entry
+
+
+def start_refresh(root, branch, source, timeout):
+    # Starts a refresh process that outlives the commit if the server is slow.
+    # Returns True if it finished within timeout.
+    python = sys.executable
+    if getattr(sys, 'frozen', False):
+        # in-process hook in a packaged Mercurial (hg.exe, TortoiseHg): not a Python interpreter
+        python = shutil.which('python3') or shutil.which('python')
+        if python is None:
+            return refresh_in_thread(root, branch, source, timeout)
+
+    if sys.platform == 'win32':
+        detach = {'creationflags': proc.DETACHED_PROCESS | proc.CREATE_NEW_PROCESS_GROUP}
+    else:
+        detach = {'start_new_session': True}
+
+    try:
+        child = proc.Popen([python, os.path.abspath(__file__), '--refresh=' + branch, '--source=' + source],
+                           stdin=proc.DEVNULL, stdout=proc.DEVNULL, stderr=proc.DEVNULL, cwd=root, **detach)
+        return child.wait(timeout) == SUCCESS
+    except proc.TimeoutExpired:
+        return False
+    except OSError:
+        return False
+
+
+def refresh_in_thread(root, branch, source, timeout):
+    # start_refresh() without a Python interpreter to start. Returns True if the
+    # refresh finished within timeout. Otherwise it is killed with the hook's
+    # process, its lock file expires after LOCK_MAX_AGE.
+    result = []
+    thread = threading.Thread(target=lambda: result.append(refresh(branch, source, root)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return result == [SUCCESS]
+
+
+def refresh(branch, source, root='.'):
+    # Runs in the refresh process. Asks the server for all heads of the branch
+    # that are missing locally and stores them (or the error) in the cache.
+    # hg identify would only tell the tipmost head. hg incoming finds all of
+    # them, but also lists their missing ancestors: the heads are the ones no
+    # other listed changeset has as a parent.
+    lock_file = os.path.join(root, LOCK_FILE)
+    cache_file = os.path.join(root, CACHE_FILE)
+    try:
+        lock = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(lock_file) < LOCK_MAX_AGE:
+                return BUSY
+            os.remove(lock_file)    # left behind by a killed refresh
+            lock = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return BUSY
+    os.close(lock)
+
+    try:
+        try:
+            result = proc.run(['hg', 'incoming', '--quiet', '--branch', branch,
+                               '--template', '{node} {p1node} {p2node}\n', source], stdin=proc.DEVNULL,
+                              stdout=proc.PIPE, stderr=proc.PIPE, universal_newlines=True,
+                              env=hg_env(), cwd=root, timeout=REFRESH_TIMEOUT)
+            if result.returncode in (0, 1):     # 1: nothing incoming
+                changesets = [line.split() for line in result.stdout.splitlines() if line.strip() != '']
+                parents = set(node for changeset in changesets for node in changeset[1:])
+                entry = {'heads': [changeset[0] for changeset in changesets if changeset[0] not in parents]}
+            elif 'unknown branch' in result.stderr:
+                entry = {'heads': []}       # new branch, not pushed yet
+            else:
+                entry = {'heads': [], 'error': result.stderr.strip() or 'hg incoming failed'}
+        except proc.TimeoutExpired:
+            entry = {'heads': [], 'error': '%s did not answer within %d seconds.'%(source, REFRESH_TIMEOUT)}
+        except OSError as err:
+            entry = {'heads': [], 'error': str(err)}
+
+        entry['checked'] = time.time()
+
+        try:
+            with open(cache_file) as cachefile:
+                cache = json.load(cachefile)
+        except (OSError, ValueError):
+            cache = {}
+        cache.setdefault(source, {})[branch] = entry
+
+        with open(cache_file + '.tmp', 'w') as cachefile:
+            json.dump(cache, cachefile, indent=1)
+        os.replace(cache_file + '.tmp', cache_file)
+        return SUCCESS
+
+    except OSError:
+        return ERROR
+    finally:
+        try:
+            os.remove(lock_file)
+        except FileNotFoundError:
+            pass    # taken over as stale by another refresh meanwhile
+
+
+def unknown_heads(root, nodes):
+    # The changesets that are not in the local repository. Local only, no server access.
+    if len(nodes) == 0:
+        return []
+    try:
+        output = proc.check_output(['hg', 'log', '-r', ' or '.join('id(%s)'%(node) for node in nodes),
+                                    '--template', '{node}\n'], universal_newlines=True, env=hg_env(), cwd=root)
+    except (OSError, proc.CalledProcessError):
+        return []       # cannot tell, do not bother the user
+    known = output.split()
+    return [node for node in nodes if node not in known]
+
+
+def hg_env():
+    # English, unstyled output from Mercurial
+    env = dict(os.environ)
+    env['HGPLAIN'] = 'true'
+    return env
+
+
+# tkinter takes a while to import. Only load it when a box is really shown.
 def error_box(msg):
+    from tkinter import Tk, messagebox
     Tk().withdraw()
     messagebox.showerror('Error', msg)
 
 def yesno_box(msg):
+    from tkinter import Tk, messagebox
     Tk().withdraw()
     return messagebox.askyesno('Warning', msg)
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+# Runs the refresh against a temporary clone given as --source, no server needed.
+import os, shutil, subprocess, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import precommit_hook
+
+pytestmark = pytest.mark.skipif(shutil.which('hg') is None, reason='needs Mercurial')
+
+
+def hg(cwd, *args):
+    env = precommit_hook.hg_env()
+    env['HGUSER'] = 'test'
+    env['HGRCPATH'] = ''
+    return subprocess.check_output(['hg'] + list(args), cwd=cwd, env=env, universal_newlines=True).strip()
+
+
+def commit(repo, name, branch=None):
+    if branch is not None:
+        hg(repo, 'branch', '--quiet', branch)
+    with open(os.path.join(repo, name), 'w') as newfile:
+        newfile.write(name)
+    hg(repo, 'commit', '--quiet', '--addremove', '--message', name)
+    return hg(repo, 'log', '-r', '.', '--template', '{node}')
+
+
+@pytest.fixture
+def repos(tmp_path):
+    # server and a local clone of it
+    server, local = str(tmp_path / 'server'), str(tmp_path / 'local')
+    hg(str(tmp_path), 'init', server)
+    commit(server, 'base')
+    hg(str(tmp_path), 'clone', '--quiet', server, local)
+    return server, local
+
+
+def refresh(local, server, branch='default'):
+    assert precommit_hook.start_refresh(local, branch, server, 30)
+    return precommit_hook.cached_heads(local, branch, server)
+
+
+def test_nothing_incoming(repos):
+    server, local = repos
+    entry = refresh(local, server)
+    assert entry['heads'] == []
+    assert 'error' not in entry
+
+
+def test_all_heads_of_the_branch(repos):
+    server, local = repos
+    first = commit(server, 'first')
+    hg(server, 'update', '--quiet', '-r', '0')
+    second = commit(server, 'second')           # second head of default
+    commit(server, 'other', branch='other')     # not the branch of the commit
+
+    entry = refresh(local, server)
+    assert sorted(entry['heads']) == sorted([first, second])
+    assert sorted(precommit_hook.unknown_heads(local, entry['heads'])) == sorted([first, second])
+
+    # pulling only one head still leaves the other one unknown
+    hg(local, 'pull', '--quiet', '-r', first, server)
+    assert precommit_hook.unknown_heads(local, entry['heads']) == [second]
+
+    hg(local, 'pull', '--quiet', server)
+    assert precommit_hook.unknown_heads(local, entry['heads']) == []
+
+
+def test_new_branch(repos):
+    server, local = repos
+    commit(local, 'new', branch='new')
+    entry = refresh(local, server, 'new')
+    assert entry['heads'] == []
+    assert 'error' not in entry
+
+
+def test_unreachable_source(repos, tmp_path):
+    server, local = repos
+    missing = str(tmp_path / 'missing')
+    assert precommit_hook.start_refresh(local, 'default', missing, 30)
+    assert precommit_hook.cached_heads(local, 'default', missing, float('inf')) is None   # failed refreshes never count
+    assert 'error' in precommit_hook.cached_heads(local, 'default', missing)
+
+
+def test_frozen_without_python(repos, monkeypatch):
+    # packaged Mercurial: the refresh runs in a thread of the hook's process
+    server, local = repos
+    first = commit(server, 'first')
+    monkeypatch.setattr(sys, 'frozen', True, raising=False)
+    monkeypatch.setattr(precommit_hook.shutil, 'which', lambda name: None)
+
+    assert precommit_hook.start_refresh(local, 'default', server, 30)
+    assert precommit_hook.cached_heads(local, 'default', server)['heads'] == [first]
+    assert not os.path.exists(os.path.join(local, precommit_hook.LOCK_FILE))
+
+
+def test_hook_without_tkinter(repos, monkeypatch):
+    # non-interactive in-process hook in a Mercurial without tkinter
+    server, local = repos
+    commit(server, 'first')
+    monkeypatch.setitem(sys.modules, 'tkinter', None)     # import raises ImportError
+
+    class UI:
+        warnings = []
+        def configint(self, section, name, default): return default
+        def config(self, section, name, default): return default
+        def interactive(self): return False
+        def warn(self, msg): self.warnings.append(msg)
+
+    class Repo:
+        root = local.encode()
+        def __getitem__(self, rev):
+            return type('Context', (), {'branch': lambda self: b'default'})()
+        def revs(self, spec, node):
+            return []
+
+    ui = UI()
+    assert precommit_hook.hook(ui, Repo()) is True    # source "default" is the server
+    assert b'Commit aborted' in ui.warnings[-1]
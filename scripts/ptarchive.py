@@ -0,0 +1,362 @@
+#-*- coding: utf8 -*-
+
+import collections, hashlib, lzma, multiprocessing, os, struct, sys, tarfile, time, zipfile, zlib
+from utils import print_ok, print_err
+
+import pttrace
+from ptupdata import file_digest
+
+USER_INVOKED = False
+
+FORMATS = {
+    # format  file extension
+    'zip':    '.zip',
+    'xz':     '.tar.xz'
+}
+
+ZIP_CHUNK_SIZE = 1 << 20    # files are deflated in pieces of this size
+XZ_CHUNK_SIZE  = 8 << 20    # one xz stream per piece of the tar stream
+ZIP_LEVEL      = 9
+XZ_PRESET      = 6          # dictionary size of preset 6 equals XZ_CHUNK_SIZE, more would be wasted
+DEFLATE_WINDOW = 32 << 10   # deflate back-reference distance, the dictionary for the next chunk
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    params = [param for param in cli_params if not param.startswith('--')]
+    options = [param for param in cli_params if param.startswith('--')]
+
+    fmt = 'zip'
+    jobs = None
+    verify = False
+    for option in options:
+        if option.startswith('--format='):
+            fmt = option[len('--format='):]
+        elif option.startswith('--jobs='):
+            jobs = int(option[len('--jobs='):])
+        elif option == '--verify':
+            verify = True
+        else:
+            print_err('Unknown option "%s".'%option)
+            return False
+
+    if len(params) != 2 or not fmt in FORMATS:
+        print_err('Usage: ptarchive.py <bin dir> <archive file> [--format=zip|xz] [--jobs=N] [--verify]')
+        return False
+
+    srcdir = os.path.abspath(params[0])
+    stats = create_archive(srcdir, params[1], fmt, jobs=jobs)
+    if stats is None:
+        return False
+    print(stats)
+
+    if verify:
+        return verify_archive(params[1], srcdir, fmt)
+    return True
+
+
+# -----------------------------------------------------------------------
+class ArchiveStats:
+    """
+    Compression ratio and throughput of a created archive.
+    """
+    def __init__(self, fmt, jobs):
+        self.format    = fmt
+        self.jobs      = jobs
+        self.files     = 0
+        self.bytes_in  = 0
+        self.bytes_out = 0
+        self.seconds   = 0.0
+
+    def ratio(self):
+        return self.bytes_out / self.bytes_in if self.bytes_in > 0 else 1.0
+
+    def throughput(self):
+        # uncompressed MB per second
+        return self.bytes_in / 2**20 / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return '%s: %d files, %.1f MB -> %.1f MB (%.1f%%), %.1f s, %.1f MB/s with %d processes'%(
+               self.format, self.files, self.bytes_in / 2**20, self.bytes_out / 2**20,
+               100 * self.ratio(), self.seconds, self.throughput(), self.jobs)
+
+
+# -----------------------------------------------------------------------
+def archive_name(basename, fmt):
+    """
+    <return>  string  basename with the file extension of the format
+    """
+    return basename + FORMATS[fmt]
+
+
+# -----------------------------------------------------------------------
+def create_archive(srcdir, archive_path, fmt='zip', root_name=None, jobs=None):
+    """
+    Packs a dir tree into a zip or tar.xz archive. Compression runs in a
+    process pool: the files (zip) or the tar stream (xz) are cut into chunks
+    that are compressed independently and written in order. Memory use is
+    bounded, only a few chunks per process are in flight.
+    srcdir        string  dir to pack
+    archive_path  string  archive file, overwritten if it exists
+    fmt           string  "zip" or "xz"
+    root_name     string  top-level folder in the archive, default is the name of srcdir
+    jobs          int     compression processes, default is the number of cores
+    <return>      ArchiveStats, None on error
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if root_name is None:
+        root_name = os.path.basename(os.path.abspath(srcdir))
+
+    stats = ArchiveStats(fmt, jobs)
+    start = time.perf_counter()
+
+    try:
+        with pttrace.ProcessPool(max_workers=jobs) as pool, open(archive_path, 'wb') as outfile:
+            if fmt == 'zip':
+                _write_zip(srcdir, root_name, outfile, pool, 2 * jobs, stats)
+            else:
+                _write_tar_xz(srcdir, root_name, outfile, pool, 2 * jobs, stats)
+            stats.bytes_out = outfile.tell()
+    except (OSError, ValueError, lzma.LZMAError, zlib.error) as err:
+        print_err('ERROR: Creating archive "%s" failed.'%archive_path)
+        print_err(str(err))
+        try:
+            os.remove(archive_path)
+        except OSError:
+            pass
+        return None
+
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+# -----------------------------------------------------------------------
+def verify_archive(archive_path, srcdir, fmt='zip'):
+    """
+    Decompresses the complete archive and compares every file with srcdir.
+    <return>  bool  True if the archive contains exactly the files of srcdir
+    """
+    expected = {relpath: path for relpath, path in _walk_files(srcdir)}
+    found = set()
+    errors = []
+
+    try:
+        if fmt == 'zip':
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    relpath = info.filename.partition('/')[2]
+                    found.add(relpath)
+                    with archive.open(info) as member:   # checks the CRC while reading
+                        if relpath in expected and _digest(member) != file_digest(expected[relpath]):
+                            errors.append(relpath)
+        else:
+            with tarfile.open(archive_path, 'r:xz') as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    relpath = member.name.partition('/')[2]
+                    found.add(relpath)
+                    if relpath in expected and _digest(archive.extractfile(member)) != file_digest(expected[relpath]):
+                        errors.append(relpath)
+    except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError, lzma.LZMAError) as err:
+        print_err('ERROR: Archive "%s" is broken.'%archive_path)
+        print_err(str(err))
+        return False
+
+    errors += ['missing: ' + relpath for relpath in sorted(set(expected) - found)]
+    errors += ['unexpected: ' + relpath for relpath in sorted(found - set(expected))]
+    if errors:
+        print_err('ERROR: Archive "%s" does not match "%s":'%(archive_path, srcdir))
+        for error in errors:
+            print_err('  ' + error)
+        return False
+
+    print_ok('Verified %d files in %s.'%(len(found), archive_path))
+    return True
+
+
+# -----------------------------------------------------------------------
+def _ordered_results(pool, func, jobs, window):
+    """
+    Runs func(*args) for every (tag, args) in jobs in the pool, with at most
+    window jobs in flight, and yields (tag, result) in the order of jobs.
+    """
+    pending = collections.deque()
+    for tag, args in jobs:
+        pending.append((tag, pool.submit(func, *args)))
+        if len(pending) >= window:
+            tag, future = pending.popleft()
+            yield tag, future.result()
+    while pending:
+        tag, future = pending.popleft()
+        yield tag, future.result()
+
+
+# -----------------------------------------------------------------------
+def _deflate_chunk(data, zdict, level, last):
+    """
+    Compresses one chunk of a file to raw deflate data. Chunks are
+    concatenated: all but the last end with a sync flush, zdict (the end of
+    the previous chunk) keeps back-references working across chunk borders.
+    """
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+# -----------------------------------------------------------------------
+def _xz_chunk(data, preset):
+    # A complete xz stream. Concatenated streams are a valid xz file.
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=preset)
+
+
+# -----------------------------------------------------------------------
+def _write_zip(srcdir, root_name, outfile, pool, window, stats):
+    """
+    Writes a zip file with deflated entries. Sizes and CRC follow each
+    entry's data in a data descriptor, so entries can be written while their
+    chunks come back from the pool. No zip64, archives must stay below 4 GB.
+    """
+    entries = []    # [name, dos time, crc, compressed size, size, header offset]
+
+    def chunk_jobs():
+        for relpath, path in _walk_files(srcdir):
+            entry = [(root_name + '/' + relpath).encode('utf-8'), _dos_time(os.path.getmtime(path)), 0, 0, 0, 0]
+            entries.append(entry)
+            crc = 0
+            size = 0
+            zdict = b''
+            with open(path, 'rb') as infile:
+                data = infile.read(ZIP_CHUNK_SIZE)
+                while True:
+                    next_data = infile.read(ZIP_CHUNK_SIZE)
+                    crc = zlib.crc32(data, crc)
+                    size += len(data)
+                    last = len(next_data) == 0
+                    if last:
+                        entry[2], entry[4] = crc, size
+                    yield (entry, last), (data, zdict, ZIP_LEVEL, last)
+                    if last:
+                        break
+                    zdict = data[-DEFLATE_WINDOW:]
+                    data = next_data
+
+    current = None
+    for (entry, last), compressed in _ordered_results(pool, _deflate_chunk, chunk_jobs(), window):
+        if entry is not current:
+            # first chunk of an entry: local file header
+            current = entry
+            entry[5] = outfile.tell()
+            outfile.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x0808, 8, entry[1][0], entry[1][1],
+                                      0, 0, 0, len(entry[0]), 0) + entry[0])
+        outfile.write(compressed)
+        entry[3] += len(compressed)
+        if last:
+            outfile.write(struct.pack('<IIII', 0x08074b50, entry[2], entry[3], entry[4]))
+            stats.files += 1
+            stats.bytes_in += entry[4]
+
+    cd_offset = outfile.tell()
+    for name, (time_part, date_part), crc, csize, size, offset in entries:
+        outfile.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, 0x0808, 8, time_part, date_part,
+                                  crc, csize, size, len(name), 0, 0, 0, 0, 0, offset) + name)
+    cd_size = outfile.tell() - cd_offset
+
+    if cd_offset + cd_size > 0xffffffff or len(entries) > 0xffff:
+        raise ValueError('Archive too large for a zip file without zip64 extensions.')
+    outfile.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(entries), len(entries), cd_size, cd_offset, 0))
+
+
+# -----------------------------------------------------------------------
+class _ChunkedXzWriter:
+    """
+    File-like sink for tarfile's stream mode. Cuts the tar stream into
+    chunks, compresses them in the pool and writes the xz streams in order.
+    """
+    def __init__(self, outfile, pool, window):
+        self._outfile = outfile
+        self._pool = pool
+        self._window = window
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self.bytes_in = 0
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_in += len(data)
+        while len(self._buffer) >= XZ_CHUNK_SIZE:
+            self._submit(bytes(self._buffer[:XZ_CHUNK_SIZE]))
+            del self._buffer[:XZ_CHUNK_SIZE]
+        return len(data)
+
+    def finish(self):
+        if self._buffer or self.bytes_in == 0:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._outfile.write(self._pending.popleft().result())
+
+    def _submit(self, data):
+        self._pending.append(self._pool.submit(_xz_chunk, data, XZ_PRESET))
+        if len(self._pending) >= self._window:
+            self._outfile.write(self._pending.popleft().result())
+
+
+# -----------------------------------------------------------------------
+def _write_tar_xz(srcdir, root_name, outfile, pool, window, stats):
+    def normalize(tarinfo):
+        # Nothing about the build machine ends up in the archive.
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ''
+        if tarinfo.isfile():
+            stats.files += 1
+        return tarinfo
+
+    writer = _ChunkedXzWriter(outfile, pool, window)
+    with tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT) as archive:
+        archive.add(srcdir, arcname=root_name, filter=normalize)
+    writer.finish()
+
+    stats.bytes_in = sum(os.path.getsize(path) for _, path in _walk_files(srcdir))
+
+
+# -----------------------------------------------------------------------
+def _walk_files(srcdir):
+    """
+    <return>  generator  (relative path with "/", full path) of all files, sorted
+    """
+    for dirpath, dirnames, filenames in os.walk(srcdir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            yield os.path.relpath(path, srcdir).replace(os.sep, '/'), path
+
+
+# -----------------------------------------------------------------------
+def _dos_time(mtime):
+    """
+    <return>  tuple  (time, date) in MS-DOS format as used by zip
+    """
+    t = time.localtime(max(mtime, 315532800))   # zip cannot store anything before 1980
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+# -----------------------------------------------------------------------
+def _digest(stream):
+    hasher = hashlib.sha1()
+    for block in iter(lambda: stream.read(1 << 20), b''):
+        hasher.update(block)
+    return hasher.hexdigest()
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
@@ -0,0 +1,310 @@
+#-*- coding: utf8 -*-
+
+import contextlib, io, json, os, platform, shutil, statistics, subprocess, sys, tempfile, time
+from utils import print_ok, print_warn, print_err
+
+import pthg, pttemplate, ptupdata, ptuplibs
+
+USER_INVOKED = False
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ISS_FILE   = os.path.join(SCRIPT_DIR, '..', 'win-installer', 'photivo-setup-win64.iss')
+
+# Shape of the synthetic trees. "full" is roughly a real Photivo release,
+# "quick" is small enough for a smoke test.
+TREE_SIZES = {
+    'full': {
+        'small_files':  2000,         # per small file dir (Presets, Curves, ...)
+        'small_size':   2 << 10,
+        'lensfun_xml':  60,
+        'lensfun_size': 256 << 10,
+        'dlls':         30,
+        'dll_size':     8 << 20,
+        'repeat':       5
+    },
+    'quick': {
+        'small_files':  200,
+        'small_size':   2 << 10,
+        'lensfun_xml':  10,
+        'lensfun_size': 64 << 10,
+        'dlls':         6,
+        'dll_size':     1 << 20,
+        'repeat':       3
+    }
+}
+
+SMALL_FILE_DIRS = {
+    # dir name          file extension
+    'ChannelMixers':    '.ptm',
+    'Curves':           '.ptc',
+    'Presets':          '.pts',
+    'Profiles':         '.icc',
+    'Themes':           '.ptt',
+    'Translations':     '.qm',
+    'UISettings':       '.ptu'
+}
+
+ISS_RENDERS_PER_SAMPLE = 1000
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    size = 'full'
+    repeat = None
+    json_file = None
+    compare_file = None
+
+    for param in cli_params:
+        if param == '--quick':
+            size = 'quick'
+        elif param.startswith('--repeat='):
+            repeat = int(param[len('--repeat='):])
+        elif param.startswith('--json='):
+            json_file = param[len('--json='):]
+        elif param.startswith('--compare='):
+            compare_file = param[len('--compare='):]
+        else:
+            print_err('Unknown parameter "%s".'%param)
+            print_err('Usage: ptbench.py [--quick] [--repeat=N] [--json=<file>] [--compare=<file>]')
+            return False
+
+    sizes = dict(TREE_SIZES[size])
+    if repeat is not None:
+        sizes['repeat'] = max(1, repeat)
+
+    workdir = tempfile.mkdtemp(prefix='ptbench-')
+    try:
+        print_ok('Creating synthetic %s tree in %s ...'%(size, workdir))
+        tree = make_tree(workdir, sizes)
+        results = run_benchmarks(tree, sizes['repeat'])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'version':   1,
+        'size':      size,
+        'changeset': current_changeset(),
+        'python':    platform.python_version(),
+        'platform':  platform.platform(),
+        'results':   results
+    }
+
+    print_results(results)
+
+    if compare_file is not None:
+        try:
+            with open(compare_file) as oldfile:
+                print_comparison(json.load(oldfile), report)
+        except (OSError, ValueError) as err:
+            print_err('ERROR: Could not read "%s".'%compare_file)
+            print_err(str(err))
+            return False
+
+    if json_file is not None:
+        try:
+            with open(json_file, 'w') as outfile:
+                json.dump(report, outfile, indent=1)
+        except OSError as err:
+            print_err('ERROR: Could not write "%s".'%json_file)
+            print_err(str(err))
+            return False
+        print_ok('Results written to ' + json_file)
+
+    return True
+
+
+# -----------------------------------------------------------------------
+def make_tree(workdir, sizes):
+    """
+    Creates a repository with all data dirs and a lib dir with DLL sized
+    dummy files. File contents are random, so nothing compresses or dedups.
+    <return>  dict  paths of the tree: repo, bin, libs, libbin
+    """
+    tree = {
+        'repo':   os.path.join(workdir, 'repo'),
+        'bin':    os.path.join(workdir, 'bin'),
+        'libs':   os.path.join(workdir, 'libs'),
+        'libbin': os.path.join(workdir, 'libbin')
+    }
+    for path in tree.values():
+        os.makedirs(path)
+
+    def write_file(path, size):
+        with open(path, 'wb') as outfile:
+            while size > 0:
+                outfile.write(os.urandom(min(size, 1 << 20)))
+                size -= 1 << 20
+
+    for dirname, ext in sorted(SMALL_FILE_DIRS.items()):
+        # a few subdirs per data dir, like Presets/<category>
+        for i in range(sizes['small_files']):
+            subdir = os.path.join(tree['repo'], dirname, 'group%02d'%(i % 10))
+            os.makedirs(subdir, exist_ok=True)
+            write_file(os.path.join(subdir, 'file%05d%s'%(i, ext)), sizes['small_size'])
+
+    # Translations also contains the *.ts sources that ptupdata ignores
+    for i in range(20):
+        write_file(os.path.join(tree['repo'], 'Translations', 'photivo_%02d.ts'%i), sizes['small_size'])
+
+    lensfundir = os.path.join(tree['repo'], 'LensfunDatabase')
+    os.makedirs(lensfundir)
+    for i in range(sizes['lensfun_xml']):
+        write_file(os.path.join(lensfundir, 'lenses-%03d.xml'%i), sizes['lensfun_size'])
+
+    for i in range(sizes['dlls']):
+        write_file(os.path.join(tree['libs'], 'lib%02d.dll'%i), sizes['dll_size'])
+
+    tree['file_list'] = [[os.path.join(tree['libs'], name), tree['libbin']]
+                         for name in sorted(os.listdir(tree['libs']))]
+    return tree
+
+
+# -----------------------------------------------------------------------
+def run_benchmarks(tree, repeat):
+    """
+    <return>  dict  benchmark name -> timing statistics
+    """
+    def empty_dir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    def fill_libbin():
+        empty_dir(tree['libbin'])
+        for srcfile, destdir in tree['file_list']:
+            if not ptupdata.link_file(srcfile, os.path.join(destdir, os.path.basename(srcfile))):
+                shutil.copy(srcfile, destdir)
+
+    def touch_data():
+        # Moves the mtime of every 10th file 10 s ahead, contents stay the same. Any
+        # mtime difference counts as a change, even on FAT it is far outside
+        # ptupdata.MTIME_TOLERANCE, so every sample copies them again.
+        for dirpath, _, filenames in os.walk(tree['repo']):
+            for name in filenames[::10]:
+                path = os.path.join(dirpath, name)
+                stat = os.stat(path)
+                os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 * 10**9))
+
+    update_args = [tree['repo'], tree['bin']]
+    iss_text, iss_values = load_iss()
+    iss_template = pttemplate.Template(iss_text, comment=';')
+
+    def render_iss():
+        for i in range(ISS_RENDERS_PER_SAMPLE):
+            iss_template.render_to(io.BytesIO(), iss_values, 'latin_1')
+
+    def parse_iss():
+        for i in range(ISS_RENDERS_PER_SAMPLE):
+            pttemplate.Template(iss_text, comment=';')
+
+    benchmarks = [
+        # name                        setup                              function
+        ['ptupdata.main cold',        lambda: empty_dir(tree['bin']),    lambda: ptupdata.main(update_args)],
+        ['ptupdata.main unchanged',   None,                              lambda: ptupdata.main(update_args)],
+        ['ptupdata.main --hash',      None,                              lambda: ptupdata.main(update_args + ['--hash'])],
+        ['ptupdata.main touched',     touch_data,                        lambda: ptupdata.main(update_args)],
+        ['ptuplibs.kill_old_libs',    fill_libbin,                       lambda: ptuplibs.kill_old_libs(tree['libbin'])],
+        ['ptuplibs.copy_libs',        lambda: empty_dir(tree['libbin']), lambda: ptuplibs.copy_libs(tree['file_list'])],
+        ['ptuplibs.stage_libs cold',  lambda: empty_dir(tree['libbin']), lambda: ptuplibs.stage_libs(tree['file_list'], tree['libbin'])],
+        ['ptuplibs.stage_libs unchanged', None,                          lambda: ptuplibs.stage_libs(tree['file_list'], tree['libbin'])],
+        ['iss parse x%d'%ISS_RENDERS_PER_SAMPLE,  None,                  parse_iss],
+        ['iss render x%d'%ISS_RENDERS_PER_SAMPLE, None,                  render_iss]
+    ]
+
+    # ptupdata.main unchanged needs a populated bin dir
+    with contextlib.redirect_stdout(io.StringIO()):
+        ptupdata.main(update_args)
+
+    results = {}
+    for name, setup, func in benchmarks:
+        samples = []
+        for i in range(repeat):
+            if setup is not None:
+                setup()
+            # The benchmarked functions print one line per file. Console speed is not what we measure.
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                func()
+                samples.append(time.perf_counter() - start)
+
+        results[name] = {
+            'samples': samples,
+            'min':     min(samples),
+            'median':  statistics.median(samples),
+            'mean':    statistics.mean(samples),
+            'stdev':   statistics.stdev(samples) if len(samples) > 1 else 0.0
+        }
+        print('%-34s %9.4fs'%(name, results[name]['median']))
+
+    return results
+
+
+# -----------------------------------------------------------------------
+def load_iss():
+    """
+    Reads the real installer script when available, creates a synthetic one otherwise.
+    <return>  tuple  (template text, dict with a value for every placeholder)
+    """
+    if os.path.isfile(ISS_FILE):
+        with open(ISS_FILE, encoding='latin_1', newline='') as issfile:
+            text = issfile.read()
+    else:
+        text = 'AppVersion={{versionstring}}\r\n' + \
+               ''.join('Source: "{{bindir}}\\file%04d.dll"; DestDir: "{app}"\r\n'%i for i in range(500))
+
+    values = {name: 'benchmark-%s'%name for name in pttemplate.Template(text, comment=';').names()}
+    return text, values
+
+
+# -----------------------------------------------------------------------
+def current_changeset():
+    """
+    <return>  string  changeset of the scripts repository, None outside a repository
+    """
+    # Without the command server every query is a plain hg run. Its stderr ("abort:
+    # there is no Mercurial repository") is captured in the error, not shown.
+    repo = pthg.RepoInfo('hg', SCRIPT_DIR, use_cmdserver=False)
+    try:
+        return repo.changeset()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# -----------------------------------------------------------------------
+def print_results(results):
+    print('\n%-34s %10s %10s %10s'%('Benchmark', 'Min', 'Median', 'Stdev'))
+    for name, result in results.items():
+        print('%-34s %9.4fs %9.4fs %9.4fs'%(name, result['min'], result['median'], result['stdev']))
+
+
+# -----------------------------------------------------------------------
+def print_comparison(old_report, new_report):
+    """
+    Prints the median of every benchmark in both reports and their ratio.
+    Ratios above 1 mean the new run is slower.
+    """
+    print('\nCompared to changeset %s (%s tree):'%(old_report.get('changeset'), old_report.get('size')))
+    if old_report.get('size') != new_report['size']:
+        print_warn('WARNING: Tree sizes differ, the comparison is meaningless.')
+
+    print('%-34s %10s %10s %7s'%('Benchmark', 'Old', 'New', 'Ratio'))
+    for name, result in new_report['results'].items():
+        old = old_report['results'].get(name)
+        if old is None:
+            print('%-34s %10s %9.4fs %7s'%(name, '-', result['median'], '-'))
+            continue
+
+        ratio = result['median'] / old['median'] if old['median'] > 0 else float('inf')
+        line = '%-34s %9.4fs %9.4fs %6.2fx'%(name, old['median'], result['median'], ratio)
+        if ratio > 1.1:
+            print_warn(line)
+        else:
+            print(line)
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
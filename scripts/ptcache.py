@@ -0,0 +1,264 @@
+#-*- coding: utf8 -*-
+
+import hashlib, json, os, shutil, sys, threading, time, uuid
+from utils import print_ok, print_warn, print_err
+
+USER_INVOKED = False
+
+INDEX_FILE = 'index.json'
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    if len(cli_params) == 1:
+        cache = ArtifactCache(cli_params[0])
+        print(cache.stats_str())
+        return True
+    elif len(cli_params) == 2 and cli_params[1] == '--clear':
+        cache = ArtifactCache(cli_params[0])
+        if not cache.clear():
+            return False
+        print_ok('Cache cleared.')
+        return True
+    else:
+        print_err('Usage: ptcache.py <cache dir> [--clear]')
+        return False
+
+
+# -----------------------------------------------------------------------
+def make_key(*parts):
+    """
+    Builds a cache key from all inputs that influence an artifact.
+    parts     strings or lists of strings
+    <return>  string  hex digest
+    """
+    hasher = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, (list, tuple)):
+            part = '\x1f'.join(part)
+        hasher.update(part.encode('utf-8'))
+        hasher.update(b'\x1e')
+    return hasher.hexdigest()
+
+
+# -----------------------------------------------------------------------
+class ArtifactCache:
+    """
+    Local cache for finished build artifacts. Every entry is a folder named
+    after its key. Entries are evicted least recently used first when the
+    cache grows beyond its size limit. A hit only updates the index in
+    memory, it is written by store(), clear() and save(). Safe to use from
+    several threads: the lock only guards the index, files are copied and
+    deleted outside of it, so parallel restores and stores do not wait for
+    each other.
+    """
+    _cache_dir = None
+    _max_bytes = None
+    _index = None
+    _lock = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, cache_dir, max_bytes=2 << 30):
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = {'entries': {}, 'hits': 0, 'misses': 0}
+
+        try:
+            with open(os.path.join(self._cache_dir, INDEX_FILE)) as indexfile:
+                self._index.update(json.load(indexfile))
+        except (OSError, ValueError):
+            pass   # no or broken index: start with an empty cache
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def restore(self, key, destdir):
+        """
+        Copies all files of a cache entry into destdir.
+        <return>  bool  True on a cache hit, False on a miss
+        """
+        with self._lock:
+            entry = self._index['entries'].get(key)
+            names = None if entry is None else list(entry['files'])
+
+        entry_dir = os.path.join(self._cache_dir, key)
+        copied = names is not None
+        try:
+            for name in names or []:
+                # A unique temp name: a failed or concurrent copy never leaves a half file behind.
+                tmp_path = os.path.join(destdir, '%s.%s.tmp'%(name, uuid.uuid4().hex))
+                try:
+                    shutil.copy2(os.path.join(entry_dir, name), tmp_path)
+                    os.replace(tmp_path, os.path.join(destdir, name))
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+        except OSError:
+            copied = False   # entry damaged or evicted meanwhile
+
+        trash = []
+        with self._lock:
+            if copied:
+                entry['last_used'] = time.time()
+                self._index['hits'] += 1
+            else:
+                if entry is not None and self._index['entries'].get(key) is entry:
+                    trash.append(self._drop(key))
+                self._index['misses'] += 1
+        self._delete(trash)
+        return copied
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def contains(self, key):
+        """
+        <return>  bool  True if there is an entry for key. Does not count as a hit.
+        """
+        with self._lock:
+            return key in self._index['entries']
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def store(self, key, files):
+        """
+        Adds files to the cache under key. An existing entry is replaced.
+        Failing to store is not fatal for a build, so errors only print a warning.
+        <return>  bool  True if the entry was stored
+        """
+        entry_dir = os.path.join(self._cache_dir, key)
+        tmp_dir = '%s.%s.tmp'%(entry_dir, uuid.uuid4().hex)
+        trash = []
+
+        try:
+            os.makedirs(tmp_dir)
+            size = 0
+            for file in files:
+                shutil.copy2(file, tmp_dir)
+                size += os.path.getsize(file)
+
+            with self._lock:
+                trash.append(self._drop(key))
+                os.replace(tmp_dir, entry_dir)
+                self._index['entries'][key] = {
+                    'files': [os.path.basename(file) for file in files],
+                    'size': size,
+                    'last_used': time.time()
+                }
+                trash += self._evict(keep=key)
+                self._save_index()
+        except OSError as err:
+            print_warn('WARNING: Could not store build artifacts in cache.')
+            print_warn(str(err))
+            trash.append(tmp_dir)
+            return False
+        finally:
+            self._delete(trash)
+        return True
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def save(self):
+        """
+        Writes the index with the access times and counters of restore().
+        <return>  bool  True if the index was written
+        """
+        with self._lock:
+            return self._save_index()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def clear(self):
+        with self._lock:
+            trash = [self._drop(key) for key in list(self._index['entries'])]
+            self._index['hits'] = self._index['misses'] = 0
+            saved = self._save_index()
+        self._delete(trash)
+        return saved
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def stats(self):
+        """
+        <return>  dict  hits, misses, number of entries and total size in bytes
+        """
+        with self._lock:
+            return {
+                'hits': self._index['hits'],
+                'misses': self._index['misses'],
+                'entries': len(self._index['entries']),
+                'size': sum(entry['size'] for entry in self._index['entries'].values())
+            }
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def stats_str(self, title='Artifact cache', since=None):
+        """
+        since     dict    earlier result of stats(), hits and misses are counted from there
+        <return>  string
+        """
+        stats = self.stats()
+        if since is not None:
+            stats['hits'] -= since['hits']
+            stats['misses'] -= since['misses']
+        return '%s: %d hits, %d misses, %d entries, %.1f MB'% \
+               (title, stats['hits'], stats['misses'], stats['entries'], stats['size'] / (1 << 20))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _evict(self, keep):
+        """
+        Removes least recently used entries until the cache fits its size limit.
+        The entry keep is never evicted. Call with the lock held.
+        <return>  list  dirs to delete with _delete(), see _drop()
+        """
+        entries = self._index['entries']
+        total = sum(entry['size'] for entry in entries.values())
+        trash = []
+
+        for key in sorted(entries, key=lambda key: entries[key]['last_used']):
+            if total <= self._max_bytes:
+                break
+            if key != keep:
+                total -= entries[key]['size']
+                trash.append(self._drop(key))
+        return trash
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _drop(self, key):
+        """
+        Removes an entry from the index and moves its dir out of the way, so
+        a new entry with the same key can take its place right away. Call
+        with the lock held.
+        <return>  string  dir to delete with _delete() after releasing the lock, None if there is none
+        """
+        self._index['entries'].pop(key, None)
+        entry_dir = os.path.join(self._cache_dir, key)
+        trash_dir = '%s.%s.del'%(entry_dir, uuid.uuid4().hex)
+        try:
+            os.rename(entry_dir, trash_dir)
+            return trash_dir
+        except OSError:
+            # missing, or still open on Windows: delete what can be deleted
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _delete(self, dirs):
+        for path in dirs:
+            if path is not None:
+                shutil.rmtree(path, ignore_errors=True)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _save_index(self):
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            tmp_path = os.path.join(self._cache_dir, INDEX_FILE + '.tmp')
+            with open(tmp_path, 'w') as indexfile:
+                json.dump(self._index, indexfile, indent=1)
+            os.replace(tmp_path, os.path.join(self._cache_dir, INDEX_FILE))
+            return True
+        except OSError as err:
+            print_warn('WARNING: Could not write cache index.')
+            print_warn(str(err))
+            return False
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
@@ -0,0 +1,132 @@
+#-*- coding: utf8 -*-
+
+import json, os, sys, threading
+from utils import print_warn, print_err
+
+import ptcache
+
+USER_INVOKED = False
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    if len(cli_params) != 1:
+        print_err('Usage: ptcheckpoint.py <checkpoint file>')
+        return False
+
+    checkpoints = Checkpoints(cli_params[0])
+    for stage in checkpoints.stages():
+        print(stage)
+    return True
+
+
+# -----------------------------------------------------------------------
+def tree_fingerprint(paths):
+    """
+    Cheap fingerprint of files and dir trees: relative path, size and mtime
+    of every file. Contents are not read.
+    paths     list    files or dirs, missing ones are part of the fingerprint
+    <return>  string
+    """
+    parts = []
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            parts.append('%s %d %r'%(path, stat.st_size, stat.st_mtime))
+        elif os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    stat = os.stat(os.path.join(dirpath, name))
+                    parts.append('%s %d %r'%(os.path.relpath(os.path.join(dirpath, name), path),
+                                             stat.st_size, stat.st_mtime))
+        else:
+            parts.append(path + ' missing')
+    return ptcache.make_key(*parts)
+
+
+# -----------------------------------------------------------------------
+class Checkpoints:
+    """
+    Records which stages of a release run completed, together with a
+    fingerprint of their inputs and optional data to restore the stage's
+    result. The file is rewritten after every record, so a crashed or
+    aborted run leaves all completed stages behind. Thread-safe.
+    """
+    _path = None
+    _stages = None
+    _lock = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, path):
+        self._path = path
+        self._stages = {}
+        self._lock = threading.Lock()
+
+        try:
+            with open(path) as cpfile:
+                self._stages = json.load(cpfile)
+        except (OSError, ValueError):
+            pass
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def stages(self):
+        with self._lock:
+            return sorted(self._stages)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def is_done(self, stage, fingerprint, outputs=()):
+        """
+        <return>  bool  True if stage completed with the same input fingerprint
+                        and all its output files still exist
+        """
+        with self._lock:
+            entry = self._stages.get(stage)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return False
+        return all(os.path.exists(output) for output in outputs)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def data(self, stage):
+        """
+        <return>  data stored with the stage, None if there is none
+        """
+        with self._lock:
+            entry = self._stages.get(stage)
+            return None if entry is None else entry.get('data')
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def record(self, stage, fingerprint, data=None):
+        """
+        Marks stage as completed. data must be JSON serializable.
+        """
+        with self._lock:
+            self._stages[stage] = {'fingerprint': fingerprint, 'data': data}
+            self._save()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def clear(self):
+        with self._lock:
+            self._stages = {}
+            if os.path.exists(self._path):
+                self._save()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+            with open(self._path + '.tmp', 'w') as cpfile:
+                json.dump(self._stages, cpfile, indent=1)
+            os.replace(self._path + '.tmp', self._path)
+        except OSError as err:
+            print_warn('WARNING: Could not write checkpoint file "%s".'%self._path)
+            print_warn(str(err))
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
@@ -0,0 +1,319 @@
+#-*- coding: utf8 -*-
+
+import io, json, lzma, multiprocessing, os, re, struct, sys, zipfile
+from utils import print_ok, print_err
+
+import ptmanifest, pttrace
+from ptupdata import file_digest
+
+# bsdiff4 makes smaller patches, but is not part of every Python installation.
+# Without it a simpler block matching diff is used.
+try:
+    import bsdiff4
+except ImportError:
+    bsdiff4 = None
+
+USER_INVOKED = False
+
+DIFF_EXTENSIONS = ('.exe', '.dll')
+DIFF_MIN_SIZE   = 256 << 10     # smaller changed files are shipped whole
+
+DELTA_INFO_FILE = 'delta.json'
+DELTA_VERSION   = 1
+
+BSDIFF_MAGIC = b'BSDIFF40'
+BLOCK_MAGIC  = b'PTD1'
+
+# Block boundaries for the fallback diff depend on content, not on offsets,
+# so inserting code in a DLL only changes the blocks around the insertion.
+# Runs of zero bytes are everywhere in PE files (padding, small constants).
+BLOCK_ANCHOR_RE = re.compile(b'\\x00{4,}')
+MIN_BLOCK       = 64
+MAX_BLOCK       = 4096
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    usage = ['Usage: ptdelta.py list <release store>',
+             '       ptdelta.py create <release store> <old release> <bin dir> <delta file>',
+             '       ptdelta.py apply <delta file> <install dir>']
+
+    if len(cli_params) == 2 and cli_params[0] == 'list':
+        for name in ptmanifest.ReleaseStore(cli_params[1]).releases():
+            print(name)
+        return True
+    elif len(cli_params) == 5 and cli_params[0] == 'create':
+        stats = create_delta(ptmanifest.ReleaseStore(cli_params[1]), cli_params[2], cli_params[3], cli_params[4])
+        if stats is None:
+            return False
+        print(stats)
+        return True
+    elif len(cli_params) == 3 and cli_params[0] == 'apply':
+        return apply_delta(cli_params[1], cli_params[2])
+
+    for line in usage:
+        print_err(line)
+    return False
+
+
+# -----------------------------------------------------------------------
+class DeltaStats:
+    def __init__(self):
+        self.added     = 0
+        self.patched   = 0
+        self.deleted   = 0
+        self.unchanged = 0
+        self.full_size = 0      # bytes of the complete new release
+        self.delta_size = 0
+
+    def __str__(self):
+        return '%d added/replaced, %d patched, %d deleted, %d unchanged, %.1f MB instead of %.1f MB'%(
+               self.added, self.patched, self.deleted, self.unchanged,
+               self.delta_size / 2**20, self.full_size / 2**20)
+
+
+# -----------------------------------------------------------------------
+def make_patch(old, new):
+    """
+    <return>  bytes  binary patch that turns old into new
+    """
+    if bsdiff4 is not None:
+        return bsdiff4.diff(old, new)
+
+    # old block contents -> offset. The first occurrence wins.
+    index = {}
+    for start, end in _blocks(old):
+        index.setdefault(old[start:end], start)
+
+    payload = io.BytesIO()
+    copy_start = copy_end = None
+    literal_start = 0
+
+    def flush_literal(end):
+        if end > literal_start:
+            payload.write(b'L' + struct.pack('<I', end - literal_start) + new[literal_start:end])
+
+    for start, end in _blocks(new):
+        offset = index.get(new[start:end])
+        if offset is None:
+            continue
+
+        if copy_end is not None and copy_end == offset and literal_start == start:
+            # continues the previous copy
+            copy_end += end - start
+        else:
+            if copy_start is not None:
+                payload.write(b'C' + struct.pack('<QI', copy_start, copy_end - copy_start))
+            flush_literal(start)
+            copy_start, copy_end = offset, offset + end - start
+        literal_start = end
+
+    if copy_start is not None:
+        payload.write(b'C' + struct.pack('<QI', copy_start, copy_end - copy_start))
+    flush_literal(len(new))
+
+    return BLOCK_MAGIC + struct.pack('<Q', len(new)) + lzma.compress(payload.getvalue())
+
+
+# -----------------------------------------------------------------------
+def apply_patch(old, patch):
+    """
+    <return>  bytes  new contents
+    Raises ValueError for broken patches or when a bsdiff patch is applied without bsdiff4.
+    """
+    if patch.startswith(BSDIFF_MAGIC):
+        if bsdiff4 is None:
+            raise ValueError('The patch needs the Python module bsdiff4.')
+        return bsdiff4.patch(old, patch)
+
+    if not patch.startswith(BLOCK_MAGIC):
+        raise ValueError('Unknown patch format.')
+
+    size, = struct.unpack_from('<Q', patch, len(BLOCK_MAGIC))
+    payload = lzma.decompress(patch[len(BLOCK_MAGIC) + 8:])
+    new = bytearray()
+    pos = 0
+
+    while pos < len(payload):
+        kind = payload[pos:pos + 1]
+        if kind == b'C':
+            offset, length = struct.unpack_from('<QI', payload, pos + 1)
+            new += old[offset:offset + length]
+            pos += 13
+        elif kind == b'L':
+            length, = struct.unpack_from('<I', payload, pos + 1)
+            new += payload[pos + 5:pos + 5 + length]
+            pos += 5 + length
+        else:
+            raise ValueError('Broken patch.')
+
+    if len(new) != size:
+        raise ValueError('Broken patch: wrong result size.')
+    return bytes(new)
+
+
+# -----------------------------------------------------------------------
+def create_delta(store, old_name, bindir, delta_path, new_name='', jobs=None, new_manifest=None):
+    """
+    Creates a delta package that updates an installation of an archived
+    release to the contents of bindir. It contains changed and new small
+    files as they are, binary patches for changed large EXEs and DLLs and
+    the list of files to delete. Patches are made in parallel.
+    store         ReleaseStore  where the old release is archived
+    old_name      string        name of the old release in store
+    bindir        string        the new release
+    delta_path    string        delta package to create (a zip file)
+    new_name      string        name of the new release, default is the name of bindir
+    jobs          int           parallel diff processes, default is the number of cores
+    new_manifest  dict          manifest of bindir when already known, it is not hashed again
+    <return>      DeltaStats, None on error
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if new_name == '':
+        new_name = os.path.basename(os.path.abspath(bindir))
+
+    old = store.manifest(old_name)
+    if old is None:
+        return None
+    new = new_manifest or ptmanifest.build_manifest(bindir, new_name, jobs)
+    if new is None:
+        return None
+
+    stats = DeltaStats()
+    info = {'version': DELTA_VERSION, 'from': old_name, 'to': new_name, 'files': {}}
+    whole = []
+    diffs = []
+
+    for relpath, entry in sorted(new['files'].items()):
+        stats.full_size += entry['size']
+        old_entry = old['files'].get(relpath)
+        if old_entry is not None and old_entry['sha1'] == entry['sha1']:
+            stats.unchanged += 1
+        elif old_entry is not None and entry['size'] >= DIFF_MIN_SIZE and relpath.lower().endswith(DIFF_EXTENSIONS):
+            diffs.append(relpath)
+        else:
+            whole.append(relpath)
+
+    for relpath in sorted(set(old['files']) - set(new['files'])):
+        info['files'][relpath] = {'action': 'delete'}
+        stats.deleted += 1
+
+    try:
+        with pttrace.ProcessPool(max_workers=jobs) as pool:
+            patches = pool.map(_diff_files,
+                               [store.blob_path(old['files'][relpath]['sha1']) for relpath in diffs],
+                               [os.path.join(bindir, *relpath.split('/')) for relpath in diffs])
+
+            with zipfile.ZipFile(delta_path, 'w', zipfile.ZIP_DEFLATED) as package:
+                for relpath, patch in zip(diffs, patches):
+                    if len(patch) >= new['files'][relpath]['size']:
+                        whole.append(relpath)   # the patch does not pay off
+                        continue
+                    info['files'][relpath] = {'action': 'patch', 'sha1': new['files'][relpath]['sha1'],
+                                              'base_sha1': old['files'][relpath]['sha1']}
+                    package.writestr('patches/' + relpath, patch, zipfile.ZIP_STORED)
+                    stats.patched += 1
+
+                for relpath in whole:
+                    info['files'][relpath] = {'action': 'add', 'sha1': new['files'][relpath]['sha1']}
+                    package.write(os.path.join(bindir, *relpath.split('/')), 'files/' + relpath)
+                    stats.added += 1
+
+                package.writestr(DELTA_INFO_FILE, json.dumps(info, indent=1, sort_keys=True))
+    except (OSError, lzma.LZMAError) as err:
+        print_err('ERROR: Creating delta package "%s" failed.'%delta_path)
+        print_err(str(err))
+        return None
+
+    stats.delta_size = os.path.getsize(delta_path)
+    return stats
+
+
+# -----------------------------------------------------------------------
+def apply_delta(delta_path, installdir):
+    """
+    Updates an installation with a delta package. Every patched file is
+    checked against its expected content before and after patching.
+    Nothing is changed when a check fails before the first file is written.
+    <return>  bool  True if the installation was updated
+    """
+    try:
+        with zipfile.ZipFile(delta_path) as package:
+            info = json.loads(package.read(DELTA_INFO_FILE).decode('utf-8'))
+            if info.get('version') != DELTA_VERSION:
+                print_err('ERROR: "%s" has an unknown format.'%delta_path)
+                return False
+
+            # check all bases first
+            for relpath, entry in info['files'].items():
+                if entry['action'] == 'patch':
+                    path = os.path.join(installdir, *relpath.split('/'))
+                    if not os.path.isfile(path) or file_digest(path) != entry['base_sha1']:
+                        print_err('ERROR: "%s" is not the file of release %s.'%(path, info['from']))
+                        return False
+
+            for relpath, entry in sorted(info['files'].items()):
+                path = os.path.join(installdir, *relpath.split('/'))
+                if entry['action'] == 'delete':
+                    if os.path.exists(path):
+                        os.remove(path)
+                    continue
+
+                if entry['action'] == 'patch':
+                    with open(path, 'rb') as oldfile:
+                        data = apply_patch(oldfile.read(), package.read('patches/' + relpath))
+                else:
+                    data = package.read('files/' + relpath)
+
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'wb') as newfile:
+                    newfile.write(data)
+                if file_digest(path + '.tmp') != entry['sha1']:
+                    os.remove(path + '.tmp')
+                    raise ValueError('Wrong content after update: ' + path)
+                os.replace(path + '.tmp', path)
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile, lzma.LZMAError) as err:
+        print_err('ERROR: Applying delta package "%s" failed.'%delta_path)
+        print_err(str(err))
+        return False
+
+    print_ok('Updated %s from release %s to %s.'%(installdir, info['from'], info['to']))
+    return True
+
+
+# -----------------------------------------------------------------------
+def _diff_files(old_path, new_path):
+    with open(old_path, 'rb') as oldfile, open(new_path, 'rb') as newfile:
+        return make_patch(oldfile.read(), newfile.read())
+
+
+# -----------------------------------------------------------------------
+def _blocks(data):
+    """
+    <return>  generator  (start, end) of the content defined blocks of data
+    """
+    start = 0
+    for match in BLOCK_ANCHOR_RE.finditer(data):
+        end = match.end()
+        if end - start < MIN_BLOCK:
+            continue
+        while end - start > MAX_BLOCK:
+            yield start, start + MAX_BLOCK
+            start += MAX_BLOCK
+        yield start, end
+        start = end
+
+    while start < len(data):
+        end = min(start + MAX_BLOCK, len(data))
+        yield start, end
+        start = end
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
@@ -0,0 +1,300 @@
+#-*- coding: utf8 -*-
+
+import atexit, os, struct, subprocess, sys, threading
+from utils import print_warn, print_err
+
+USER_INVOKED = False
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    hg_cmd = cli_params[0] if len(cli_params) > 0 else 'hg'
+    repo = RepoInfo(hg_cmd, os.getcwd())
+
+    try:
+        print('Branch   :', repo.branch())
+        print('Changeset:', repo.changeset())
+        print('Status   :', '%d changed files'%len(repo.status()))
+        print('Mode     :', 'command server' if repo.uses_cmdserver() else 'one process per query')
+    except subprocess.CalledProcessError as err:
+        print_err(str(err))
+        if err.stderr:
+            print_err(err.stderr.strip())
+        return False
+    finally:
+        repo.close()
+
+    return True
+
+
+# -----------------------------------------------------------------------
+class RepoInfo:
+    """
+    Answers all repository metadata queries of a release run. Queries go
+    through a single long-lived "hg serve --cmdserver pipe" process. When that
+    is not available (old Mercurial, stand-in hg for tests) every query spawns
+    hg once instead. Either way every distinct query runs only once, the
+    results are cached for the lifetime of the object. Thread-safe.
+    Failed queries raise subprocess.CalledProcessError like check_output(),
+    with the error messages of hg in its stderr.
+    """
+    _hg_cmd = None
+    _repo_dir = None
+    _env = None
+    _server = None
+    _encoding = 'utf-8'
+    _use_cmdserver = True
+    _cache = None
+    _lock = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, hg_cmd='hg', repo_dir=None, use_cmdserver=True):
+        """
+        hg_cmd         string  Mercurial command
+        repo_dir       string  working copy dir, default is the current dir
+        use_cmdserver  bool    False always spawns one hg process per query
+        """
+        self._hg_cmd = hg_cmd
+        self._repo_dir = os.path.abspath(repo_dir or os.getcwd())
+        self._use_cmdserver = use_cmdserver
+        self._cache = {}
+        self._lock = threading.Lock()
+
+        # Force English, unstyled output from Mercurial
+        self._env = dict(os.environ)
+        self._env['HGPLAIN'] = 'true'
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def branch(self):
+        """
+        <return>  string  branch of the working copy
+        """
+        return self._identify()[1]
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def changeset(self):
+        """
+        <return>  string  short id of the working copy parent, ends with "+"
+                          when there are uncommitted changes
+        """
+        return self._identify()[0]
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def status(self):
+        """
+        <return>  list  "hg status" lines, empty for a clean working copy
+        """
+        return [line for line in self.query(['status']).split('\n') if line != '']
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def branch_log(self, style=None):
+        """
+        <return>  string  "hg log" output for the newest changeset on the working copy branch
+        style     string  path of an hg style file, None for the default log output
+        """
+        args = ['log', '-b', self.branch(), '-l', '1']
+        if style is not None:
+            args += ['--style', style]
+        return self.query(args)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def query(self, args):
+        """
+        Runs an hg command once and caches its stripped output.
+        args      list    hg arguments without the hg command itself
+        <return>  string
+        """
+        key = tuple(args)
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = self._run(args)
+            return self._cache[key]
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def uses_cmdserver(self):
+        with self._lock:
+            return self._server is not None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def close(self):
+        """
+        Shuts down the command server. Cached results stay available.
+        """
+        server = self._server
+        self._server = None
+
+        if server is not None:
+            try:
+                server.stdin.close()
+                server.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                server.kill()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _identify(self):
+        # One query for changeset and branch: "<id>[+] <branch>"
+        changeset, _, branch = self.query(['identify', '--id', '--branch']).partition(' ')
+        return changeset, branch.strip()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _run(self, args):
+        if self._use_cmdserver and self._server is None:
+            self._start_server()
+
+        if self._server is not None:
+            try:
+                returncode, output, errors = self._run_cmdserver(args)
+            except (OSError, ValueError, struct.error) as err:
+                print_warn('WARNING: Mercurial command server failed, falling back to separate processes.')
+                print_warn(str(err))
+                self.close()
+                self._use_cmdserver = False
+                return self._run(args)
+
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, [self._hg_cmd] + args, output, errors)
+            return output.strip()
+
+        result = subprocess.run([self._hg_cmd] + args, cwd=self._repo_dir, env=self._env, check=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        return result.stdout.strip()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _start_server(self):
+        try:
+            server = subprocess.Popen([self._hg_cmd, 'serve', '--cmdserver', 'pipe'],
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL,
+                                      cwd=self._repo_dir, env=self._env)
+        except OSError:
+            self._use_cmdserver = False
+            return
+
+        self._server = server
+        try:
+            channel, data = self._read_message()
+            if channel != b'o' or not b'runcommand' in data:
+                raise ValueError('unexpected hello message')
+            for line in data.decode('ascii', 'replace').split('\n'):
+                key, _, value = line.partition(': ')
+                if key == 'encoding':
+                    self._encoding = value.strip()
+        except (OSError, ValueError, struct.error):
+            self.close()
+            self._use_cmdserver = False
+            return
+
+        atexit.register(self.close)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _run_cmdserver(self, args):
+        data = '\0'.join(args).encode(self._encoding)
+        self._server.stdin.write(b'runcommand\n' + struct.pack('>I', len(data)) + data)
+        self._server.stdin.flush()
+
+        output = {b'o': [], b'e': []}
+        while True:
+            channel, data = self._read_message()
+
+            if channel in output:
+                output[channel].append(data)
+            elif channel == b'r':
+                return (struct.unpack('>i', data)[0], b''.join(output[b'o']).decode(self._encoding, 'replace'),
+                        b''.join(output[b'e']).decode(self._encoding, 'replace'))
+            elif channel in (b'I', b'L'):
+                # Queries never need input. Answer with EOF.
+                self._server.stdin.write(struct.pack('>I', 0))
+                self._server.stdin.flush()
+            elif channel.isupper():
+                raise ValueError('unsupported command server channel ' + repr(channel))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _read_message(self):
+        """
+        Reads one command server message.
+        <return>  tuple  (channel, data). For input channels data is the requested size.
+        """
+        header = self._read_exact(5)
+        channel = header[:1]
+        length = struct.unpack('>I', header[1:])[0]
+
+        if channel in (b'I', b'L'):
+            return channel, length
+        return channel, self._read_exact(length)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self._server.stdout.read(size - len(data))
+            if not chunk:
+                raise OSError('Mercurial command server closed the connection.')
+            data += chunk
+        return data
+
+
+# -----------------------------------------------------------------------
+class RevisionInfo:
+    """
+    Metadata of a committed revision instead of the working copy, with the
+    same interface as RepoInfo. All queries go through a shared RepoInfo,
+    so several revisions use one command server and one cache.
+    """
+    _repo = None
+    _rev = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, repo, rev):
+        """
+        repo  RepoInfo  the repository
+        rev   string    revision, tag or branch name
+        """
+        self._repo = repo
+        self._rev = rev
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def branch(self):
+        return self._identify()[1]
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def changeset(self):
+        """
+        <return>  string  short id of the revision. A branch name resolves to
+                          its head at the time of the first query.
+        """
+        return self._identify()[0]
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def status(self):
+        # A committed revision has no uncommitted changes.
+        return []
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def branch_log(self, style=None):
+        """
+        <return>  string  "hg log" output for the revision itself
+        style     string  path of an hg style file, None for the default log output
+        """
+        args = ['log', '-r', self.changeset()]
+        if style is not None:
+            args += ['--style', style]
+        return self._repo.query(args)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def query(self, args):
+        return self._repo.query(args)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _identify(self):
+        changeset, _, branch = self._repo.query(['identify', '-r', self._rev, '--id', '--branch']).partition(' ')
+        return changeset, branch.strip()
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
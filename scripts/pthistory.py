@@ -0,0 +1,257 @@
+#-*- coding: utf8 -*-
+
+import contextlib, os, statistics, sys, time
+from utils import print_warn, print_err
+
+# sqlite3 is part of every normal Python installation, but can be left out of
+# embedded ones. Without it no history is kept and nothing is estimated.
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+USER_INVOKED = False
+
+HISTORY_RUNS     = 10     # an estimate is the median of this many newest samples
+SLOW_FACTOR      = 1.5    # a stage is slow when it takes this much longer than its median ...
+SLOW_MIN_SECONDS = 10     # ... and at least this many seconds more
+SLOW_MIN_SAMPLES = 3      # stages with fewer earlier samples are never slow
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, started TEXT, kind TEXT,'
+    ' concurrent INTEGER, success INTEGER, wall_s REAL)',
+    'CREATE TABLE IF NOT EXISTS stages (run_id INTEGER REFERENCES runs(id), track TEXT, stage TEXT,'
+    ' leaf INTEGER, wall_s REAL, child_cpu_s REAL, bytes_copied INTEGER)',
+    'CREATE INDEX IF NOT EXISTS stages_by_name ON stages (stage, track)'
+]
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    if len(cli_params) != 1:
+        print_err('Usage: pthistory.py <history file>')
+        return False
+
+    if not os.path.isfile(cli_params[0]):
+        print_err('ERROR: History file "%s" not found.'%cli_params[0])
+        return False
+
+    rows = TimingHistory(cli_params[0]).stage_table()
+    if rows is None:
+        return False
+
+    print('%-20s %-8s %9s %9s %9s %6s'%('Stage', 'Track', 'Median', 'Last', 'Copied', 'Runs'))
+    for stage, track, median, last, copied, count in rows:
+        print('%-20s %-8s %9s %9s %9s %6d'%(stage[:20], track[:8], format_duration(median), format_duration(last),
+                                            '-' if not copied else '%.0f MB'%(copied / 2**20), count))
+    return True
+
+
+# -----------------------------------------------------------------------
+class TimingHistory:
+    """
+    Durations and byte volumes of the traced stages of all earlier runs in
+    an SQLite database, per stage and track (arch). Estimates are medians of
+    the newest successful runs, so a single outlier does not spoil them.
+    Keeping the history is a side job: errors only print a warning, a
+    missing or broken database just means there is nothing to estimate from.
+    Every call uses its own connection, so it is safe to use from several
+    threads and processes.
+    """
+    _path = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, path):
+        self._path = path
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def record(self, events, kind='release', concurrent=False, success=True):
+        """
+        Adds a run.
+        events      list    complete Chrome trace events of the run, see Tracer.events()
+        kind        string  e.g. 'release' or 'batch'
+        concurrent  bool    archs were built at the same time
+        success     bool    only successful runs are used for estimates
+        <return>    bool    True if the run was stored
+        """
+        if sqlite3 is None:
+            return False
+
+        stages = _stage_rows(events)
+        wall = max([(event['ts'] + event['dur']) / 1e6 for event in events if event.get('ph') == 'X'] or [0])
+
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+            with self._connect() as db:
+                run_id = db.execute('INSERT INTO runs (started, kind, concurrent, success, wall_s) VALUES (?, ?, ?, ?, ?)',
+                                    (time.strftime('%Y-%m-%d %H:%M:%S'), kind, int(concurrent), int(success),
+                                     wall)).lastrowid
+                db.executemany('INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               [(run_id,) + row for row in stages])
+            return True
+        except (OSError, sqlite3.Error) as err:
+            print_warn('WARNING: Could not save timing history to "%s".'%self._path)
+            print_warn(str(err))
+            return False
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def estimate(self, stage, track, concurrent=None, column='wall_s', fallback=True):
+        """
+        Expected value of a stage. Runs in the same mode (concurrent or not)
+        are preferred. Without any for this track the stage on other tracks
+        counts, e.g. ptupdata, which runs in whichever arch gets there first.
+        stage       string  span name, e.g. 'make'
+        track       string  e.g. 'win64'
+        concurrent  bool    mode of the run to estimate, None for any
+        column      string  'wall_s', 'child_cpu_s' or 'bytes_copied'
+        fallback    bool    False: only runs in this mode and on this track count
+        <return>    tuple   (median, number of samples), (None, 0) without history
+        """
+        samples = self._samples(stage, track, concurrent, column)
+        if fallback:
+            samples = samples or self._samples(stage, track, None, column) \
+                      or self._samples(stage, None, None, column)
+        if not samples:
+            return None, 0
+        return statistics.median(samples), len(samples)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def slow_stages(self, events, concurrent=None):
+        """
+        Compares the innermost spans of a run with their history. Call it
+        before record(), or the run is compared with itself.
+        <return>  list  (track, stage, seconds, median seconds) of every stage that was
+                        much slower than usual
+        """
+        slow = []
+        for track, stage, leaf, wall, cpu, copied in _stage_rows(events):
+            if not leaf:
+                continue    # a slow make is reported once, not again for build and the job around it
+            samples = self._samples(stage, track, concurrent, 'wall_s')
+            if len(samples) < SLOW_MIN_SAMPLES:
+                continue
+            median = statistics.median(samples)
+            if wall > median * SLOW_FACTOR and wall - median > SLOW_MIN_SECONDS:
+                slow.append((track, stage, wall, median))
+        return slow
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def stage_table(self):
+        """
+        <return>  list  (stage, track, median s, last s, median bytes copied, samples) of every
+                        stage in the history, None on error
+        """
+        if sqlite3 is None:
+            print_err('ERROR: Python has no sqlite3 module.')
+            return None
+
+        try:
+            with self._connect() as db:
+                names = db.execute('SELECT DISTINCT stages.stage, stages.track FROM stages JOIN runs ON runs.id = run_id'
+                                   ' WHERE runs.success ORDER BY stages.track, stages.stage').fetchall()
+        except sqlite3.Error as err:
+            print_err('ERROR: Could not read timing history "%s".'%self._path)
+            print_err(str(err))
+            return None
+
+        rows = []
+        for stage, track in names:
+            samples = self._samples(stage, track, None, 'wall_s')
+            copied = self._samples(stage, track, None, 'bytes_copied')
+            if samples:
+                rows.append((stage, track, statistics.median(samples), samples[0],
+                             statistics.median(copied) if copied else 0, len(samples)))
+        return rows
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _samples(self, stage, track, concurrent, column):
+        """
+        <return>  list  values of column of the newest HISTORY_RUNS samples, newest first
+        """
+        if sqlite3 is None or not os.path.isfile(self._path):
+            return []
+
+        query = 'SELECT stages.%s FROM stages JOIN runs ON runs.id = run_id WHERE runs.success AND stage = ?'%column
+        params = [stage]
+        if track is not None:
+            query += ' AND track = ?'
+            params.append(track)
+        if concurrent is not None:
+            query += ' AND runs.concurrent = ?'
+            params.append(int(concurrent))
+        query += ' ORDER BY runs.id DESC LIMIT ?'
+        params.append(HISTORY_RUNS)
+
+        try:
+            with self._connect() as db:
+                return [row[0] for row in db.execute(query, params) if row[0] is not None]
+        except sqlite3.Error:
+            return []
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    @contextlib.contextmanager
+    def _connect(self):
+        """
+        Context manager for a connection with the tables in place. Commits
+        when the block finishes without an exception.
+        """
+        db = sqlite3.connect(self._path, timeout=10)
+        try:
+            with db:
+                for statement in SCHEMA:
+                    db.execute(statement)
+                yield db
+        finally:
+            db.close()
+
+
+# -----------------------------------------------------------------------
+def format_duration(seconds):
+    """
+    <return>  string  e.g. '4.2s' or '12:05' (minutes:seconds), '?' for None
+    """
+    if seconds is None:
+        return '?'
+    if seconds < 60:
+        return '%.1fs'%seconds
+    return '%d:%02d'%(seconds // 60, seconds % 60)
+
+
+# -----------------------------------------------------------------------
+def _stage_rows(events):
+    """
+    <return>  list  (track, stage, leaf, wall s, child CPU s, bytes copied) of every span,
+                    leaf is True for spans without nested spans
+    """
+    tracks = {event['tid']: event['args']['name'] for event in events
+              if event.get('ph') == 'M' and event['name'] == 'thread_name'}
+    spans = sorted((event for event in events if event.get('ph') == 'X'),
+                   key=lambda event: (event['tid'], event['ts'], -event['dur']))
+
+    rows = []
+    current_tid = None
+    open_spans = []     # (end, row index) of the spans around the current one
+    for event in spans:
+        if event['tid'] != current_tid:
+            current_tid = event['tid']
+            open_spans = []
+        while open_spans and open_spans[-1][0] <= event['ts']:
+            open_spans.pop()
+        if open_spans:
+            rows[open_spans[-1][1]][2] = False
+
+        args = event.get('args', {})
+        open_spans.append((event['ts'] + event['dur'], len(rows)))
+        rows.append([tracks.get(event['tid'], 'track %d'%event['tid']), event['name'], True, event['dur'] / 1e6,
+                     args.get('child_cpu_s', 0.0), args.get('bytes_copied', 0)])
+
+    return [tuple(row) for row in rows]
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
@@ -0,0 +1,311 @@
+#-*- coding: utf8 -*-
+
+import hashlib, json, mmap, multiprocessing, os, shutil, sys, time
+from utils import print_ok, print_err
+
+import pttrace
+
+USER_INVOKED = False
+
+MANIFEST_VERSION = 1
+MMAP_MIN_SIZE    = 1 << 20     # smaller files are read in one piece
+MMAP_WINDOW_SIZE = 64 << 20    # mapped at once, must be a multiple of mmap.ALLOCATIONGRANULARITY
+HASH_BATCH_SIZE  = 8 << 20     # small files go to the hash processes in batches of about this many bytes
+MAX_REPORTED     = 20          # differences listed per kind by verify_tree()
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    usage = ['Usage: ptmanifest.py <dir> [<manifest file>]',
+             '       ptmanifest.py --verify <dir> <manifest file> [--allow-extra]']
+    options = [param for param in cli_params if param.startswith('--')]
+    args = [param for param in cli_params if not param.startswith('--')]
+
+    if '--verify' in options:
+        if len(args) != 2 or not set(options) <= {'--verify', '--allow-extra'}:
+            for line in usage:
+                print_err(line)
+            return False
+        manifest = load_manifest(args[1])
+        if manifest is None:
+            return False
+        return verify_tree(args[0], manifest, allow_extra='--allow-extra' in options)
+
+    if not len(args) in (1, 2) or len(options) > 0:
+        for line in usage:
+            print_err(line)
+        return False
+
+    manifest = build_manifest(args[0])
+    if manifest is None:
+        return False
+
+    if len(args) == 2:
+        return save_manifest(manifest, args[1])
+
+    for relpath, entry in sorted(manifest['files'].items()):
+        print('%s %10d %s'%(entry['sha1'], entry['size'], relpath))
+    return True
+
+
+# -----------------------------------------------------------------------
+def build_manifest(bindir, name='', jobs=None):
+    """
+    Lists every file of a dir tree with its size and SHA-1. Files are
+    hashed in parallel processes.
+    bindir    string  dir to describe
+    name      string  release name stored in the manifest
+    jobs      int     parallel hash processes, default is the number of cores
+    <return>  dict    {'version', 'name', 'created', 'files': {relative path with "/": {'size', 'sha1'}}},
+                      None on error
+    """
+    try:
+        files = _list_files(bindir)
+        digests = hash_files(files.values(), jobs)
+    except OSError as err:
+        print_err('ERROR: Hashing the files in "%s" failed.'%bindir)
+        print_err(str(err))
+        return None
+
+    return {
+        'version': MANIFEST_VERSION,
+        'name':    name,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'files':   {relpath: {'size': size, 'sha1': digests[path]}
+                    for relpath, (path, size) in sorted(files.items())}
+    }
+
+
+# -----------------------------------------------------------------------
+def verify_tree(rootdir, manifest, allow_extra=False, jobs=None):
+    """
+    Compares a dir tree against a manifest in one pass. Missing and extra
+    files are found from the dir listing, files with a different size are
+    reported without reading them, only the rest is hashed (in parallel).
+    rootdir      string  bin dir or installation to check
+    manifest     dict    see build_manifest()
+    allow_extra  bool    files that are not in the manifest are fine, e.g. the
+                         uninstaller of an installation
+    <return>     bool    True if the tree matches the manifest
+    """
+    try:
+        files = _list_files(rootdir)
+        expected = manifest['files']
+        to_hash = {relpath: files[relpath] for relpath in expected
+                   if relpath in files and files[relpath][1] == expected[relpath]['size']}
+        digests = hash_files(to_hash.values(), jobs)
+    except OSError as err:
+        print_err('ERROR: Hashing the files in "%s" failed.'%rootdir)
+        print_err(str(err))
+        return False
+
+    differences = [
+        ['missing', sorted(set(expected) - set(files))],
+        ['changed', sorted(relpath for relpath in expected if relpath in files and
+                           (relpath not in to_hash or digests[to_hash[relpath][0]] != expected[relpath]['sha1']))],
+        ['unexpected', [] if allow_extra else sorted(set(files) - set(expected))]
+    ]
+
+    if not any(relpaths for kind, relpaths in differences):
+        print_ok('%s matches manifest %s: %d files.'%(rootdir, manifest['name'], len(expected)))
+        return True
+
+    print_err('ERROR: %s does not match manifest %s.'%(rootdir, manifest['name']))
+    for kind, relpaths in differences:
+        for relpath in relpaths[:MAX_REPORTED]:
+            print_err('  %-10s  %s'%(kind, relpath))
+        if len(relpaths) > MAX_REPORTED:
+            print_err('  %-10s  ... and %d more'%(kind, len(relpaths) - MAX_REPORTED))
+    return False
+
+
+# -----------------------------------------------------------------------
+def hash_file(path):
+    """
+    Large files are hashed through memory mapped windows, so their contents
+    are never copied into Python objects.
+    <return>  string  SHA-1 of the file, same as ptupdata.file_digest()
+    """
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        size = os.fstat(infile.fileno()).st_size
+        if size < MMAP_MIN_SIZE:
+            hasher.update(infile.read())
+        else:
+            for offset in range(0, size, MMAP_WINDOW_SIZE):
+                with mmap.mmap(infile.fileno(), min(MMAP_WINDOW_SIZE, size - offset),
+                               access=mmap.ACCESS_READ, offset=offset) as window:
+                    hasher.update(window)
+    return hasher.hexdigest()
+
+
+# -----------------------------------------------------------------------
+def hash_files(files, jobs=None):
+    """
+    Hashes files in a process pool. Large files are hashed first and one
+    at a time, small files in batches, so the processes finish at about
+    the same time and the pool overhead stays small.
+    files     iterable  (path, size) tuples
+    jobs      int       parallel processes, default is the number of cores
+    <return>  dict      path -> SHA-1
+    Raises OSError when a file cannot be read.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    batches = []
+    batch = []
+    batch_size = 0
+    for path, size in sorted(files, key=lambda item: item[1], reverse=True):
+        batch.append(path)
+        batch_size += size
+        if batch_size >= HASH_BATCH_SIZE:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+    if len(batch) > 0:
+        batches.append(batch)
+
+    if jobs <= 1 or len(batches) <= 1:
+        results = [_hash_batch(batch) for batch in batches]
+    else:
+        with pttrace.ProcessPool(max_workers=min(jobs, len(batches))) as pool:
+            results = list(pool.map(_hash_batch, batches))
+
+    return {path: digest for batch, digests in zip(batches, results) for path, digest in zip(batch, digests)}
+
+
+# -----------------------------------------------------------------------
+def _hash_batch(paths):
+    return [hash_file(path) for path in paths]
+
+
+# -----------------------------------------------------------------------
+def _list_files(rootdir):
+    """
+    <return>  dict  relative path with "/" -> (path, size) for every file below rootdir
+    Raises OSError when rootdir is not a dir.
+    """
+    if not os.path.isdir(rootdir):
+        raise OSError('"%s" is missing or not a folder.'%rootdir)
+
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(rootdir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            files[os.path.relpath(path, rootdir).replace(os.sep, '/')] = (path, os.path.getsize(path))
+    return files
+
+
+# -----------------------------------------------------------------------
+def save_manifest(manifest, path):
+    try:
+        with open(path + '.tmp', 'w') as outfile:
+            json.dump(manifest, outfile, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+        return True
+    except OSError as err:
+        print_err('ERROR: Could not write manifest "%s".'%path)
+        print_err(str(err))
+        return False
+
+
+# -----------------------------------------------------------------------
+def load_manifest(path):
+    """
+    <return>  dict  the manifest, None when it cannot be read
+    """
+    try:
+        with open(path) as infile:
+            manifest = json.load(infile)
+    except (OSError, ValueError) as err:
+        print_err('ERROR: Could not read manifest "%s".'%path)
+        print_err(str(err))
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        print_err('ERROR: Manifest "%s" has an unknown format.'%path)
+        return None
+    return manifest
+
+
+# -----------------------------------------------------------------------
+class ReleaseStore:
+    """
+    Archive of released bin trees. Every release is a manifest, the file
+    contents are stored once by their SHA-1, so files that did not change
+    between releases (most DLLs, all data files) take no additional space.
+    Layout: <store>/<release name>.json and <store>/blobs/<2 hex digits>/<sha1>
+    """
+    _path = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, path):
+        self._path = path
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def releases(self):
+        """
+        <return>  list  names of all archived releases, oldest first
+        """
+        if not os.path.isdir(self._path):
+            return []
+        manifests = [entry for entry in os.scandir(self._path) if entry.name.endswith('.json')]
+        return [entry.name[:-len('.json')] for entry in sorted(manifests, key=lambda entry: entry.stat().st_mtime)]
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def manifest(self, name):
+        """
+        <return>  dict  manifest of a release, None if it is not archived
+        """
+        return load_manifest(os.path.join(self._path, name + '.json'))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def blob_path(self, sha1):
+        return os.path.join(self._path, 'blobs', sha1[:2], sha1)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def archive(self, bindir, name, jobs=None, manifest=None):
+        """
+        Adds a release: hashes bindir, stores new file contents and writes
+        the manifest. Blobs are real copies, not hard links, so later changes
+        to bindir (e.g. strip) cannot modify archived releases.
+        manifest  dict  manifest of bindir when already known, it is not hashed again then
+        <return>  dict  the manifest, None on error
+        """
+        if manifest is None:
+            manifest = build_manifest(bindir, name, jobs)
+            if manifest is None:
+                return None
+        manifest = dict(manifest, name=name)
+
+        stored = 0
+        try:
+            os.makedirs(self._path, exist_ok=True)
+            for relpath, entry in manifest['files'].items():
+                blob = self.blob_path(entry['sha1'])
+                if os.path.exists(blob):
+                    continue
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                shutil.copyfile(os.path.join(bindir, *relpath.split('/')), blob + '.tmp')
+                os.replace(blob + '.tmp', blob)
+                stored += 1
+        except OSError as err:
+            print_err('ERROR: Archiving release "%s" failed.'%name)
+            print_err(str(err))
+            return None
+
+        if not save_manifest(manifest, os.path.join(self._path, name + '.json')):
+            return None
+
+        print_ok('Archived release %s: %d files, %d new in the store.'%(name, len(manifest['files']), stored))
+        return manifest
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
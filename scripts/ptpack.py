@@ -0,0 +1,250 @@
+#-*- coding: utf8 -*-
+
+import os, shutil, sys, zipfile
+from utils import print_ok, print_err
+
+import ptcache, ptupdata
+
+USER_INVOKED = False
+
+PACK_EXTENSION = '.ptpack'
+PACK_FORMAT    = 'ptpack 1'     # part of the fingerprint, change it when the pack layout changes
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    usage = ['Usage: ptpack.py pack <dir> [<pack file>]',
+             '       ptpack.py list <pack file>',
+             '       ptpack.py extract <pack file> <dest dir> [<entry> ...]']
+
+    if len(cli_params) in (2, 3) and cli_params[0] == 'pack':
+        pack_path = cli_params[2] if len(cli_params) == 3 else cli_params[1].rstrip('/\\') + PACK_EXTENSION
+        stats = pack_dir(cli_params[1], pack_path)
+        if stats is None:
+            return False
+        print_ok('%s: %s'%(pack_path, stats))
+        return True
+
+    try:
+        if len(cli_params) == 2 and cli_params[0] == 'list':
+            with DataPack(cli_params[1]) as pack:
+                for name in pack.names():
+                    print('%10d %s'%(pack.size(name), name))
+            return True
+        elif len(cli_params) >= 3 and cli_params[0] == 'extract':
+            with DataPack(cli_params[1]) as pack:
+                count = pack.extract(cli_params[2], cli_params[3:] or None)
+            print_ok('%d files extracted to %s.'%(count, cli_params[2]))
+            return True
+    except (OSError, KeyError, zipfile.BadZipFile) as err:
+        print_err('ERROR: Reading pack "%s" failed.'%cli_params[1])
+        print_err(str(err))
+        return False
+
+    for line in usage:
+        print_err(line)
+    return False
+
+
+# -----------------------------------------------------------------------
+class PackStats:
+    def __init__(self):
+        self.packed    = 0      # packs written
+        self.unchanged = 0      # packs that were up to date
+        self.files     = 0      # in all packs
+        self.bytes     = 0      # file contents written into packs
+
+    def add(self, other):
+        self.packed    += other.packed
+        self.unchanged += other.unchanged
+        self.files     += other.files
+        self.bytes     += other.bytes
+
+    def __str__(self):
+        return '%d packed, %d unchanged, %d files, %.1f MB written'%(
+               self.packed, self.unchanged, self.files, self.bytes / 2**20)
+
+
+# -----------------------------------------------------------------------
+class DataPack:
+    """
+    Read access to a pack without unpacking it. A pack is a zip file with
+    uncompressed entries: opening it only reads the central directory at its
+    end, every entry is then found by its path and read in one piece. Paths
+    are relative to the packed dir and use "/". Use it as a context manager
+    or call close().
+    Raises OSError or zipfile.BadZipFile when the pack cannot be opened.
+    """
+    _zip = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, path):
+        self._zip = zipfile.ZipFile(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._zip.close()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def names(self):
+        """
+        <return>  list  paths of all entries in pack order (sorted)
+        """
+        return self._zip.namelist()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def size(self, name):
+        """
+        <return>  int  size of an entry in bytes. Raises KeyError for unknown entries.
+        """
+        return self._zip.getinfo(name.replace('\\', '/')).file_size
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def read(self, name):
+        """
+        <return>  bytes  contents of an entry. Raises KeyError for unknown entries.
+        """
+        return self._zip.read(name.replace('\\', '/'))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def extract(self, destdir, names=None):
+        """
+        Writes entries below destdir, with their subdirs.
+        names     list  entries to extract, None for all
+        <return>  int   number of files written
+        Raises KeyError for unknown entries, OSError when writing fails.
+        """
+        if names is None:
+            names = self.names()
+        for name in names:
+            self._zip.extract(self._zip.getinfo(name.replace('\\', '/')), destdir)
+        return len(names)
+
+
+# -----------------------------------------------------------------------
+def pack_data(basedir):
+    """
+    Packs every data dir in basedir that is marked as packed in
+    ptupdata.DIR_LIST into <dir name>.ptpack next to it. The dirs stay
+    where they are, so the next incremental update still works on them.
+    <return>  PackStats  statistics for all packs, None on error
+    """
+    total = PackStats()
+    for name, ignore, packed in ptupdata.DIR_LIST:
+        if not packed:
+            continue
+        stats = pack_dir(os.path.join(basedir, name), os.path.join(basedir, name + PACK_EXTENSION),
+                         None if ignore is None else shutil.ignore_patterns(ignore))
+        if stats is None:
+            return None
+        total.add(stats)
+    return total
+
+
+# -----------------------------------------------------------------------
+def packed_names():
+    """
+    <return>  list  names of the data dirs that pack_data() packs
+    """
+    return [name for name, ignore, packed in ptupdata.DIR_LIST if packed]
+
+
+# -----------------------------------------------------------------------
+def pack_dir(srcdir, pack_path, ignore=None):
+    """
+    Packs all files below srcdir into one pack. Entries are stored in sorted
+    order without compression: the installer compresses the whole pack much
+    better than thousands of single files anyway, and uncompressed entries
+    are read without any decoding. An existing pack with the same files,
+    sizes and modification times is kept. Zip entry times only have a 2 s
+    resolution, so the exact times go into the zip comment as a fingerprint.
+    ignore    callable   same as the ignore argument of shutil.copytree()
+    <return>  PackStats  None on error
+    """
+    stats = PackStats()
+    try:
+        files = _list_files(srcdir, ignore)
+        stats.files = len(files)
+
+        # Taken before reading the files: a file that changes while it is packed
+        # no longer matches next time.
+        fingerprint = _files_fingerprint(files)
+        if _is_pack_current(pack_path, fingerprint):
+            stats.unchanged = 1
+            return stats
+
+        with zipfile.ZipFile(pack_path + '.tmp', 'w', zipfile.ZIP_STORED) as pack:
+            pack.comment = fingerprint
+            for relpath, path in files:
+                info = zipfile.ZipInfo.from_file(path, relpath, strict_timestamps=False)
+                with open(path, 'rb') as infile:
+                    pack.writestr(info, infile.read())
+                stats.bytes += info.file_size
+        os.replace(pack_path + '.tmp', pack_path)
+        stats.packed = 1
+        return stats
+    except (OSError, zipfile.BadZipFile) as err:
+        print_err('ERROR: Packing "%s" failed.'%srcdir)
+        print_err(str(err))
+        return None
+
+
+# -----------------------------------------------------------------------
+def _list_files(srcdir, ignore=None):
+    """
+    <return>  list  sorted (relative path with "/", path) of every file below srcdir
+    Raises OSError when srcdir is not a dir.
+    """
+    if not os.path.isdir(srcdir):
+        raise OSError('"%s" is missing or not a folder.'%srcdir)
+
+    files = []
+    for dirpath, dirnames, filenames in os.walk(srcdir):
+        if ignore is not None:
+            ignored = ignore(dirpath, dirnames + filenames)
+            dirnames[:] = [name for name in dirnames if not name in ignored]
+            filenames = [name for name in filenames if not name in ignored]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            files.append((os.path.relpath(path, srcdir).replace(os.sep, '/'), path))
+    return sorted(files)
+
+
+# -----------------------------------------------------------------------
+def _files_fingerprint(files):
+    """
+    <return>  bytes  digest of the relative path, size and exact modification time
+                     (ns) of every file, stored as the zip comment of the pack
+    Raises OSError when a file cannot be read.
+    """
+    entries = []
+    for relpath, path in files:
+        stat = os.stat(path)
+        entries.append('%s %d %d'%(relpath, stat.st_size, stat.st_mtime_ns))
+    return ptcache.make_key(PACK_FORMAT, entries).encode('ascii')
+
+
+# -----------------------------------------------------------------------
+def _is_pack_current(pack_path, fingerprint):
+    """
+    <return>  bool  True if the pack was made from files with this fingerprint
+    """
+    try:
+        with zipfile.ZipFile(pack_path) as pack:
+            return pack.comment == fingerprint
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
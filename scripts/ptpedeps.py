@@ -0,0 +1,265 @@
+#-*- coding: utf8 -*-
+
+import json, os, struct, sys, threading
+from utils import print_warn, print_err
+
+USER_INVOKED = False
+
+# data directory indexes in the PE optional header
+IMPORT_DIR       = 1
+DELAY_IMPORT_DIR = 13
+
+PE32_MAGIC      = 0x10b
+PE32_PLUS_MAGIC = 0x20b
+
+# Concurrent arch pipelines share one cache file; save() merges under this lock.
+_save_lock = threading.Lock()
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    if len(cli_params) < 2:
+        print_err('Usage: ptpedeps.py <exe or dll> <lib dir> [<lib dir> ...]')
+        return False
+
+    try:
+        index = DllIndex(cli_params[1:])
+        resolved, unresolved = resolve_deps([cli_params[0]], index)
+    except (OSError, PEError) as err:
+        print_err('ERROR: ' + str(err))
+        return False
+
+    for name in sorted(resolved, key=str.lower):
+        print(resolved[name])
+
+    if len(unresolved) > 0:
+        print_warn('Not found in the lib dirs (assumed to be system DLLs):')
+        print_warn(' '.join(sorted(unresolved, key=str.lower)))
+
+    return True
+
+
+# -----------------------------------------------------------------------
+class PEError(Exception):
+    pass
+
+
+# -----------------------------------------------------------------------
+def read_imports(path):
+    """
+    Reads the names of all DLLs a PE file (EXE or DLL) imports, including
+    delay-loaded ones. Only the headers and the import tables are read.
+    <return>  list    DLL names as stored in the file
+    Raises PEError for files that are not valid PE files, OSError on read errors.
+    """
+    with open(path, 'rb') as pefile:
+        def read_at(offset, size):
+            pefile.seek(offset)
+            data = pefile.read(size)
+            if len(data) < size:
+                raise PEError('%s: truncated PE file.'%path)
+            return data
+
+        if read_at(0, 2) != b'MZ':
+            raise PEError('%s: not a PE file (no MZ header).'%path)
+        pe_offset = struct.unpack('<I', read_at(0x3c, 4))[0]
+        if read_at(pe_offset, 4) != b'PE\0\0':
+            raise PEError('%s: not a PE file (no PE signature).'%path)
+
+        num_sections, = struct.unpack('<H', read_at(pe_offset + 6, 2))
+        opt_size, = struct.unpack('<H', read_at(pe_offset + 20, 2))
+        opt_offset = pe_offset + 24
+        optional = read_at(opt_offset, opt_size)
+
+        magic, = struct.unpack_from('<H', optional, 0)
+        if magic == PE32_MAGIC:
+            image_base, = struct.unpack_from('<I', optional, 28)
+            num_dirs, = struct.unpack_from('<I', optional, 92)
+            dirs_offset = 96
+        elif magic == PE32_PLUS_MAGIC:
+            image_base, = struct.unpack_from('<Q', optional, 24)
+            num_dirs, = struct.unpack_from('<I', optional, 108)
+            dirs_offset = 112
+        else:
+            raise PEError('%s: unknown optional header magic 0x%x.'%(path, magic))
+
+        def data_dir(index):
+            if index >= num_dirs or dirs_offset + 8 * (index + 1) > opt_size:
+                return 0, 0
+            return struct.unpack_from('<II', optional, dirs_offset + 8 * index)
+
+        sections = []
+        table = read_at(opt_offset + opt_size, 40 * num_sections)
+        for i in range(num_sections):
+            virt_size, virt_addr, raw_size, raw_ptr = struct.unpack_from('<IIII', table, 40 * i + 8)
+            sections.append((virt_addr, max(virt_size, raw_size), raw_ptr))
+
+        def rva_to_offset(rva):
+            for virt_addr, size, raw_ptr in sections:
+                if virt_addr <= rva < virt_addr + size:
+                    return rva - virt_addr + raw_ptr
+            raise PEError('%s: RVA 0x%x outside of all sections.'%(path, rva))
+
+        def read_name(rva):
+            pefile.seek(rva_to_offset(rva))
+            return pefile.read(256).split(b'\0', 1)[0].decode('ascii', 'replace')
+
+        names = []
+
+        # IMAGE_IMPORT_DESCRIPTOR: 20 bytes, DLL name RVA at offset 12
+        import_rva, import_size = data_dir(IMPORT_DIR)
+        if import_rva != 0:
+            offset = rva_to_offset(import_rva)
+            while True:
+                descriptor = read_at(offset, 20)
+                if descriptor == b'\0' * 20:
+                    break
+                names.append(read_name(struct.unpack_from('<I', descriptor, 12)[0]))
+                offset += 20
+
+        # IMAGE_DELAYLOAD_DESCRIPTOR: 32 bytes, attributes and DLL name at offset 0 and 4.
+        # Old linkers store VAs instead of RVAs, marked by attribute bit 0 being unset.
+        delay_rva, delay_size = data_dir(DELAY_IMPORT_DIR)
+        if delay_rva != 0:
+            offset = rva_to_offset(delay_rva)
+            while True:
+                descriptor = read_at(offset, 32)
+                if descriptor == b'\0' * 32:
+                    break
+                attributes, name_addr = struct.unpack_from('<II', descriptor, 0)
+                names.append(read_name(name_addr if attributes & 1 else name_addr - image_base))
+                offset += 32
+
+    return names
+
+
+# -----------------------------------------------------------------------
+class DllIndex:
+    """
+    Maps DLL names (case-insensitive, as Windows does) to files in a list of
+    lib dirs. Earlier dirs win when a name exists more than once. With a
+    cache file the import lists of all DLLs are remembered between runs,
+    keyed on path, size and mtime, so only new or changed DLLs are parsed.
+    """
+    _dlls = None
+    _cache_path = None
+    _imports = None
+    _parsed = None      # cache entries added since the last save()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, libdirs, cache_path=None):
+        self._dlls = {}
+        self._cache_path = cache_path
+        self._parsed = {}
+        self._imports = {} if cache_path is None else _load_cache(cache_path)
+
+        for libdir in libdirs:
+            if not os.path.isdir(libdir):
+                continue
+            for entry in os.scandir(libdir):
+                if entry.name.lower().endswith('.dll') and entry.is_file():
+                    self._dlls.setdefault(entry.name.lower(), entry.path)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def find(self, name):
+        """
+        <return>  string  path of the DLL, None if it is in none of the lib dirs
+        """
+        return self._dlls.get(name.lower())
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def imports(self, path):
+        """
+        Same as read_imports() but uses the cache.
+        """
+        stat = os.stat(path)
+        key = os.path.normcase(os.path.abspath(path))
+        cached = self._imports.get(key)
+
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+            return cached['imports']
+
+        imports = read_imports(path)
+        self._imports[key] = self._parsed[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'imports': imports}
+        return imports
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def save(self):
+        """
+        Adds the newly parsed DLLs to the cache file. Entries other indexes
+        saved in the meantime are kept: the file is read again and merged
+        under a lock, then replaced in one step, so readers never see a
+        half-written file.
+        <return>  bool  False if the cache could not be written
+        """
+        if self._cache_path is None or not self._parsed:
+            return True
+        temp_path = '%s.%d.tmp'%(self._cache_path, os.getpid())
+        try:
+            with _save_lock:
+                os.makedirs(os.path.dirname(os.path.abspath(self._cache_path)), exist_ok=True)
+                cache = _load_cache(self._cache_path)
+                cache.update(self._parsed)
+                with open(temp_path, 'w') as cachefile:
+                    json.dump(cache, cachefile)
+                os.replace(temp_path, self._cache_path)
+            self._imports = cache
+            self._parsed = {}
+            return True
+        except OSError as err:
+            print_warn('WARNING: Could not write DLL import cache "%s".'%self._cache_path)
+            print_warn(str(err))
+            return False
+
+
+# -----------------------------------------------------------------------
+def _load_cache(path):
+    """
+    <return>  dict  contents of a DLL import cache file, empty if it is missing or broken
+    """
+    try:
+        with open(path) as cachefile:
+            cache = json.load(cachefile)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+# -----------------------------------------------------------------------
+def resolve_deps(roots, index):
+    """
+    Walks the imports of the root binaries transitively.
+    roots     list      paths of EXEs/DLLs to start from
+    index     DllIndex  where to look up imported DLLs
+    <return>  tuple     (dict DLL name -> path of every DLL found in the index,
+                         set of DLL names not found, i.e. system DLLs)
+    """
+    resolved = {}
+    unresolved = set()
+    seen = set()
+    pending = list(roots)
+
+    while len(pending) > 0:
+        for name in index.imports(pending.pop()):
+            if name.lower() in seen:
+                continue
+            seen.add(name.lower())
+
+            path = index.find(name)
+            if path is None:
+                unresolved.add(name)
+            else:
+                resolved[os.path.basename(path)] = path
+                pending.append(path)
+
+    index.save()
+    return resolved, unresolved
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
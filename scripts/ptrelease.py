@@ -2,16 +2,16 @@
 
 import sys
 
-if sys.hexversion < 0x03020000:
-    print('ERROR: Your Python is too old. At least v3.2 needed. Yours is:')
+if sys.hexversion < 0x03080000:
+    print('ERROR: Your Python is too old. At least v3.8 needed. Yours is:')
     print(sys.version)
     sys.exit(1)
 
-import configparser, msvcrt, os, shutil, subprocess
-from subprocess import Popen, PIPE, STDOUT
+import configparser, glob, json, multiprocessing, os, re, shutil, subprocess, threading, time, types
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-import ptupdata, ptuplibs
+import ptarchive, ptcache, ptcheckpoint, ptdelta, pthg, pthistory, ptmanifest, ptpack, ptrun, ptstrip, pttemplate, pttoolchain, pttrace, ptupdata, ptuplibs
 from utils import print_ok, print_warn, print_err
 
 SCRIPT_VERSION = '2.0'
@@ -32,6 +32,11 @@ CMD = {   # updated by load_ini_file()
     STRIP : 'strip'
 }
 
+TOOL_PROBE_FILE = 'toolprobe.json'   # in CACHE_DIR
+
+# placeholders in the installer scripts, see _create_installers()
+ISS_PLACEHOLDERS = ['versionstring', 'changelogfile', 'outputbasename', 'bindir']
+
 # Some commands (like make) do not need parameters to stark working for real.
 # These parameters are for check_bin() ensure that the programs will be
 # executed if present but they will not attempt to do any real work.
@@ -44,6 +49,16 @@ CMD_PARAMS_FOR_TEST = {
 }
 
 ARCHIVE_DIR   = ''   # filled by load_ini_file()
+CACHE_DIR     = os.path.join(os.environ.get('LOCALAPPDATA', os.path.expanduser('~')), 'ptrelease-cache')
+CACHE_MAXSIZE = 2048 # MB, updated by load_ini_file()
+STRIP_SHARE   = 0.25    # part of CACHE_MAXSIZE for the stripped DLLs, the rest is for the binaries
+INCREMENTAL   = False   # updated by load_ini_file()
+MAKE_JOBS     = 0       # 0 means auto, updated by load_ini_file()
+MAKE_THROTTLE = False   # updated by load_ini_file()
+MEM_PER_JOB   = 1024    # MB, updated by load_ini_file()
+RESOLVE_DLLS  = True    # updated by load_ini_file()
+PORTABLE      = ''      # portable archive format (see ptarchive.FORMATS), '' for none, updated by load_ini_file()
+PACK_DATA     = False   # pack the data dirs into one file each, updated by load_ini_file()
 SCRIPT_DIR    = os.path.dirname(os.path.abspath(__file__))
 
 PTBASEDIR   = 0      # Photivo repo base dir (where photivo.pro is)
@@ -56,6 +71,7 @@ LICFILE     = 6      # COPYING file
 LIC3FILE    = 7      # COPYING.3rd.party file
 DATESTYFILE = 8      # Hg shortdate style file
 VERSTYFILE  = 9      # Hg revision/version style file
+COMMONDIR   = 10     # arch independent data files, linked into the bin dirs
 
 TC_NAME = ''    # filled by load_ini_file()
 
@@ -72,6 +88,41 @@ class ArchNames:
 
 DIVIDER = '------------------------------------------------------------------------------'
 
+CLI_OPTIONS = [
+    '--concurrent',   # build win32 and win64 at the same time
+    '--no-cache',     # always compile and strip, do not use cached binaries
+    '--incremental',  # keep the build dirs from the previous run
+    '--resume',       # skip all stages that completed in the previous run with the same inputs
+    '--zip',          # also create a portable zip archive per arch
+    '--xz',           # also create a portable tar.xz archive per arch
+    '--pack-data',    # ship the data dirs as one pack file each
+    '--delta',        # also create a delta package against the newest archived release
+    '--delta=',       # same against the archived release with this date
+    '--batch=',       # run all jobs of a job file without asking anything
+    '--plan'          # only predict how long the release takes
+]
+
+# Prompts that can be answered by a batch job file: prompt name -> policy -> key
+PROMPTS = {
+    'branch':    {'continue': 'y', 'abort': 'n'},   # working copy/revision not on branch "default"
+    'dirty':     {'continue': 'y', 'abort': 'n'},   # uncommitted changes in the working copy
+    'changelog': {'continue': 'c', 'abort': 'a'},   # Changelog.txt not edited today
+    'cleanup':   {'yes': 'y', 'no': 'n'}            # clean up after a complete release
+}
+PROMPT_ANSWERS = {}   # prompt name -> key, these prompts are answered without asking. Filled by load_batch_file()
+
+BATCH_DIR = 'build-batch'   # in the Photivo repo, batch job sources and build trees
+
+BUILD_STAMP_FILE = 'ptrelease-build.stamp'
+CHECKPOINT_FILE  = 'ptrelease-checkpoints.json'   # in PKGBASEDIR
+TRACE_PATTERN    = 'ptrelease-trace-%s.json'      # in CACHE_DIR/traces
+TRACE_KEEP       = 20                             # number of trace files kept
+HISTORY_FILE     = 'ptrelease-history.sqlite'     # in CACHE_DIR
+
+# Traced stages of an arch pipeline in the order they run, see PhotivoBuilder.planned_stages()
+PIPELINE_STAGES = ['switchtc', 'qmake', 'make', 'ptupdata', 'ptpack', 'link data', 'ptuplibs', 'strip', 'manifest',
+                   'verify', 'ISCC', 'archive', 'delta']
+
 # =======================================================================
 
 def main(cli_params):
@@ -83,33 +134,210 @@ def main(cli_params):
         print_err('where "photivo.pro" is located.')
         return False
 
+    args, options = parse_cli(cli_params)
+    if args is None: return False
+
     # setup, config and pre-build checks
     if not load_ini_file(): return False
 
-    paths = build_paths(os.getcwd())
+    if '--plan' in options:
+        return plan_release(build_paths(os.getcwd()), args, options)
+
+    tracer = pttrace.Tracer()
+    success = False
+    try:
+        if option_value(options, '--batch') is not None:
+            success = run_batch(option_value(options, '--batch'), options, tracer)
+        else:
+            success = release(build_paths(os.getcwd()), args, options, tracer)
+        return success
+    finally:
+        save_trace(tracer)
+        save_history(tracer, options, success)
+
 
-    if not check_build_env(paths): return False
-    if not prepare_dirs(paths): return False
+# -----------------------------------------------------------------------
+def release(paths, args, options, tracer):
+    """
+    Builds a release of the working copy.
+    <return>  bool  True if everything succeeded
+    """
+    repo = pthg.RepoInfo(CMD[HG], paths[PTBASEDIR])
+    return build_release(paths, repo, select_archs(args), options, tracer)
 
-    archlist = Arch.archs
-    fullrelease = True
 
-    if len(cli_params) > 0:
-        if cli_params[0] == '32':
+# -----------------------------------------------------------------------
+def select_archs(args):
+    """
+    <return>  list  archs to build, from the optional "32" or "64" argument
+    """
+    if len(args) > 0:
+        if args[0] == '32':
             print_warn('Only building 32bit package!')
-            archlist = [Arch.win32]
-            fullrelease = False
-        elif cli_params[0] == '64':
+            return [Arch.win32]
+        elif args[0] == '64':
             print_warn('Only building 64bit package!')
-            archlist = [Arch.win64]
-            fullrelease = False
+            return [Arch.win64]
+
+    return Arch.archs
+
+
+# -----------------------------------------------------------------------
+def plan_release(paths, args, options):
+    """
+    Predicts from the timing history how long a release of the working copy
+    with these arguments takes. Nothing is built. Stages that never ran
+    before are not included in the prediction.
+    <return>  bool  True if a prediction was made
+    """
+    archlist = select_archs(args)
+    concurrent = '--concurrent' in options and len(archlist) > 1
+    shared = SharedState(options)
+
+    delta_bases = None
+    if '--delta' in options or option_value(options, '--delta') is not None:
+        delta_bases = find_delta_bases(release_store(), archlist, option_value(options, '--delta'))
+        if delta_bases is None: return False
+
+    repo = pthg.RepoInfo(CMD[HG], paths[PTBASEDIR])
+    builder = PhotivoBuilder(paths, repo,
+                             cache=shared.cache,
+                             parallel_builds=len(archlist) if concurrent else 1,
+                             portable=portable_format(options),
+                             delta_bases=delta_bases,
+                             toolchains=shared.toolchains,
+                             pack_data=PACK_DATA or '--pack-data' in options)
+
+    if concurrent:
+        archlist = builder.schedule(archlist, shared.history)
+    estimates = {arch: builder.estimate_pipeline(arch, shared.history, concurrent, concurrent or arch == archlist[0])
+                 for arch in archlist}
+    env_seconds, samples = shared.history.estimate('check_build_env', 'main', concurrent)
+
+    print('Release plan from the timing history in ' + os.path.join(CACHE_DIR, HISTORY_FILE))
+    print('%-20s'%'Stage' + ''.join('%12s'%ArchNames.names[arch] for arch in archlist))
+    print('%-20s%12s'%('check_build_env', pthistory.format_duration(env_seconds)))
+    for stage in PIPELINE_STAGES:
+        cells = [dict(estimates[arch]).get(stage, '') for arch in archlist]
+        if any(cell != '' for cell in cells):
+            print('%-20s'%stage + ''.join('%12s'%(pthistory.format_duration(cell) if cell != '' else '')
+                                          for cell in cells))
+
+    pipelines = [sum(seconds or 0 for stage, seconds in estimates[arch]) for arch in archlist]
+    print('%-20s'%'Pipeline' + ''.join('%12s'%pthistory.format_duration(seconds) for seconds in pipelines))
+
+    total = (env_seconds or 0) + (max(pipelines) if concurrent else sum(pipelines))
+    unknown = (env_seconds is None) + sum(seconds is None for arch in archlist for stage, seconds in estimates[arch])
+    print_ok('\nExpected time for the release: %s (%s)'%(pthistory.format_duration(total),
+             'concurrent' if concurrent else 'one arch after the other'))
+    if concurrent:
+        print('Start order: %s'%(', '.join(ArchNames.names[arch] for arch in archlist)))
+    if unknown > 0:
+        print_warn('%d stages never ran before and are not included.'%unknown)
+    print('Prompts and the cleanup are not included.')
+    return True
+
+
+# -----------------------------------------------------------------------
+class SharedState:
+    """
+    Everything the jobs of a batch run share: the artifact caches, the
+    toolchain environments and the timing history.
+    """
+    cache = None
+    strip_cache = None
+    toolchains = None
+    history = None
+
+    def __init__(self, options):
+        if not '--no-cache' in options:
+            # Both caches share one size limit.
+            strip_bytes = int((CACHE_MAXSIZE << 20) * STRIP_SHARE)
+            self.cache = ptcache.ArtifactCache(os.path.join(CACHE_DIR, 'artifacts'), (CACHE_MAXSIZE << 20) - strip_bytes)
+            self.strip_cache = ptcache.ArtifactCache(os.path.join(CACHE_DIR, 'stripped'), strip_bytes)
+        self.toolchains = pttoolchain.ToolchainCache(os.path.join(CACHE_DIR, 'toolchains'))
+        self.history = pthistory.TimingHistory(os.path.join(CACHE_DIR, HISTORY_FILE))
+
+    def save(self):
+        """
+        Writes the cache indexes, cache hits only update them in memory.
+        """
+        for cache in [self.cache, self.strip_cache]:
+            if cache is not None:
+                cache.save()
+
+
+# -----------------------------------------------------------------------
+def build_release(paths, repo, archlist, options, tracer, qmake_config=None, variant='', shared=None):
+    """
+    Runs all checks, builds and packages. Everything that takes time is
+    recorded as a span in tracer.
+    paths         list         as returned by build_paths()
+    repo          RepoInfo     or RevisionInfo, metadata of the sources in paths
+    archlist      list         archs to build
+    qmake_config  list         qmake CONFIG arguments, None for the default ones
+    variant       string       appended to the names of all created files
+    shared        SharedState  caches etc. shared with other builds, None for new ones
+    <return>      bool         True if everything succeeded
+    """
+    if shared is None:
+        shared = SharedState(options)
+    fullrelease = len(archlist) == len(Arch.archs)
+
+    resume = '--resume' in options
+    incremental = INCREMENTAL or '--incremental' in options or resume
+    checkpoints = ptcheckpoint.Checkpoints(os.path.join(paths[PKGBASEDIR], CHECKPOINT_FILE))
+    if not resume:
+        checkpoints.clear()
+
+    # Changelog.txt may be edited while the script runs, see check_build_env().
+    env_fingerprint = ptcache.make_key(repo.changeset(), repo.branch(), list(CMD.values()),
+                                       [entry for entry in repo.status() if not 'Changelog.txt' in entry])
+    if resume and checkpoints.is_done('env', env_fingerprint):
+        print_ok('Resuming: build environment unchanged, skipping checks.')
+    else:
+        with tracer.span('check_build_env'):
+            if not check_build_env(paths, repo): return False
+
+    if not prepare_dirs(paths, incremental, resume): return False
+    checkpoints.record('env', env_fingerprint)
 
     # build and package everything
-    builder = PhotivoBuilder(paths)
+    delta_bases = None
+    if '--delta' in options or option_value(options, '--delta') is not None:
+        delta_bases = find_delta_bases(release_store(), archlist, option_value(options, '--delta'))
+        if delta_bases is None: return False
+
+    concurrent = '--concurrent' in options and len(archlist) > 1
+    builder = PhotivoBuilder(paths, repo,
+                             cache=shared.cache,
+                             incremental=incremental,
+                             parallel_builds=len(archlist) if concurrent else 1,
+                             strip_cache=shared.strip_cache,
+                             checkpoints=checkpoints,
+                             resume=resume,
+                             tracer=tracer,
+                             portable=portable_format(options),
+                             delta_bases=delta_bases,
+                             qmake_config=qmake_config,
+                             variant=variant,
+                             toolchains=shared.toolchains,
+                             pack_data=PACK_DATA or '--pack-data' in options)
 
-    for arch in archlist:
-        if not builder.build(arch): return False
-        if not builder.package(arch): return False
+    try:
+        if concurrent:
+            # One pipeline per arch. Each pipeline builds and then packages its arch,
+            # so packaging of the faster arch overlaps the compile of the other one.
+            archlist = builder.schedule(archlist, shared.history)
+            print_warn('Building %s concurrently.'%(' and '.join(ArchNames.names[arch] for arch in archlist)))
+            with ThreadPoolExecutor(max_workers=len(archlist)) as pool:
+                results = list(pool.map(builder.run_pipeline, archlist))
+            if not all(results): return False
+        else:
+            for arch in archlist:
+                if not builder.run_pipeline(arch): return False
+    finally:
+        shared.save()
 
     # final summary and option to clean up
     if not builder.show_summary():
@@ -121,28 +349,286 @@ def main(cli_params):
         print('You can test and upload the release now.')
         print('\nAfterwards I can clean up automatically, i.e.:')
 
+        print('* archive the bin folders for later update packages')
         if ARCHIVE_DIR == '':
             print('* delete everything created during the build process.')
         else:
-            print('* move installers to', ARCHIVE_DIR)
+            print('* move installers, manifests, portable archives and update packages to', ARCHIVE_DIR)
             print('* delete everything else created during the build process')
 
-        if wait_for_yesno('\nShall I clean up now?'):
-            if not builder.cleanup(): return False
+        if wait_for_yesno('\nShall I clean up now?', 'cleanup'):
+            with tracer.span('cleanup'):
+                if not builder.cleanup(): return False
         else:
             print('OK. The mess stays.')
     else:
-        print_warn('Remember: Only the ' + Archnames.names[archlist[0]] + ' installer was built.')
+        print_warn('Remember: Only the ' + ArchNames.names[archlist[0]] + ' installer was built.')
 
     print_ok('All done.')
     return True
 
 
+# -----------------------------------------------------------------------
+def parse_cli(cli_params):
+    """
+    Separates --options from positional arguments.
+    cli_params  list    command line parameters without the script name
+    <return>    tuple   (positional args, set of options) or (None, None) on error
+    """
+    args = []
+    options = set()
+
+    for param in cli_params:
+        if not param.startswith('--'):
+            args.append(param)
+        elif '=' not in param and param in CLI_OPTIONS:
+            options.add(param)
+        elif param.partition('=')[0] + '=' in CLI_OPTIONS and param.partition('=')[2] != '':
+            # --name=value option
+            options.add(param)
+        else:
+            print_err('ERROR: Unknown option "%s".'%param)
+            return None, None
+
+    return args, options
+
+
+# -----------------------------------------------------------------------
+def portable_format(options):
+    """
+    <return>  string  format of the portable archives (see ptarchive.FORMATS), '' for none
+    """
+    if '--xz' in options: return 'xz'
+    if '--zip' in options: return 'zip'
+    return PORTABLE
+
+
+# -----------------------------------------------------------------------
+def option_value(options, name):
+    """
+    <return>  string  value of a --name=value option, None if not given
+    """
+    for option in options:
+        if option.startswith(name + '='):
+            return option[len(name) + 1:]
+    return None
+
+
+# -----------------------------------------------------------------------
+def release_store():
+    """
+    <return>  ReleaseStore  archived releases for delta packages, next to the
+                            archived installers or in the cache dir
+    """
+    return ptmanifest.ReleaseStore(os.path.join(ARCHIVE_DIR or CACHE_DIR, 'releases'))
+
+
+# -----------------------------------------------------------------------
+def find_delta_bases(store, archlist, release_date=None):
+    """
+    Finds the archived releases delta packages are made against.
+    release_date  string  date of the release, None for the newest one
+    <return>      list    release name per arch (None for archs not built), None on error
+    """
+    releases = store.releases()
+    bases = [None] * len(Arch.archs)
+
+    for arch in archlist:
+        suffix = '-' + ArchNames.names[arch]
+        candidates = [name for name in releases if name.endswith(suffix)
+                      and (release_date is None or name == release_date + suffix)]
+        if len(candidates) == 0:
+            print_err('ERROR: No archived %s release%s for the delta package.'%(
+                      ArchNames.names[arch], '' if release_date is None else ' from ' + release_date))
+            print_err('Archived releases: ' + (', '.join(releases) or 'none'))
+            return None
+        bases[arch] = candidates[-1]
+
+    return bases
+
+
+# -----------------------------------------------------------------------
+def load_batch_file(path):
+    """
+    Reads a batch job file and sets PROMPT_ANSWERS from its prompt policies.
+    Prompts without a policy are answered with abort/no.
+    <return>  list  one dict per job (name, rev, archs, config, variant), None on error
+    """
+    config = configparser.ConfigParser(inline_comment_prefixes=('#', ';'))
+    try:
+        if len(config.read(path)) == 0:
+            raise OSError('File not found.')
+        batch = config['batch']
+    except (OSError, KeyError, configparser.Error) as err:
+        print_err('ERROR: Could not read batch job file "%s". It needs a [batch] section.'%path)
+        print_err(str(err))
+        return None
+
+    revisions = batch.get('revisions', '.').split()
+    archlist = []
+    for archname in batch.get('archs', '32 64').split():
+        if archname in ArchNames.bits:
+            archlist.append(ArchNames.bits.index(archname))
+        elif archname in ArchNames.names:
+            archlist.append(ArchNames.names.index(archname))
+        else:
+            print_err('ERROR: Unknown arch "%s" in "%s". Use 32, 64, win32 or win64.'%(archname, path))
+            return None
+
+    configs = []
+    for name in batch.get('configs', '').split():
+        section = 'config ' + name
+        if not section in config or not 'qmake' in config[section]:
+            print_err('ERROR: Section [%s] with entry "qmake" missing in "%s".'%(section, path))
+            return None
+        configs.append([name, config[section]['qmake'].split()])
+    if len(configs) == 0:
+        configs = [['', None]]
+
+    PROMPT_ANSWERS.clear()
+    for prompt, policies in PROMPTS.items():
+        policy = config.get('prompts', prompt, fallback='abort' if 'abort' in policies else 'no').strip().lower()
+        if not policy in policies:
+            print_err('ERROR: Entry "%s" in section [prompts] must be %s.'%(prompt, ' or '.join(sorted(policies))))
+            return None
+        PROMPT_ANSWERS[prompt] = policies[policy]
+
+    def safe_name(rev):
+        return 'wc' if rev == '.' else re.sub(r'[^\w.-]', '_', rev)
+
+    jobs = []
+    for rev in revisions:
+        for config_name, qmake_config in configs:
+            parts = []
+            if len(revisions) > 1:
+                parts.append(safe_name(rev))
+            if config_name != '':
+                parts.append(safe_name(config_name))
+            variant = '-'.join(parts)
+            jobs.append({
+                'name':    variant or safe_name(rev),
+                'rev':     rev,
+                'archs':   sorted(set(archlist)),
+                'config':  qmake_config,
+                'variant': variant
+            })
+
+    return jobs
+
+
+# -----------------------------------------------------------------------
+def run_batch(job_file, options, tracer):
+    """
+    Runs every job of a batch job file, one after the other. A failed job
+    does not stop the batch. All jobs share one repository connection, the
+    artifact caches and the toolchain environments.
+    <return>  bool  True if all jobs succeeded
+    """
+    if '--delta' in options or option_value(options, '--delta') is not None:
+        print_err('ERROR: Update packages (--delta) are not supported in batch mode.')
+        return False
+
+    jobs = load_batch_file(job_file)
+    if jobs is None:
+        return False
+
+    repo_dir = os.getcwd()
+    repo = pthg.RepoInfo(CMD[HG], repo_dir)
+    shared = SharedState(options)
+    batch_dir = os.path.join(repo_dir, BATCH_DIR)
+    results = []
+
+    for index, job in enumerate(jobs):
+        print(DIVIDER)
+        print_ok('Job %d of %d: %s (revision %s, %s)'%(index + 1, len(jobs), job['name'], job['rev'],
+                 ' '.join(job['config']) if job['config'] is not None else 'default CONFIG'))
+        start = time.perf_counter()
+        with tracer.span('job ' + job['name']):
+            result = run_job(job, repo, repo_dir, batch_dir, options, tracer, shared)
+        results.append([job['name'], result, time.perf_counter() - start])
+        os.chdir(repo_dir)   # cleanup leaves us in the job's source dir
+
+    print(DIVIDER)
+    print('Batch summary:')
+    for name, result, seconds in results:
+        line = '  %-7s %4d:%02d  %s'%('ok' if result else 'FAILED', seconds // 60, seconds % 60, name)
+        if result:
+            print(line)
+        else:
+            print_err(line)
+
+    return all(result for name, result, seconds in results)
+
+
+# -----------------------------------------------------------------------
+def run_job(job, repo, repo_dir, batch_dir, options, tracer, shared):
+    """
+    Builds one job of a batch. Revision "." is the working copy as it is,
+    every other revision is exported to its own source dir first.
+    <return>  bool  True if the job succeeded
+    """
+    try:
+        if job['rev'] == '.':
+            jobrepo = repo
+            srcdir = repo_dir
+        else:
+            jobrepo = pthg.RevisionInfo(repo, job['rev'])
+            with tracer.span('hg archive'):
+                srcdir = export_revision(jobrepo, repo_dir, batch_dir)
+            if srcdir is None:
+                return False
+
+        paths = build_paths(srcdir, os.path.join(batch_dir, job['name']))
+        # Changelog.txt is kept next to the repository, not in it.
+        paths[CHLOGFILE] = build_paths(repo_dir)[CHLOGFILE]
+        return build_release(paths, jobrepo, job['archs'], options, tracer,
+                             qmake_config=job['config'], variant=job['variant'], shared=shared)
+    except subprocess.CalledProcessError as err:
+        print_err('ERROR: Mercurial query failed for revision "%s".'%job['rev'])
+        print_err(str(err))
+        if err.stderr:
+            print_err(err.stderr.strip())
+        return False
+
+
+# -----------------------------------------------------------------------
+def export_revision(repo, repo_dir, batch_dir):
+    """
+    Exports the sources of a revision with "hg archive". Jobs and later
+    runs for the same changeset reuse the export.
+    repo      RevisionInfo  the revision
+    repo_dir  string        the Photivo repository
+    batch_dir string        the export goes to a subdir
+    <return>  string        source dir, None on error
+    """
+    srcdir = os.path.join(batch_dir, 'src-' + repo.changeset())
+    if os.path.isfile(os.path.join(srcdir, 'photivo.pro')):
+        print_ok('Using exported sources of changeset %s.'%repo.changeset())
+        return srcdir
+
+    print_ok('Exporting changeset %s ...'%repo.changeset())
+    try:
+        # Export under a temporary name, so an aborted export is never reused.
+        if os.path.exists(srcdir + '.tmp'):
+            shutil.rmtree(srcdir + '.tmp')
+        os.makedirs(batch_dir, exist_ok=True)
+        if not run_cmd([CMD[HG], 'archive', '-r', repo.changeset(), srcdir + '.tmp'], cwd=repo_dir):
+            print_err('ERROR: Exporting changeset %s failed.'%repo.changeset())
+            return None
+        os.replace(srcdir + '.tmp', srcdir)
+    except OSError as err:
+        print_err('ERROR: Exporting changeset %s failed.'%repo.changeset())
+        print_err(str(err))
+        return None
+
+    return srcdir
+
+
 # -----------------------------------------------------------------------
 # Returns a nested list of all needed dir and file paths
-def build_paths(repo_dir):
+def build_paths(repo_dir, base_dir=None):
     repo_dir = os.path.abspath(repo_dir)
-    base_dir = os.path.join(repo_dir, 'build-for-release')
+    base_dir = os.path.abspath(base_dir or os.path.join(repo_dir, 'build-for-release'))
 
     return [
         repo_dir,                           # PTBASEDIR
@@ -161,70 +647,50 @@ def build_paths(repo_dir):
         os.path.join(repo_dir, 'COPYING'),                # LICFILE
         os.path.join(repo_dir, 'COPYING.3rd.party'),      # LIC3FILE
         os.path.join(SCRIPT_DIR, 'hg-shortdate.style'),   # DATESTYFILE
-        os.path.join(SCRIPT_DIR, 'hg-revdatenum.style')   # VERSTYFILE
+        os.path.join(SCRIPT_DIR, 'hg-revdatenum.style'),  # VERSTYFILE
+        os.path.join(base_dir, 'data-common')             # COMMONDIR
     ]
 
 
 # -----------------------------------------------------------------------
-def check_build_env(paths):
-    # Force English output from Mercurial
-    os.environ['HGPLAIN'] = 'true'
-
+def check_build_env(paths, repo):
     # Check presence of required commands
-    cmds_ok = True
-    for cmd in CMD:
-        cmds_ok = check_bin([CMD[cmd]] + CMD_PARAMS_FOR_TEST[cmd]) and cmds_ok
-    if not cmds_ok: return False
+    if not check_bins([[CMD[cmd]] + CMD_PARAMS_FOR_TEST[cmd] for cmd in CMD]):
+        return False
 
-    hgbranch = get_cmd_output([CMD[HG], 'branch'])
+    hgbranch = repo.branch()
     if hgbranch != 'default':
         print_warn('Working copy is set to branch "%s" instead of "default".'%(hgbranch))
-        if not wait_for_yesno('Continue anyway?'):
+        if not wait_for_yesno('Continue anyway?', 'branch'):
             return False
 
     # Working copy should be clean. The only exception is the Changelog.txt file.
     # Ignoring that makes it possible to start the release script and edit the
     # changelos while it is running.
-    if not 'commit: (clean)' in get_cmd_output([CMD[HG], 'summary']):
-        hgstatus = get_cmd_output([CMD[HG], 'status']).split('\n')
-        for file_entry in hgstatus:
-            if (len(file_entry) > 0) and (not 'Changelog.txt' in file_entry):
-                print_warn('Working copy has uncommitted changes.')
-                if wait_for_yesno('Continue anyway?'):
-                    break
-                else:
-                    return False
-
-    files_ok = True
+    for file_entry in repo.status():
+        if not 'Changelog.txt' in file_entry:
+            print_warn('Working copy has uncommitted changes.')
+            if wait_for_yesno('Continue anyway?', 'dirty'):
+                break
+            else:
+                return False
 
     # files must be present
-    if not os.path.isfile(paths[ISSFILE][Arch.win32]):
-        print_err('ERROR: Installer script "%s" missing.'%paths[ISSFILE][Arch.win32])
-        files_ok = False
-
-    if not os.path.isfile(paths[ISSFILE][Arch.win64]):
-        print_err('ERROR: Installer script "%s" missing.'%paths[ISSFILE][Arch.win64])
-        files_ok = False
-
-    if not os.path.isfile(paths[CHLOGFILE]):
-        print_err('ERROR: File "%s" missing.'%paths[CHLOGFILE])
-        files_ok = False
-
-    if not os.path.isfile(paths[LICFILE]):
-        print_err('ERROR: File "%s" missing.'%paths[LICFILE])
-        files_ok = False
-
-    if not os.path.isfile(paths[LIC3FILE]):
-        print_err('ERROR: File "%s" missing.'%paths[LIC3FILE])
-        files_ok = False
-
-    if not os.path.isfile(paths[DATESTYFILE]):
-        print_err('ERROR: Style file "%s" missing.'%paths[DATESTYFILE])
-        files_ok = False
+    files_ok = True
+    required_files = [
+        [paths[ISSFILE][Arch.win32], 'Installer script'],
+        [paths[ISSFILE][Arch.win64], 'Installer script'],
+        [paths[CHLOGFILE],           'File'],
+        [paths[LICFILE],             'File'],
+        [paths[LIC3FILE],            'File'],
+        [paths[DATESTYFILE],         'Style file'],
+        [paths[VERSTYFILE],          'Style file']
+    ]
 
-    if not os.path.isfile(paths[VERSTYFILE]):
-        print_err('ERROR: Style file "%s" missing.'%paths[VERSTYFILE])
-        files_ok = False
+    for filepath, description in required_files:
+        if not os.path.isfile(filepath):
+            print_err('ERROR: %s "%s" missing.'%(description, filepath))
+            files_ok = False
 
     return files_ok
 
@@ -255,6 +721,15 @@ def load_ini_file():
 
     global CMD
     global ARCHIVE_DIR
+    global CACHE_DIR
+    global CACHE_MAXSIZE
+    global INCREMENTAL
+    global MAKE_JOBS
+    global MAKE_THROTTLE
+    global MEM_PER_JOB
+    global RESOLVE_DLLS
+    global PORTABLE
+    global PACK_DATA
 
     if 'commands' in config:
         if QMAKE in config['commands']: CMD[QMAKE] = config['commands']['qmake']
@@ -264,20 +739,63 @@ def load_ini_file():
         if STRIP in config['commands']: CMD[STRIP] = config['commands']['strip']
 
     if 'archive' in config['paths']: ARCHIVE_DIR = config['paths']['archive']
+    if 'cache' in config['paths']: CACHE_DIR = config['paths']['cache']
+
+    if 'cache' in config:
+        try:
+            CACHE_MAXSIZE = config['cache'].getint('maxsize', CACHE_MAXSIZE)
+        except ValueError:
+            print_err('ERROR: Entry "maxsize" in section [cache] must be a number (MB).')
+            return False
+
+    if 'build' in config:
+        try:
+            INCREMENTAL = config['build'].getboolean('incremental', INCREMENTAL)
+            MAKE_THROTTLE = config['build'].getboolean('throttle', MAKE_THROTTLE)
+            RESOLVE_DLLS = config['build'].getboolean('resolve_dlls', RESOLVE_DLLS)
+            PACK_DATA = config['build'].getboolean('pack_data', PACK_DATA)
+        except ValueError:
+            print_err('ERROR: Entries "incremental", "throttle", "resolve_dlls" and "pack_data" in section [build]'
+                      ' must be yes or no.')
+            return False
+        PORTABLE = config['build'].get('portable', PORTABLE).strip().lower()
+        if PORTABLE == 'no':
+            PORTABLE = ''
+        if PORTABLE != '' and not PORTABLE in ptarchive.FORMATS:
+            print_err('ERROR: Entry "portable" in section [build] must be %s or no.'%' or '.join(sorted(ptarchive.FORMATS)))
+            return False
+        try:
+            MAKE_JOBS = config['build'].getint('jobs', MAKE_JOBS)
+            MEM_PER_JOB = config['build'].getint('mem_per_job', MEM_PER_JOB)
+        except ValueError:
+            print_err('ERROR: Entries "jobs" and "mem_per_job" in section [build] must be numbers.')
+            return False
 
     return True
 
 
 # -----------------------------------------------------------------------
-def prepare_dirs(paths):
+def prepare_dirs(paths, incremental=False, resume=False):
+    """
+    Sets up the build directory tree.
+    incremental  bool  keep the build dirs and only reset the bin dirs.
+                       PhotivoBuilder decides if a build dir needs a clean rebuild.
+    resume       bool  keep everything, the checkpoints decide what is redone
+    """
     try:
-        if os.path.exists(paths[PKGBASEDIR]):
+        if resume:
+            pass
+        elif incremental:
+            for bindir in paths[BINDIR]:
+                if os.path.exists(bindir):
+                    shutil.rmtree(bindir)
+        elif os.path.exists(paths[PKGBASEDIR]):
             shutil.rmtree(paths[PKGBASEDIR])
 
-        os.makedirs(paths[BUILDDIR][Arch.win32])
-        os.makedirs(paths[BUILDDIR][Arch.win64])
-        os.makedirs(paths[BINDIR][Arch.win32])
-        os.makedirs(paths[BINDIR][Arch.win64])
+        os.makedirs(paths[BUILDDIR][Arch.win32], exist_ok=True)
+        os.makedirs(paths[BUILDDIR][Arch.win64], exist_ok=True)
+        os.makedirs(paths[BINDIR][Arch.win32], exist_ok=True)
+        os.makedirs(paths[BINDIR][Arch.win64], exist_ok=True)
 
         return True
 
@@ -288,26 +806,174 @@ def prepare_dirs(paths):
 
 
 # -----------------------------------------------------------------------
-def check_bin(exec_cmd):
+def check_bins(exec_cmds):
     """
-    Tests if a command is present.
-    exec_cmd   list    command that should be tested
-    <return>   bool    true if command can be executed
+    Tests if commands are present and prints their versions. All commands are
+    probed at the same time. Results are cached in TOOL_PROBE_FILE keyed on the
+    resolved path and mtime of each binary, so unchanged tools are not started again.
+    exec_cmds  list    commands that should be tested
+    <return>   bool    true if all commands can be executed
     """
-    with open(os.devnull, 'w') as devnull:
-        try:
-            subprocess.call(exec_cmd, stdout=devnull, stderr=devnull)
-            return True
-        except OSError:
+    cache_path = os.path.join(CACHE_DIR, TOOL_PROBE_FILE)
+    try:
+        with open(cache_path) as cachefile:
+            probe_cache = json.load(cachefile)
+    except (OSError, ValueError):
+        probe_cache = {}
+
+    with ThreadPoolExecutor(max_workers=len(exec_cmds)) as pool:
+        probes = list(pool.map(lambda exec_cmd: check_bin(exec_cmd, probe_cache), exec_cmds))
+
+    all_ok = True
+    for exec_cmd, probe in zip(exec_cmds, probes):
+        if probe is None:
             print_err('ERROR: Required command not found: ' + exec_cmd[0])
-            return False
+            all_ok = False
+        else:
+            probe_cache[probe['key']] = probe
+            print('%-8s %-40s %s'%(os.path.basename(exec_cmd[0]), probe['version'][:40],
+                                   'cached' if probe['cached'] else '%.2fs'%probe['seconds']))
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(cache_path, 'w') as cachefile:
+            json.dump(probe_cache, cachefile, indent=1)
+    except OSError as err:
+        print_warn('WARNING: Could not write tool cache "%s".'%cache_path)
+        print_warn(str(err))
+
+    return all_ok
+
+
+# -----------------------------------------------------------------------
+def check_bin(exec_cmd, probe_cache=None):
+    """
+    Tests if a command is present.
+    exec_cmd     list    command that should be tested
+    probe_cache  dict    earlier results of check_bin(), not modified
+    <return>     dict    key, path, mtime, version (first line of output), seconds
+                         the probe took and whether the result was cached.
+                         None if the command cannot be executed.
+    """
+    path = shutil.which(exec_cmd[0])
+    if path is None:
+        return None
+
+    path = os.path.normcase(os.path.abspath(path))
+    key = '\x1f'.join([path] + exec_cmd[1:])
+    mtime = os.path.getmtime(path)
+
+    cached = probe_cache.get(key) if probe_cache is not None else None
+    if cached is not None and cached.get('mtime') == mtime:
+        result = dict(cached)
+        result['cached'] = True
+        return result
+
+    start = time.perf_counter()
+    try:
+        output = subprocess.run([path] + exec_cmd[1:], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, universal_newlines=True, errors='replace').stdout
+    except OSError:
+        return None
+
+    version = ''
+    for line in output.split('\n'):
+        if line.strip() != '':
+            version = line.strip()
+            break
+
+    return {
+        'key': key,
+        'path': path,
+        'mtime': mtime,
+        'version': version,
+        'seconds': time.perf_counter() - start,
+        'cached': False
+    }
+
+
+# -----------------------------------------------------------------------
+def make_job_args(parallel_builds=1, share=None):
+    """
+    Returns the job related arguments for make.
+    parallel_builds  int    number of makes running at the same time, they share the cores
+    share            float  part of the cores for this make, None for an equal share
+    <return>         list   e.g. ['-j4']
+    """
+    if share is None:
+        share = 1 / parallel_builds
+    cores = multiprocessing.cpu_count()
+
+    try:
+        jobs = int(os.environ['JobsForMake'])
+    except (KeyError, ValueError):
+        jobs = MAKE_JOBS if MAKE_JOBS > 0 else cores
+
+    jobs = max(1, int(jobs * share))
+    args = []
+
+    if MAKE_THROTTLE:
+        # Every compiler process needs up to MEM_PER_JOB of RAM. Starting more
+        # than fit into the free memory only makes the machine swap.
+        avail_mem = get_available_memory()
+        if avail_mem is not None:
+            jobs = max(1, min(jobs, int((avail_mem >> 20) // MEM_PER_JOB * share)))
+
+        # make only knows the load average where the OS provides it (not on Windows).
+        if hasattr(os, 'getloadavg'):
+            args.append('--load-average=%d'%cores)
+
+    return ['-j%d'%jobs] + args
+
+
+# -----------------------------------------------------------------------
+def get_available_memory():
+    """
+    <return>  int  available physical memory in bytes, None if unknown
+    """
+    if sys.platform == 'win32':
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong),
+                        ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong),
+                        ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong),
+                        ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong),
+                        ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
 
 
 # -----------------------------------------------------------------------
-def wait_for_yesno(msg):
+def wait_for_yesno(msg, prompt=None):
+    """
+    prompt  string  name of the prompt (see PROMPTS), answered from PROMPT_ANSWERS if present there
+    """
     print(msg, end=' (y/n) ')
     sys.stdout.flush()
 
+    if prompt in PROMPT_ANSWERS:
+        print(('Yes' if PROMPT_ANSWERS[prompt] == 'y' else 'No') + ' (batch policy)')
+        return PROMPT_ANSWERS[prompt] == 'y'
+
+    import msvcrt   # Windows only, not needed for unattended runs
     while True:
         char = msvcrt.getch()
 
@@ -328,10 +994,18 @@ def wait_for_yesno(msg):
 
 
 # -----------------------------------------------------------------------
-def wait_for_key(msg, keys):
+def wait_for_key(msg, keys, prompt=None):
+    """
+    prompt  string  name of the prompt (see PROMPTS), answered from PROMPT_ANSWERS if present there
+    """
     print(msg, end=' ')
     sys.stdout.flush()
 
+    if prompt in PROMPT_ANSWERS:
+        print(PROMPT_ANSWERS[prompt] + ' (batch policy)')
+        return PROMPT_ANSWERS[prompt]
+
+    import msvcrt   # Windows only, not needed for unattended runs
     while True:
         char = msvcrt.getch()
 
@@ -349,13 +1023,55 @@ def wait_for_key(msg, keys):
 
 
 # -----------------------------------------------------------------------
-def get_cmd_output(cmd, use_shell=False, env=None):
-    return subprocess.check_output(cmd, shell=use_shell, env=env, universal_newlines=True).strip()
+def run_cmd(cmd, use_shell=False, env=None, cwd=None, log_file=None, prefix=None, progress=None, stdin_data=None):
+    """
+    Runs a command with streamed output, see ptrun.run_async() for the parameters.
+    On failure the last output lines are shown again, because in concurrent
+    builds they may be far up between the output of the other arch.
+    <return>  bool  True if the command succeeded
+    """
+    result = ptrun.run(cmd, shell=use_shell, env=env, cwd=cwd, log_file=log_file, prefix=prefix,
+                       progress=progress, stdin_data=stdin_data)
+    if result.returncode != 0:
+        result.print_tail()
+    return result.returncode == 0
+
+
+# -----------------------------------------------------------------------
+def save_trace(tracer):
+    """
+    Writes the trace of this run to the cache dir and removes the oldest
+    trace files beyond TRACE_KEEP.
+    """
+    tracedir = os.path.join(CACHE_DIR, 'traces')
+    tracefile = os.path.join(tracedir, TRACE_PATTERN%time.strftime('%Y%m%d-%H%M%S'))
+    if not tracer.save(tracefile):
+        return
+
+    print('Trace of this run:', tracefile)
+    for oldfile in sorted(glob.glob(os.path.join(tracedir, TRACE_PATTERN%'*')))[:-TRACE_KEEP]:
+        try:
+            os.remove(oldfile)
+        except OSError:
+            pass
 
 
 # -----------------------------------------------------------------------
-def run_cmd(cmd, use_shell=False, env=None):
-    return subprocess.call(cmd, shell=use_shell, env=env) == 0
+def save_history(tracer, options, success):
+    """
+    Warns about stages that took much longer than in earlier runs and adds
+    this run to the timing history.
+    """
+    history = pthistory.TimingHistory(os.path.join(CACHE_DIR, HISTORY_FILE))
+    events = tracer.events()
+    concurrent = '--concurrent' in options
+
+    for track, stage, seconds, median in history.slow_stages(events, concurrent):
+        print_warn('WARNING: %s (%s) took %s, usually it takes %s.'%(stage, track, pthistory.format_duration(seconds),
+                                                                     pthistory.format_duration(median)))
+
+    history.record(events, 'batch' if option_value(options, '--batch') is not None else 'release',
+                   concurrent, success)
 
 
 # -----------------------------------------------------------------------
@@ -370,24 +1086,198 @@ def print_file_status(filepath):
 # -----------------------------------------------------------------------
 class PhotivoBuilder:
     _install_files = None
+    _portable_files = None   # per arch, None when no portable archive is built
+    _manifest_files = None
+    _archive_stats = None
+    _delta_bases = None      # per arch, archived release the delta package is made against
+    _delta_files = None
+    _delta_stats = None
     _paths = None
     _hgbranch = None
     _release_date = None
-    _env = os.environ
+    _repo = None
+    _changeset = None
+    _cache = None
+    _strip_cache = None
+    _cache_stats = None     # stats() of the caches when the builder was created
+    _incremental = False
+    _parallel_builds = 1
+    _checkpoints = None
+    _resume = False
+    _fingerprints = None     # per arch, fingerprint of the last stage
+    _env = None              # one read-only environment per arch, filled by _change_tc_arch()
+    _prompt_lock = None      # serializes user prompts between concurrent pipelines
+    _stage_lock = None
+    _common_staged = None    # None: not yet, True/False: result of _stage_common_data()
+    _tracer = None
+    _portable = ''
+    _qmake_config = None
+    _release_tag = None      # release date and variant, part of all file names
+    _toolchains = None
+    _make_shares = None      # per arch, part of the cores for make, None for an equal share
+    _pack_data = False
 
     _INST_NAME_PATTERN = 'photivo-setup-%s-%s'
+    _PORTABLE_NAME_PATTERN = 'photivo-portable-%s-%s'
+    _DELTA_NAME_PATTERN = 'photivo-update-%s-to-%s-%s.zip'   # base release name includes the arch
+    _MANIFEST_NAME_PATTERN = 'photivo-%s-%s.manifest.json'
+    _QMAKE_CONFIG = ['CONFIG+=WithoutGimp', 'CONFIG-=debug']
     _INSTALLERS = 0
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-    def __init__(self, paths):
+    def __init__(self, paths, repo, cache=None, incremental=False, parallel_builds=1, strip_cache=None,
+                 checkpoints=None, resume=False, tracer=None, portable='', delta_bases=None,
+                 qmake_config=None, variant='', toolchains=None, pack_data=False):
+        """
+        paths            list           as returned by build_paths()
+        repo             RepoInfo       metadata of the Photivo repository
+        cache            ArtifactCache  cache for finished binaries, None disables caching
+        incremental      bool           reuse object files in the build dirs when possible
+        parallel_builds  int            number of archs built at the same time
+        strip_cache      ArtifactCache  cache for stripped DLLs, None disables caching
+        checkpoints      Checkpoints    completed stages are recorded here
+        resume           bool           skip stages recorded in checkpoints with unchanged inputs
+        tracer           Tracer         records timing and resource usage of all stages
+        portable         string         also create a portable archive in this format (see ptarchive.FORMATS)
+        delta_bases      list           per arch the archived release to make a delta package against,
+                                        None for no delta packages
+        qmake_config     list           qmake CONFIG arguments, None for the default ones
+        variant          string         appended to the release date in all file names
+        toolchains       ToolchainCache saved toolchain environments, None for the default cache dir
+        pack_data        bool           ship the data dirs marked in ptupdata.DIR_LIST as one pack each
+        """
         self._paths = paths
-        self._hgbranch = get_cmd_output([CMD[HG], 'branch'])
-        self._release_date = get_cmd_output([CMD[HG], 'log', '-b', self._hgbranch, '-l', '1', \
-                                            '--style', self._paths[DATESTYFILE]])
+        self._repo = repo
+        self._cache = cache
+        self._strip_cache = strip_cache
+        self._cache_stats = {cache: cache.stats() for cache in [cache, strip_cache] if cache is not None}
+        self._incremental = incremental
+        self._parallel_builds = parallel_builds
+        self._checkpoints = checkpoints
+        self._resume = resume
+        self._tracer = tracer or pttrace.Tracer()
+        self._fingerprints = [''] * len(Arch.archs)
+        self._env = [None] * len(Arch.archs)
+        self._prompt_lock = threading.Lock()
+        self._stage_lock = threading.Lock()
+        self._hgbranch = repo.branch()
+        self._changeset = repo.changeset()
+        self._release_date = repo.branch_log(self._paths[DATESTYFILE])
+        self._release_tag = self._release_date + ('-' + variant if variant != '' else '')
+        self._qmake_config = qmake_config if qmake_config is not None else self._QMAKE_CONFIG
+        self._toolchains = toolchains or pttoolchain.ToolchainCache(os.path.join(CACHE_DIR, 'toolchains'))
+        self._make_shares = [None] * len(Arch.archs)
+        self._pack_data = pack_data
         self._install_files = [
-            os.path.join(self._paths[PKGBASEDIR], self._INST_NAME_PATTERN%(self._release_date, ArchNames.win32) + '.exe'),
-            os.path.join(self._paths[PKGBASEDIR], self._INST_NAME_PATTERN%(self._release_date, ArchNames.win64) + '.exe')
+            os.path.join(self._paths[PKGBASEDIR], self._INST_NAME_PATTERN%(self._release_tag, ArchNames.win32) + '.exe'),
+            os.path.join(self._paths[PKGBASEDIR], self._INST_NAME_PATTERN%(self._release_tag, ArchNames.win64) + '.exe')
+        ]
+        self._manifest_files = [
+            os.path.join(self._paths[PKGBASEDIR], self._MANIFEST_NAME_PATTERN%(self._release_tag, archname))
+            for archname in ArchNames.names
         ]
+        self._portable_files = [None] * len(Arch.archs)
+        self._archive_stats = [None] * len(Arch.archs)
+        if portable != '':
+            self._portable_files = [
+                os.path.join(self._paths[PKGBASEDIR], ptarchive.archive_name(
+                             self._PORTABLE_NAME_PATTERN%(self._release_tag, archname), portable))
+                for archname in ArchNames.names
+            ]
+        self._portable = portable
+        self._delta_bases = delta_bases or [None] * len(Arch.archs)
+        self._delta_stats = [None] * len(Arch.archs)
+        self._delta_files = [
+            None if base is None else
+            os.path.join(self._paths[PKGBASEDIR], self._DELTA_NAME_PATTERN%(base, self._release_tag, archname))
+            for base, archname in zip(self._delta_bases, ArchNames.names)
+        ]
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def run_pipeline(self, arch):
+        """
+        Builds and packages one architecture. Pipelines for different archs
+        do not share any state and may run concurrently.
+        <return>  bool  True if the installer was successfully created, False otherwise
+        """
+        with self._span('build', arch):
+            if not self.build(arch): return False
+        with self._span('package', arch):
+            return self.package(arch)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def schedule(self, archlist, history):
+        """
+        Prepares concurrent pipelines with the timing history. The arch with
+        the longest expected remaining stage time starts first. Every pipeline
+        has its own thread, so the others follow right away; the order only
+        decides whose stages are ahead when both reach a shared stage, e.g.
+        the common data. What balances the pipelines is the split of the cores
+        between the makes by their expected compile work, so both finish at
+        about the same time instead of the bigger one finishing alone on half
+        the cores. The work of a make is its wall time in runs one arch after
+        the other, where it had all cores to itself. Without such runs for
+        every arch it is the CPU time of the make in concurrent runs. Without
+        history nothing changes.
+        archlist  list            archs that are built concurrently
+        history   TimingHistory
+        <return>  list            archs in the order to start them
+        """
+        remaining = {arch: sum(seconds or 0 for stage, seconds in self.estimate_pipeline(arch, history, True, False))
+                     for arch in archlist}
+        ordered = sorted(archlist, key=lambda arch: remaining[arch], reverse=True)
+
+        if not all('make' in self.planned_stages(arch, False) for arch in archlist):
+            return ordered      # a cached build has nothing to compile
+
+        for concurrent, column in [(False, 'wall_s'), (True, 'child_cpu_s')]:
+            work = {arch: history.estimate('make', ArchNames.names[arch], concurrent, column, fallback=False)[0]
+                    for arch in archlist}
+            if all(work.values()):
+                break
+        else:
+            return ordered
+
+        for arch in archlist:
+            # Never starve a make completely, the estimate may be off.
+            self._make_shares[arch] = min(0.75, max(0.25, work[arch] / sum(work.values())))
+        print_ok('Make jobs from the timing history: %s.'%(', '.join(
+                 '%s %d%%'%(ArchNames.names[arch], 100 * self._make_shares[arch]) for arch in ordered)))
+        return ordered
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def planned_stages(self, arch, with_common):
+        """
+        Traced stages the pipeline of an arch is going to run, as far as it
+        is known before it starts (see PIPELINE_STAGES).
+        with_common  bool  the pipeline stages the common data (ptupdata)
+        <return>     list  stage names
+        """
+        stages = ['switchtc']
+        cache_key = self._artifact_key(arch)
+        if cache_key is None or not self._cache.contains(cache_key):
+            stages += ['qmake', 'make']
+        if with_common:
+            stages.append('ptupdata')
+            if self._pack_data:
+                stages.append('ptpack')
+        stages += ['link data', 'ptuplibs', 'strip', 'manifest', 'verify', 'ISCC']
+        if self._portable != '':
+            stages.append('archive')
+        if self._delta_bases[arch] is not None:
+            stages.append('delta')
+        return stages
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def estimate_pipeline(self, arch, history, concurrent, with_common):
+        """
+        history      TimingHistory
+        concurrent   bool           the archs are built concurrently
+        with_common  bool           see planned_stages()
+        <return>     list           (stage, expected seconds or None without history)
+        """
+        return [(stage, history.estimate(stage, ArchNames.names[arch], concurrent)[0])
+                for stage in self.planned_stages(arch, with_common)]
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     def build(self, arch):
@@ -396,25 +1286,52 @@ class PhotivoBuilder:
         arch            can be either Arch.win32 or Arch.win64
         <return>  bool  True if build succeeded, False otherwise
         """
-        if not self._change_tc_arch(ArchNames.bits[arch]):
+        if not self._switch_toolchain(arch):
             return False
-        
-        try:
-            os.chdir(self._paths[BUILDDIR][arch])
-        except OSError as err:
-            print_err('ERROR: Changing directory to "%s" failed.'%self._paths[PKGBASEDIR])
-            print_err(str(err))
+
+        binaries = [os.path.join(self._paths[BINDIR][arch], 'photivo.exe'),
+                    os.path.join(self._paths[BINDIR][arch], 'ptClear.exe')]
+        fingerprint = self._next_fingerprint(arch, self._changeset, self._qmake_config,
+                                             self._env[arch].get('tcpath', ''))
+        if self._is_done('build', arch, fingerprint, binaries):
+            return True
+        if not self._compile(arch):
+            return False
+        self._record('build', arch, fingerprint)
+        return True
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _compile(self, arch):
+        """
+        Runs qmake and make (or restores the binaries from the artifact cache)
+        and copies photivo.exe and ptClear.exe to the bin dir.
+        """
+        if not os.path.isdir(self._paths[BUILDDIR][arch]):
+            print_err('ERROR: Build directory "%s" missing.'%self._paths[BUILDDIR][arch])
+            return False
+
+        cache_key = self._artifact_key(arch)
+        if cache_key is not None and self._cache.restore(cache_key, self._paths[BINDIR][arch]):
+            print_ok('Using cached Photivo and ptClear binaries (%s).'%ArchNames.names[arch])
+            return True
+
+        if not self._prepare_build_dir(arch):
             return False
 
         print_ok('Building Photivo and ptClear (%s) ...'%ArchNames.names[arch])
 
         # Build production Photivo
-        build_result = run_cmd([CMD[QMAKE], \
-                               os.path.join('..', '..', 'photivo.pro'), \
-                               'CONFIG+=WithoutGimp', \
-                               'CONFIG-=debug'],
-                               env=self._env) \
-                       and run_cmd([CMD[MAKE]], env=self._env)
+        with self._span('qmake', arch):
+            build_result = run_cmd([CMD[QMAKE], os.path.join(self._paths[PTBASEDIR], 'photivo.pro')] + self._qmake_config,
+                                   env=self._env[arch], cwd=self._paths[BUILDDIR][arch],
+                                   log_file=self._log_file(arch, 'qmake'), prefix=self._prefix(arch))
+        if build_result:
+            progress = ptrun.MakeProgress(ptrun.MakeProgress.count_objects(self._paths[BUILDDIR][arch]))
+            with self._span('make', arch):
+                build_result = run_cmd([CMD[MAKE]] + make_job_args(self._parallel_builds, self._make_shares[arch]),
+                                       env=self._env[arch], cwd=self._paths[BUILDDIR][arch],
+                                       log_file=self._log_file(arch, 'make'), prefix=self._prefix(arch),
+                                       progress=progress)
 
         if not build_result \
            or not os.path.isfile(os.path.join(self._paths[BUILDDIR][arch], 'photivo.exe')) \
@@ -425,15 +1342,88 @@ class PhotivoBuilder:
 
         # Move fresh binaries to bin dir
         try:
-            shutil.move(os.path.join(self._paths[BUILDDIR][arch], 'photivo.exe'), self._paths[BINDIR][arch])
+            # Copy instead of move, so an incremental build does not have to relink.
+            shutil.copy(os.path.join(self._paths[BUILDDIR][arch], 'photivo.exe'), self._paths[BINDIR][arch])
             shutil.copy(os.path.join(self._paths[BUILDDIR][arch], 'ptClear.exe'), self._paths[BINDIR][arch])
         except OSError as err:
             print_err('ERROR: Copying binaries to "%s" failed.'%self._paths[BINDIR])
             print_err(str(err))
             return False
 
+        if cache_key is not None:
+            self._cache.store(cache_key, [os.path.join(self._paths[BINDIR][arch], 'photivo.exe'),
+                                          os.path.join(self._paths[BINDIR][arch], 'ptClear.exe')])
+
+        return True
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _prepare_build_dir(self, arch):
+        """
+        In incremental mode keeps the build dir of an arch when it was created
+        with the same toolchain, qmake CONFIG, branch and project files. Otherwise
+        it is wiped to force a clean rebuild. The inputs are recorded in a stamp file.
+        """
+        builddir = self._paths[BUILDDIR][arch]
+        stamp_path = os.path.join(builddir, BUILD_STAMP_FILE)
+        stamp = self._build_stamp(arch)
+
+        try:
+            with open(stamp_path) as stampfile:
+                old_stamp = json.load(stampfile)
+        except (OSError, ValueError):
+            old_stamp = None
+
+        try:
+            # Without incremental mode prepare_dirs() already created an empty build dir.
+            if self._incremental and old_stamp != stamp:
+                if len(os.listdir(builddir)) > 0:
+                    if old_stamp is None:
+                        reason = 'no build stamp found'
+                    else:
+                        reason = ', '.join(sorted(key for key in stamp if old_stamp.get(key) != stamp[key])) + ' changed'
+                    print_warn('Clean rebuild needed (%s): %s.'%(ArchNames.names[arch], reason))
+
+                shutil.rmtree(builddir)
+                os.makedirs(builddir)
+
+            with open(stamp_path, 'w') as stampfile:
+                json.dump(stamp, stampfile, indent=1)
+
+        except OSError as err:
+            print_err('ERROR: Preparing build directory "%s" failed.'%builddir)
+            print_err(str(err))
+            return False
+
         return True
 
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _build_stamp(self, arch):
+        """
+        Collects everything that makes object files from an earlier build unusable.
+        """
+        project_files = sorted(glob.glob(os.path.join(self._paths[PTBASEDIR], '*.pro')) +
+                               glob.glob(os.path.join(self._paths[PTBASEDIR], '*.pri')))
+
+        return {
+            'toolchain': '%s %s'%(TC_NAME, ArchNames.names[arch]),
+            'tcpath': self._env[arch].get('tcpath', ''),
+            'config': ' '.join(self._qmake_config),
+            'branch': self._hgbranch,
+            'project files': ptcache.make_key(*[os.path.basename(file) + ptupdata.file_digest(file)
+                                                for file in project_files])
+        }
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _artifact_key(self, arch):
+        """
+        Returns the artifact cache key for the binaries of an arch, or None when
+        caching is not possible. Builds from a working copy with uncommitted
+        changes (hg id ends with "+") are never cached.
+        """
+        if self._cache is None or self._changeset.endswith('+'):
+            return None
+        return ptcache.make_key(self._changeset, TC_NAME, ArchNames.names[arch], self._qmake_config)
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     def package(self, arch):
         """
@@ -441,26 +1431,149 @@ class PhotivoBuilder:
         Then create the installer package from that.
         <return>  bool  True if the installer was successfully created, False otherwise
         """
-        if not self._copy_data_dlls(arch): return False
-        if not self._create_installers(arch): return False
+        data_inputs = [os.path.join(self._paths[PTBASEDIR], direntry[0]) for direntry in ptupdata.DIR_LIST]
+        data_inputs += [self._paths[CHLOGFILE], self._paths[LICFILE], self._paths[LIC3FILE]]
+        fingerprint = self._next_fingerprint(arch, ptcheckpoint.tree_fingerprint(data_inputs), str(RESOLVE_DLLS),
+                                             str(self._pack_data))
+        if not self._is_done('staging', arch, fingerprint, [self._paths[BINDIR][arch]]):
+            if not self._copy_data_dlls(arch): return False
+            self._record('staging', arch, fingerprint)
+
+        fingerprint = self._next_fingerprint(arch)
+        if not self._is_done('strip', arch, fingerprint):
+            self._traced('strip', arch, self._strip_binaries)
+            self._record('strip', arch, fingerprint)
+
+        fingerprint = self._next_fingerprint(arch)
+        if not self._is_done('manifest', arch, fingerprint, [self._manifest_files[arch]]):
+            if not self._traced('manifest', arch, self._create_manifest): return False
+            self._record('manifest', arch, fingerprint)
+
+        fingerprint = self._next_fingerprint(arch, ptcheckpoint.tree_fingerprint([self._paths[ISSFILE][arch]]),
+                                             self._repo.branch_log(self._paths[VERSTYFILE]))
+        if not self._is_done('installer', arch, fingerprint, [self._install_files[arch]]):
+            # The installer is only built from a bin folder that matches its manifest, whether
+            # the manifest was made just now or by an earlier run.
+            if not self._traced('verify', arch, self._verify_bindir): return False
+            if not self._traced('ISCC', arch, self._create_installers): return False
+            self._record('installer', arch, fingerprint)
+
+        if self._portable != '':
+            fingerprint = self._next_fingerprint(arch, self._portable)
+            if not self._is_done('portable', arch, fingerprint, [self._portable_files[arch]]):
+                if not self._traced('archive', arch, self._create_portable): return False
+                self._record('portable', arch, fingerprint)
+
+        if self._delta_bases[arch] is not None:
+            fingerprint = self._next_fingerprint(arch, self._delta_bases[arch])
+            if not self._is_done('delta', arch, fingerprint, [self._delta_files[arch]]):
+                if not self._traced('delta', arch, self._create_delta): return False
+                self._record('delta', arch, fingerprint)
+
         return True
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-    def _change_tc_arch(self, archname):
+    def _log_file(self, arch, step):
+        return os.path.join(self._paths[PKGBASEDIR], 'logs', '%s-%s.log'%(ArchNames.names[arch], step))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _prefix(self, arch):
+        # Console lines only need to be told apart when both archs build at once.
+        return ArchNames.names[arch] if self._parallel_builds > 1 else None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _span(self, name, arch):
+        return self._tracer.span(name, ArchNames.names[arch])
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _traced(self, name, arch, func):
+        with self._span(name, arch):
+            return func(arch)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _stage_name(self, stage, arch):
+        return stage + ':' + ArchNames.names[arch]
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _next_fingerprint(self, arch, *inputs):
         """
-        Changes the toolchain architecture between 32bit and 64bit.
-        Calls the external switchtc script and parses its output.
+        Fingerprint for the next stage of an arch. It includes the fingerprint
+        of the previous stage, so a stage that runs again invalidates all later ones.
         """
-        try:
-            for line in get_cmd_output(['switchtc', TC_NAME, archname, '--listenv'], use_shell=True).split('\n'):
-                key, _, val = line.strip().partition('=')
-                self._env[key] = val            
-            return True
-        except Exception as err:
-            print_err(str(err))
+        self._fingerprints[arch] = ptcache.make_key(self._fingerprints[arch], *inputs)
+        return self._fingerprints[arch]
 
-        print_err('ERROR: Failed to switch toolchain to %s %s.'%(TC_NAME, archname))
-        return False
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _is_done(self, stage, arch, fingerprint, outputs=()):
+        """
+        <return>  bool  True if resuming and the stage completed earlier with the same inputs
+        """
+        if not self._resume or self._checkpoints is None:
+            return False
+        if not self._checkpoints.is_done(self._stage_name(stage, arch), fingerprint, outputs):
+            return False
+        print_ok('Resuming: %s (%s) unchanged, skipped.'%(stage, ArchNames.names[arch]))
+        return True
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _record(self, stage, arch, fingerprint, data=None):
+        if self._checkpoints is not None:
+            self._checkpoints.record(self._stage_name(stage, arch), fingerprint, data)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _switch_toolchain(self, arch):
+        """
+        Toolchain switch as a resumable stage. The checkpoint keeps the variables
+        the switch set and removed compared to os.environ, and the toolchain
+        fingerprint of pttoolchain (switchtc script, toolchain dir and PATH).
+        A resumed run applies the changes to its own environment, as long as
+        the fingerprint is unchanged. Otherwise the switch runs again and, with
+        a new fingerprint, all later stages as well.
+        """
+        changes = None
+        if self._resume and self._checkpoints is not None:
+            changes = self._checkpoints.data(self._stage_name('toolchain', arch))
+
+        if isinstance(changes, dict) and 'key' in changes:
+            env = dict(os.environ)
+            env.update(changes['set'])
+            for key in changes['removed']:
+                env.pop(key, None)
+
+            previous = self._fingerprints[arch]
+            if self._toolchains.fingerprint(env.get('tcpath', '')) == changes['key']:
+                if self._is_done('toolchain', arch, self._next_fingerprint(arch, TC_NAME, changes['key'])):
+                    self._env[arch] = types.MappingProxyType(env)
+                    return True
+            self._fingerprints[arch] = previous
+
+        if not self._traced('switchtc', arch, self._change_tc_arch):
+            return False
+
+        env = self._env[arch]
+        key = self._toolchains.fingerprint(env.get('tcpath', ''))
+        self._record('toolchain', arch, self._next_fingerprint(arch, TC_NAME, key), {
+            'key':     key,
+            'set':     {name: value for name, value in env.items() if os.environ.get(name) != value},
+            'removed': sorted(name for name in os.environ if not name in env)
+        })
+        return True
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _change_tc_arch(self, arch):
+        """
+        Sets up the toolchain environment for the given architecture. It comes
+        from a saved snapshot of the switchtc output, switchtc itself only runs
+        when the snapshot is outdated (see pttoolchain). The environment is a
+        read-only mapping, os.environ itself stays untouched.
+        """
+        env = self._toolchains.environment(TC_NAME, ArchNames.bits[arch])
+        if env is None:
+            print_err('ERROR: Failed to switch toolchain to %s %s.'%(TC_NAME, ArchNames.bits[arch]))
+            return False
+
+        self._env[arch] = env
+        return True
 
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -470,46 +1583,136 @@ class PhotivoBuilder:
         """
         print_ok('Packaging files (%s)...'%(ArchNames.names[arch]))
 
-        # Changelog: make sure it is up to date (i.e. edited today)
-        while True:
-            chlog_moddate = datetime.fromtimestamp(os.path.getmtime(self._paths[CHLOGFILE])).date()
-            if chlog_moddate >= datetime.today().date():
-                break
-            else:
-                print_warn('Changelog not edited today, but on ' + str(chlog_moddate) + '. It is probably outdated.')
-                print('Note that any changes you make after this point will probably not be present')
-                print('in the installers.')
-
-                cont = wait_for_key('(R)etry, (c)ontinue or (a)bort?', ['r', 'c', 'a'])
-                if cont == 'r':
-                    continue
-                elif cont == 'c':
-                    break
-                elif cont == 'a':
-                    raise KeyboardInterrupt
-
-        shutil.copy(self._paths[CHLOGFILE], self._paths[BINDIR][arch])
-
-        # copy licence files
-        shutil.copy(self._paths[LICFILE], os.path.join(self._paths[BINDIR][arch], 'License.txt'))
-        shutil.copy(self._paths[LIC3FILE], os.path.join(self._paths[BINDIR][arch], 'License 3rd party.txt'))
+        if not self._stage_common_data(arch):
+            return False
 
-        # Call util scripts to updata data files and DLLs
-        if not ptupdata.main([self._paths[PTBASEDIR], self._paths[BINDIR][arch]]):
+        # Hard link the shared data into the bin dir. Only falls back to copying
+        # when the file system does not support hard links.
+        # With packed data the packs replace their dirs, otherwise packs of an earlier run are left out.
+        skipped = ptpack.packed_names() if self._pack_data else \
+                  [name + ptpack.PACK_EXTENSION for name in ptpack.packed_names()]
+        try:
+            with self._span('link data', arch):
+                stats = ptupdata.SyncStats()
+                for entry in os.scandir(self._paths[COMMONDIR]):
+                    destpath = os.path.join(self._paths[BINDIR][arch], entry.name)
+                    if entry.name in skipped:
+                        if os.path.isdir(destpath):
+                            shutil.rmtree(destpath)
+                        elif os.path.exists(destpath):
+                            os.remove(destpath)
+                    elif entry.is_dir():
+                        ptupdata.sync_tree(entry.path, destpath, stats=stats, link=True)
+                    elif not ptupdata.link_file(entry.path, destpath):
+                        shutil.copy2(entry.path, destpath)
+                        stats.copied += 1
+                        stats.bytes_copied += entry.stat().st_size
+                pttrace.count('bytes_copied', stats.bytes_copied)
+            print('Shared data files (%s): %s'%(ArchNames.names[arch], stats))
+        except OSError as err:
+            print_err('ERROR: Linking data files into "%s" failed.'%self._paths[BINDIR][arch])
+            print_err(str(err))
             return False
+
+        # Call util script to update DLLs
         try:
-            if not ptuplibs.main([os.path.dirname(os.environ['tcpath']), 
-                                  self._paths[BINDIR][arch], 
-                                  ArchNames.bits[arch]]):
+            with self._span('ptuplibs', arch):
+                libs_ok = ptuplibs.main([os.path.dirname(self._env[arch]['tcpath']),
+                                         self._paths[BINDIR][arch],
+                                         ArchNames.bits[arch],
+                                         '--stage',
+                                         '--cache-dir=' + CACHE_DIR] +
+                                        (['--auto'] if RESOLVE_DLLS else []))
+            if not libs_ok:
                 return False
         except KeyError:
             print_err('Environment variable tcpath not set.')
             return False
 
-        # strip unnecessary symbols from binaries
-        for files in ['*.exe', '*.dll']:
-            if not run_cmd([CMD[STRIP], os.path.join(self._paths[BINDIR][arch], files)]):
-                print_warn('WARNING: Failed to strip ' + os.path.join(self._paths[BINDIR][arch], files))
+        return True
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _strip_binaries(self, arch):
+        """
+        Strips unnecessary symbols from all binaries in the bin dir. Failing to
+        strip is not fatal, the installer only gets bigger.
+        """
+        ptstrip.strip_files(ptstrip.find_binaries(self._paths[BINDIR][arch]),
+                            CMD[STRIP], env=self._env[arch], cache=self._strip_cache,
+                            jobs=max(1, multiprocessing.cpu_count() // self._parallel_builds))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _stage_common_data(self, arch):
+        """
+        Stages everything that is the same for all archs (data dirs, Changelog,
+        licence files) once into the common dir. Runs only once per run, even
+        when several pipelines reach this point. arch is the pipeline that does
+        the work, it only matters for the trace.
+        """
+        with self._stage_lock:
+            if self._common_staged is None:
+                self._common_staged = self._check_changelog() \
+                                      and self._traced('ptupdata', arch, self._copy_common_data) \
+                                      and (not self._pack_data or self._traced('ptpack', arch, self._pack_common_data))
+            return self._common_staged
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _copy_common_data(self, arch):
+        commondir = self._paths[COMMONDIR]
+        try:
+            os.makedirs(commondir, exist_ok=True)
+            shutil.copy2(self._paths[CHLOGFILE], commondir)
+            shutil.copy2(self._paths[LICFILE], os.path.join(commondir, 'License.txt'))
+            shutil.copy2(self._paths[LIC3FILE], os.path.join(commondir, 'License 3rd party.txt'))
+        except OSError as err:
+            print_err('ERROR: Copying Changelog and licence files failed.')
+            print_err(str(err))
+            return False
+
+        stats = ptupdata.update_data(self._paths[PTBASEDIR], commondir)
+        if stats is None:
+            return False
+        pttrace.count('bytes_copied', stats.bytes_copied)
+        return True
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _pack_common_data(self, arch):
+        """
+        Packs the data dirs in the common dir, see ptpack. Photivo then gets
+        a handful of pack files instead of thousands of small files, which is
+        much faster to link, compress, install and scan for viruses.
+        """
+        stats = ptpack.pack_data(self._paths[COMMONDIR])
+        if stats is None:
+            return False
+        print('Data packs: %s'%stats)
+        pttrace.count('bytes_copied', stats.bytes)
+        return True
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _check_changelog(self):
+        """
+        Makes sure the Changelog is up to date (i.e. edited today).
+        """
+        with self._prompt_lock:
+            while True:
+                chlog_moddate = datetime.fromtimestamp(os.path.getmtime(self._paths[CHLOGFILE])).date()
+                if chlog_moddate >= datetime.today().date():
+                    break
+                else:
+                    print_warn('Changelog not edited today, but on ' + str(chlog_moddate) + '. It is probably outdated.')
+                    print('Note that any changes you make after this point will probably not be present')
+                    print('in the installers.')
+
+                    cont = wait_for_key('(R)etry, (c)ontinue or (a)bort?', ['r', 'c', 'a'], 'changelog')
+                    if cont == 'r':
+                        continue
+                    elif cont == 'c':
+                        break
+                    elif cont == 'a':
+                        # Only this release fails, a batch run goes on with the next job.
+                        print_err('ERROR: Aborted because of the outdated Changelog.')
+                        return False
 
         return True
 
@@ -518,28 +1721,98 @@ class PhotivoBuilder:
     def _create_installers(self, arch):
         print_ok('Creating installer (%s) ...'%(ArchNames.names[arch]))
 
-        ptversion = get_cmd_output([CMD[HG], 'log', '-b', self._hgbranch, '-l', '1', '--style', self._paths[VERSTYFILE]])
+        try:
+            iss_template = pttemplate.load(self._paths[ISSFILE][arch], ISS_PLACEHOLDERS, comment=';')
+            iss_values = {
+                'versionstring':  self._repo.branch_log(self._paths[VERSTYFILE]),
+                'changelogfile':  self._paths[CHLOGFILE],
+                'outputbasename': self._INST_NAME_PATTERN%(self._release_tag, ArchNames.names[arch]),
+                'bindir':         self._paths[BINDIR][arch]
+            }
+            iss_template.check(iss_values)
+        except (OSError, pttemplate.TemplateError) as err:
+            print_err('ERROR: ' + str(err))
+            return False
+
+        # The script is rendered straight into the stdin pipe of ISCC.
+        if not run_cmd([CMD[ISCC], '/O' + self._paths[PKGBASEDIR], '-'],
+                       log_file=self._log_file(arch, 'iscc'), prefix=self._prefix(arch),
+                       stdin_data=lambda pipe: iss_template.render_to(pipe, iss_values, 'latin_1')):
+            print_err('ERROR: Creating installer (%s) failed.'%(ArchNames.names[arch]))
+            return False
 
-        with open(self._paths[ISSFILE][arch]) as issfile:
-            iss_script = issfile.readlines()
+        return True
 
-        i = 0
-        while i < len(iss_script):
-            line = iss_script[i].replace('{{versionstring}}', ptversion)
-            line = line.replace('{{changelogfile}}', self._paths[CHLOGFILE])
-            line = line.replace('{{outputbasename}}', self._INST_NAME_PATTERN%(self._release_date, ArchNames.names[arch]))
-            iss_script[i] = line.replace('{{bindir}}', self._paths[BINDIR][arch])
-            i += 1
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _create_manifest(self, arch):
+        """
+        Records size and SHA-1 of every file in the finished bin dir. The manifest
+        goes to the archive dir with the installer, so installations can be
+        checked against it with ptmanifest.py.
+        """
+        print_ok('Creating manifest (%s) ...'%ArchNames.names[arch])
+        manifest = ptmanifest.build_manifest(self._paths[BINDIR][arch], self._release_name(arch),
+                                             jobs=max(1, multiprocessing.cpu_count() // self._parallel_builds))
+        if manifest is None:
+            return False
 
-        iscc_proc = Popen([CMD[ISCC], '/O' + self._paths[PKGBASEDIR], '-'], stdin=PIPE)
-        iscc_proc.communicate(input=bytes('\n'.join(iss_script), 'latin_1'))
+        pttrace.count('bytes_hashed', sum(entry['size'] for entry in manifest['files'].values()))
+        return ptmanifest.save_manifest(manifest, self._manifest_files[arch])
 
-        if iscc_proc.returncode != 0:
-            print_err('ERROR: Creating installer (%s) failed.'%(ArchNames.names[arch]))
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _verify_bindir(self, arch):
+        manifest = ptmanifest.load_manifest(self._manifest_files[arch])
+        if manifest is None:
             return False
 
+        return ptmanifest.verify_tree(self._paths[BINDIR][arch], manifest,
+                                      jobs=max(1, multiprocessing.cpu_count() // self._parallel_builds))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _create_portable(self, arch):
+        """
+        Packs the bin dir into a portable archive. Runs on all cores, shared
+        with the other pipeline in concurrent mode.
+        """
+        print_ok('Creating portable %s archive (%s) ...'%(self._portable, ArchNames.names[arch]))
+
+        root_name = os.path.basename(self._portable_files[arch])[:-len(ptarchive.FORMATS[self._portable])]
+        stats = ptarchive.create_archive(self._paths[BINDIR][arch], self._portable_files[arch], self._portable,
+                                         root_name=root_name,
+                                         jobs=max(1, multiprocessing.cpu_count() // self._parallel_builds))
+        if stats is None:
+            return False
+
+        pttrace.count('bytes_written', stats.bytes_out)
+        self._archive_stats[arch] = stats
+        print(stats)
+        return True
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _create_delta(self, arch):
+        print_ok('Creating update package from %s (%s) ...'%(self._delta_bases[arch], ArchNames.names[arch]))
+
+        manifest = ptmanifest.load_manifest(self._manifest_files[arch])
+        if manifest is None:
+            return False
+
+        stats = ptdelta.create_delta(release_store(), self._delta_bases[arch], self._paths[BINDIR][arch],
+                                     self._delta_files[arch], self._release_name(arch),
+                                     jobs=max(1, multiprocessing.cpu_count() // self._parallel_builds),
+                                     new_manifest=manifest)
+        if stats is None:
+            return False
+
+        pttrace.count('bytes_written', stats.delta_size)
+        self._delta_stats[arch] = stats
+        print(stats)
         return True
 
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _release_name(self, arch):
+        # name of this release in the release store
+        return '%s-%s'%(self._release_tag, ArchNames.names[arch])
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     def show_summary(self):
         print('\n' + DIVIDER + '\nFinal status\n' + DIVIDER)
@@ -552,8 +1825,30 @@ class PhotivoBuilder:
         print('Photivo installer 32bit: ', end='')
         inst32_ok = print_file_status(self._install_files[Arch.win32])
 
+        if self._portable != '':
+            print('Portable archive 64bit:  ', end='')
+            inst64_ok = print_file_status(self._portable_files[Arch.win64]) and inst64_ok
+            print('Portable archive 32bit:  ', end='')
+            inst32_ok = print_file_status(self._portable_files[Arch.win32]) and inst32_ok
+
+            for arch in Arch.archs:
+                if self._archive_stats[arch] is not None:
+                    print('%s %s'%(ArchNames.names[arch], self._archive_stats[arch]))
+
+        for arch in Arch.archs:
+            if self._delta_stats[arch] is not None:
+                print('Update package from %s: %s'%(self._delta_bases[arch], self._delta_stats[arch]))
+
+        # Batch jobs share the caches, every job shows its own hits and misses.
+        if self._cache is not None:
+            print('\n' + self._cache.stats_str(since=self._cache_stats[self._cache]))
+        if self._strip_cache is not None:
+            print(self._strip_cache.stats_str('Stripped DLL cache', self._cache_stats[self._strip_cache]))
+
+        print('\n' + self._tracer.summary())
+
         print('\nChangeset info:')
-        run_cmd([CMD[HG], 'log', '-b', self._hgbranch, '-l', '1'])
+        print(self._repo.branch_log())
 
         print(DIVIDER)
 
@@ -561,6 +1856,15 @@ class PhotivoBuilder:
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
     def cleanup(self):
+        # Keep the contents of the release, later releases make their delta packages against it.
+        store = release_store()
+        for arch in Arch.archs:
+            manifest = ptmanifest.load_manifest(self._manifest_files[arch])
+            if manifest is None or store.archive(self._paths[BINDIR][arch], self._release_name(arch),
+                                                 manifest=manifest) is None:
+                print_err('Cleanup failed. Could not archive the %s release.'%ArchNames.names[arch])
+                return False
+
         if ARCHIVE_DIR != '':
             try:
                 if not os.path.isdir(ARCHIVE_DIR):
@@ -568,6 +1872,11 @@ class PhotivoBuilder:
 
                 for arch in Arch.archs:
                     shutil.move(self._install_files[arch], ARCHIVE_DIR)
+                    shutil.move(self._manifest_files[arch], ARCHIVE_DIR)
+                    if self._portable_files[arch] is not None:
+                        shutil.move(self._portable_files[arch], ARCHIVE_DIR)
+                    if self._delta_files[arch] is not None:
+                        shutil.move(self._delta_files[arch], ARCHIVE_DIR)
             except OSError as err:
                 print_err('Cleanup failed. Could not move installers.')
                 print_err(str(err))
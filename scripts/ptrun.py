@@ -0,0 +1,266 @@
+#-*- coding: utf8 -*-
+
+import asyncio, collections, glob, locale, os, re, shlex, subprocess, sys, threading, time
+from utils import print_err
+
+import pttrace
+
+USER_INVOKED = False
+
+LOG_TAIL_LINES  = 50        # lines kept in memory for error reports
+LINE_LIMIT      = 1 << 20   # longest output line that is read in one piece
+PROGRESS_STEP   = 5         # percent between two make progress messages
+
+# Serializes all console output of child processes, so lines from children
+# that run at the same time (in any thread) never get mixed up.
+_console_lock = threading.Lock()
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    if len(cli_params) == 0:
+        print_err('Usage: ptrun.py [--log=<file>] <command> [<arg> ...]')
+        return False
+
+    log_file = None
+    if cli_params[0].startswith('--log='):
+        log_file = cli_params[0][len('--log='):]
+        cli_params = cli_params[1:]
+
+    result = run(cli_params, log_file=log_file)
+    return result.returncode == 0
+
+
+# -----------------------------------------------------------------------
+class CmdResult:
+    """
+    Outcome of a command run with run() or run_async().
+    """
+    def __init__(self, cmd, returncode, tail, output=None, log_file=None, seconds=0.0):
+        self.cmd        = cmd
+        self.returncode = returncode
+        self.tail       = tail        # list, last output lines (stdout and stderr)
+        self.output     = output      # string, complete stdout when captured, None otherwise
+        self.log_file   = log_file
+        self.seconds    = seconds
+
+    def print_tail(self, name=None):
+        if name is None:
+            name = self.cmd if isinstance(self.cmd, str) else self.cmd[0]
+        print_err('Last %d output lines of %s:'%(len(self.tail), name))
+        for line in self.tail:
+            print_err('  ' + line)
+        if self.log_file is not None:
+            print_err('Full output: ' + self.log_file)
+
+
+# -----------------------------------------------------------------------
+class MakeProgress:
+    """
+    Estimates how far a make run is by counting the compiler calls in its
+    output against the number of object files in the qmake generated makefiles.
+    """
+    # e.g. "g++ -c -pipe -O2 ... -o release\\ptMain.o ..\\..\\Sources\\ptMain.cpp"
+    COMPILE_RE = re.compile(r'\s-c\s.*\.(c|cc|cpp|cxx)\b')
+
+    def __init__(self, total, step=PROGRESS_STEP):
+        """
+        total  int  number of compile steps expected, see count_objects()
+        step   int  percent between two progress messages
+        """
+        self._total = max(1, total)
+        self._step = step
+        self._done = 0
+        self._reported = 0
+        self._start = time.monotonic()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def feed(self, line):
+        """
+        <return>  string  progress message when the next step is reached, None otherwise
+        """
+        if not self.COMPILE_RE.search(line):
+            return None
+
+        self._done += 1
+        # Incremental builds compile fewer files, full rebuilds of generated files more.
+        total = max(self._total, self._done)
+        percent = 100 * self._done // total
+        if percent < self._reported + self._step:
+            return None
+
+        self._reported = percent
+        elapsed = time.monotonic() - self._start
+        remaining = elapsed / self._done * (total - self._done)
+        return 'make: %d%% (%d/%d), about %d:%02d left'%(percent, self._done, total,
+                                                      remaining // 60, remaining % 60)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    @staticmethod
+    def count_objects(builddir):
+        """
+        Counts the object files in the OBJECTS variable of the release makefiles
+        in builddir and its subdirs (or the plain makefiles when there are no
+        release ones).
+        <return>  int
+        """
+        makefiles = glob.glob(os.path.join(builddir, '**', 'Makefile.Release'), recursive=True) \
+                    or glob.glob(os.path.join(builddir, '**', 'Makefile'), recursive=True)
+
+        count = 0
+        for makefile in makefiles:
+            try:
+                with open(makefile, errors='replace') as mkfile:
+                    in_objects = False
+                    for line in mkfile:
+                        if line.startswith('OBJECTS '):
+                            in_objects = True
+                            line = line.partition('=')[2]
+                        if in_objects:
+                            count += sum(1 for word in line.split() if word.endswith(('.o', '.obj')))
+                            in_objects = line.rstrip().endswith('\\')
+            except OSError:
+                pass
+
+        return count
+
+
+# -----------------------------------------------------------------------
+def run(cmd, **kwargs):
+    """
+    Blocking version of run_async() with the same parameters. Runs its own
+    event loop, so it can be called from any thread.
+    <return>  CmdResult
+    """
+    return asyncio.run(run_async(cmd, **kwargs))
+
+
+# -----------------------------------------------------------------------
+async def run_async(cmd, env=None, cwd=None, shell=False, log_file=None, echo=True, prefix=None,
+                    capture=False, stdin_data=None, progress=None, tail_lines=LOG_TAIL_LINES):
+    """
+    Runs a command and streams its stdout and stderr line by line to the
+    console, a log file and a ring buffer with the last lines. Several
+    commands can run at the same time, in one loop or in several threads,
+    without mixing up their lines.
+    The child is a plain subprocess.Popen, not one of
+    asyncio.create_subprocess_exec(): the loop's child watcher reaps its
+    children with waitpid() and their resource usage is lost. The pipes are
+    read and the child is waited for (os.wait4(), the process handle on
+    Windows) in the loop's executor, the usage goes to the trace spans of the
+    thread that runs the loop.
+    cmd         list          command and arguments
+    env         dict          environment, None for the current one
+    cwd         string        working dir of the command
+    shell       bool          run through the shell
+    log_file    string        complete output goes here, the file is overwritten
+    echo        bool          show the output on the console
+    prefix      string        put in front of every console line, e.g. the arch
+    capture     bool          keep the complete stdout in CmdResult.output
+    stdin_data  bytes         written to stdin, stdin is closed afterwards. Or a
+                              function that gets the binary stdin pipe and writes
+                              to it itself, e.g. piece by piece; it runs in the
+                              loop's executor.
+    progress    MakeProgress  progress messages are shown instead of the output
+    tail_lines  int           size of the ring buffer
+    <return>    CmdResult
+    Raises OSError when the command cannot be started.
+    """
+    tail = collections.deque(maxlen=tail_lines)
+    captured = [] if capture else None
+    encoding = locale.getpreferredencoding(False)
+    line_prefix = '' if prefix is None else '[%s] '%prefix
+
+    logfile = None
+    if log_file is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+        logfile = open(log_file, 'w', encoding='utf-8', errors='replace')
+
+    def show(line, stream):
+        with _console_lock:
+            print(line_prefix + line, file=stream, flush=True)
+
+    async def pump(pipe, stream, keep):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Plain pipes read in the executor: the child stays a normal Popen
+            # child, so pttrace.wait() gets its own resource usage.
+            data = await loop.run_in_executor(None, pipe.readline, LINE_LIMIT)
+            if not data:
+                break
+            line = data.decode(encoding, 'replace').rstrip('\r\n')
+
+            tail.append(line)
+            if keep is not None:
+                keep.append(line)
+            if logfile is not None:
+                logfile.write(line + '\n')
+
+            if progress is not None:
+                message = progress.feed(line)
+                if message is not None:
+                    show(message, sys.stdout)
+                # Warnings and errors still show up, the compiler chatter does not.
+                if stream is sys.stderr and echo:
+                    show(line, stream)
+            elif echo:
+                show(line, stream)
+
+    def feed_stdin(pipe):
+        try:
+            if callable(stdin_data):
+                stdin_data(pipe)
+            else:
+                pipe.write(stdin_data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass    # the child exited early, its output tells why
+        finally:
+            try:
+                pipe.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+    if shell and not isinstance(cmd, str):
+        cmdline = subprocess.list2cmdline(cmd) if os.name == 'nt' else ' '.join(shlex.quote(arg) for arg in cmd)
+    else:
+        cmdline = cmd
+
+    start = time.perf_counter()
+    try:
+        proc = subprocess.Popen(cmdline, shell=shell, env=env, cwd=cwd,
+                                stdin=subprocess.PIPE if stdin_data is not None else subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            tasks = [pump(proc.stdout, sys.stdout, captured), pump(proc.stderr, sys.stderr, None)]
+            if stdin_data is not None:
+                tasks.append(asyncio.get_running_loop().run_in_executor(None, feed_stdin, proc.stdin))
+            await asyncio.gather(*tasks)
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            # Both pipes are at their end, so the child is exiting. The executor thread
+            # has no spans open, its CPU time and peak RSS are added here.
+            try:
+                returncode, child_cpu, peak_rss = \
+                    await asyncio.get_running_loop().run_in_executor(None, pttrace.wait_usage, proc)
+                pttrace.add_child_usage(child_cpu, peak_rss)
+            finally:
+                proc.stdout.close()
+                proc.stderr.close()
+    finally:
+        if logfile is not None:
+            logfile.close()
+
+    return CmdResult(cmd, returncode, list(tail),
+                     None if captured is None else '\n'.join(captured),
+                     log_file, time.perf_counter() - start)
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
@@ -0,0 +1,89 @@
+#-*- coding: utf8 -*-
+
+import glob, multiprocessing, os, subprocess, sys
+from concurrent.futures import ThreadPoolExecutor
+from utils import print_ok, print_warn, print_err
+
+import ptcache
+from ptupdata import file_digest
+
+USER_INVOKED = False
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    if len(cli_params) == 1:
+        bindir = os.path.abspath(cli_params[0])
+    else:
+        print_err('Wrong number of arguments. Must be one (the bin dir).')
+        return False
+
+    if not os.path.isdir(bindir):
+        print_err('ERROR: Directory "%s" missing.'%bindir)
+        return False
+
+    return strip_files(find_binaries(bindir))
+
+
+# -----------------------------------------------------------------------
+def find_binaries(bindir):
+    """
+    <return>  list  all *.exe and *.dll files in bindir (not recursive)
+    """
+    return sorted(glob.glob(os.path.join(bindir, '*.exe')) + glob.glob(os.path.join(bindir, '*.dll')))
+
+
+# -----------------------------------------------------------------------
+def strip_files(files, strip_cmd='strip', env=None, cache=None, jobs=None):
+    """
+    Strips unnecessary symbols from binaries. Every file gets its own strip
+    process, up to jobs of them run at the same time.
+    DLLs are looked up in cache by their content first. When a stripped copy
+    is found it replaces the file, otherwise the freshly stripped DLL is added
+    to the cache. EXEs change with every build and are always stripped.
+    files      list           paths of the binaries
+    strip_cmd  string         strip command
+    env        dict           environment for strip, None for the current one
+    cache      ArtifactCache  cache for stripped DLLs, None disables caching
+    jobs       int            parallel strip processes, default is the number of cores
+    <return>   bool           True if all files were stripped
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+
+    def strip_file(file):
+        name = os.path.basename(file)
+        cache_key = None
+
+        try:
+            if cache is not None and name.lower().endswith('.dll'):
+                cache_key = ptcache.make_key(name, file_digest(file))
+                if cache.restore(cache_key, os.path.dirname(file)):
+                    return True
+
+            if subprocess.call([strip_cmd, file], env=env) != 0:
+                raise OSError('%s returned an error.'%strip_cmd)
+        except OSError as err:
+            print_warn('WARNING: Failed to strip ' + file)
+            print_warn(str(err))
+            return False
+
+        if cache_key is not None:
+            cache.store(cache_key, [file])
+        return True
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(strip_file, files))
+
+    if all(results):
+        print_ok('Stripped %d binaries.'%len(files))
+    return all(results)
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
@@ -0,0 +1,162 @@
+#-*- coding: utf8 -*-
+
+import os, re, sys, threading
+from utils import print_err
+
+USER_INVOKED = False
+
+# {{name}} placeholders. Inno Setup's own "{{" escape (e.g. in AppID) is not
+# followed by a plain name and "}}", so it never matches.
+PLACEHOLDER_RE = re.compile(r'\{\{([A-Za-z_][A-Za-z0-9_]*)\}\}')
+
+_template_cache = {}
+_cache_lock = threading.Lock()
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    if len(cli_params) == 0:
+        print_err('Usage: pttemplate.py <template file> [name=value ...]')
+        return False
+
+    values = {}
+    for param in cli_params[1:]:
+        name, sep, value = param.partition('=')
+        if sep == '':
+            print_err('ERROR: "%s" is not a name=value pair.'%param)
+            return False
+        values[name] = value
+
+    try:
+        template = load(cli_params[0])
+        template.render_to(sys.stdout, values)
+    except (OSError, TemplateError) as err:
+        print_err('ERROR: ' + str(err))
+        return False
+
+    return True
+
+
+# -----------------------------------------------------------------------
+class TemplateError(Exception):
+    pass
+
+
+# -----------------------------------------------------------------------
+def load(path, known_names=None, comment=None, encoding='latin_1'):
+    """
+    Returns the parsed template from a file. Templates are parsed only once
+    and reparsed only when the file changes on disk.
+    known_names  iterable  allowed placeholder names, None allows all
+    comment      string    placeholders on lines starting with this are left alone
+    <return>     Template
+    Raises OSError when the file cannot be read, TemplateError for unknown placeholders.
+    """
+    path = os.path.abspath(path)
+    key = (path, os.path.getmtime(path), comment, encoding,
+           None if known_names is None else frozenset(known_names))
+
+    with _cache_lock:
+        template = _template_cache.get(key)
+
+    if template is None:
+        # newline='' keeps the line endings of the file as they are
+        with open(path, encoding=encoding, newline='') as tplfile:
+            template = Template(tplfile.read(), known_names, comment, path)
+        with _cache_lock:
+            _template_cache[key] = template
+
+    return template
+
+
+# -----------------------------------------------------------------------
+class Template:
+    """
+    Text with {{name}} placeholders. The text is split into literal parts and
+    placeholder names once, rendering is a single join over the parts.
+    """
+    _parts = None      # literal, name, literal, name, ..., literal
+    _names = None
+    _source = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, text, known_names=None, comment=None, source='<string>'):
+        """
+        known_names  iterable  allowed placeholder names, None allows all
+        comment      string    placeholders on lines starting with this are left alone
+        source       string    file name for error messages
+        Raises TemplateError for placeholders not in known_names.
+        """
+        self._source = source
+        self._parts = []
+
+        literal_start = 0
+        for match in PLACEHOLDER_RE.finditer(text):
+            if comment is not None:
+                line_start = text.rfind('\n', 0, match.start()) + 1
+                if text[line_start:match.start()].lstrip().startswith(comment):
+                    continue
+            self._parts += [text[literal_start:match.start()], match.group(1)]
+            literal_start = match.end()
+        self._parts.append(text[literal_start:])
+
+        self._names = frozenset(self._parts[1::2])
+
+        if known_names is not None:
+            unknown = self._names - frozenset(known_names)
+            if unknown:
+                raise TemplateError('%s: unknown placeholder(s): %s'%(source, ', '.join(sorted(unknown))))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def names(self):
+        """
+        <return>  frozenset  names of all placeholders in the template
+        """
+        return self._names
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def render(self, values):
+        """
+        values    dict    value for every placeholder name
+        <return>  string
+        Raises TemplateError when a value is missing.
+        """
+        return ''.join(self._chunks(values))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def render_to(self, stream, values, encoding=None):
+        """
+        Writes the rendered template to stream piece by piece. All values are
+        checked before the first write, so nothing is written on error.
+        stream    file    text stream, or binary stream when encoding is given
+        """
+        for chunk in self._chunks(values):
+            stream.write(chunk if encoding is None else chunk.encode(encoding))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def check(self, values):
+        """
+        Raises TemplateError when values lacks a value for any placeholder.
+        """
+        missing = self._names.difference(values)
+        if missing:
+            raise TemplateError('%s: no value for placeholder(s): %s'%(self._source, ', '.join(sorted(missing))))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _chunks(self, values):
+        self.check(values)
+
+        parts = self._parts
+        for i in range(0, len(parts) - 1, 2):
+            yield parts[i]
+            yield values[parts[i + 1]]
+        yield parts[-1]
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
@@ -0,0 +1,188 @@
+#-*- coding: utf8 -*-
+
+import json, os, shutil, sys, threading, types
+from utils import print_ok, print_warn, print_err
+
+import ptcache, ptrun
+
+USER_INVOKED = False
+
+SWITCHTC         = 'switchtc'
+SNAPSHOT_VERSION = 1
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    if not len(cli_params) in (3, 4) or not cli_params[2] in ('32', '64') \
+       or (len(cli_params) == 4 and cli_params[3] != '--refresh'):
+        print_err('Usage: pttoolchain.py <cache dir> <toolchain> <32|64> [--refresh]')
+        return False
+
+    toolchains = ToolchainCache(cli_params[0])
+    if len(cli_params) == 4:
+        toolchains.forget(cli_params[1], cli_params[2])
+
+    env = toolchains.environment(cli_params[1], cli_params[2])
+    if env is None:
+        return False
+
+    for key, value in sorted(env.items()):
+        if os.environ.get(key) != value:
+            print('%s=%s'%(key, value))
+    return True
+
+
+# -----------------------------------------------------------------------
+class ToolchainCache:
+    """
+    Environments of the toolchains set up by switchtc. The variables that
+    "switchtc <toolchain> <bits> --listenv" prints are saved on disk per
+    toolchain and arch. A snapshot is used as long as the switchtc script,
+    the toolchain dir and PATH are unchanged, otherwise switchtc runs again.
+    Environments are returned as read-only mappings: every caller gets the
+    same object and nobody can change it for the others. os.environ is never
+    modified. Safe to use from several threads.
+    """
+    _cache_dir = None
+    _envs = None       # (toolchain, bits) -> environment already used in this run
+    _lock = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, cache_dir):
+        self._cache_dir = os.path.abspath(cache_dir)
+        self._envs = {}
+        self._lock = threading.Lock()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def environment(self, toolchain, bits):
+        """
+        toolchain  string            toolchain name as known to switchtc
+        bits       string            '32' or '64'
+        <return>   MappingProxyType  the process environment with the toolchain
+                                     variables, None on error
+        """
+        with self._lock:
+            env = self._envs.get((toolchain, bits))
+            if env is not None:
+                return env
+
+            variables = self._load(toolchain, bits)
+            if variables is not None:
+                print_ok('Using the saved %s %sbit toolchain environment.'%(toolchain, bits))
+            else:
+                variables = self._run_switchtc(toolchain, bits)
+                if variables is None:
+                    return None
+                self._save(toolchain, bits, variables)
+
+            env = dict(os.environ)
+            env.update(variables)
+            env = types.MappingProxyType(env)
+            self._envs[(toolchain, bits)] = env
+            return env
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def forget(self, toolchain, bits):
+        """
+        Deletes a snapshot, so switchtc runs again next time.
+        """
+        with self._lock:
+            self._envs.pop((toolchain, bits), None)
+            try:
+                os.remove(self._snapshot_path(toolchain, bits))
+            except OSError:
+                pass
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def fingerprint(self, tcpath):
+        """
+        tcpath    string  toolchain dir, the "tcpath" variable of an environment
+        <return>  string  the key snapshots are checked with: it changes with the
+                          switchtc script, the toolchain dir and PATH. Empty when
+                          switchtc cannot be found.
+        """
+        return self._snapshot_key(tcpath) or ''
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _snapshot_path(self, toolchain, bits):
+        return os.path.join(self._cache_dir, '%s-%s.json'%(toolchain, bits))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _snapshot_key(self, tcpath):
+        """
+        <return>  string  fingerprint of everything switchtc's output depends on,
+                          None when switchtc cannot be found
+        """
+        script = shutil.which(SWITCHTC)
+        if script is None:
+            return None
+
+        mtimes = []
+        for path in [script, tcpath, os.path.join(tcpath, 'bin')]:
+            try:
+                mtimes.append('%s %d'%(os.path.normcase(path), os.stat(path).st_mtime_ns))
+            except OSError:
+                mtimes.append(path + ' missing')
+        return ptcache.make_key(mtimes, os.environ.get('PATH', ''))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _load(self, toolchain, bits):
+        """
+        <return>  dict  toolchain variables of a valid snapshot, None if there is none
+        """
+        try:
+            with open(self._snapshot_path(toolchain, bits)) as snapshotfile:
+                snapshot = json.load(snapshotfile)
+            variables = snapshot['variables']
+            if snapshot['version'] != SNAPSHOT_VERSION \
+               or snapshot['key'] != self._snapshot_key(variables.get('tcpath', '')):
+                return None
+            return variables
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _save(self, toolchain, bits, variables):
+        key = self._snapshot_key(variables.get('tcpath', ''))
+        if key is None:
+            return
+
+        path = self._snapshot_path(toolchain, bits)
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            with open(path + '.tmp', 'w') as snapshotfile:
+                json.dump({'version': SNAPSHOT_VERSION, 'key': key, 'variables': variables}, snapshotfile, indent=1)
+            os.replace(path + '.tmp', path)
+        except OSError as err:
+            print_warn('WARNING: Could not save toolchain environment "%s".'%path)
+            print_warn(str(err))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _run_switchtc(self, toolchain, bits):
+        """
+        <return>  dict  variables printed by switchtc, None on error
+        """
+        try:
+            result = ptrun.run([SWITCHTC, toolchain, bits, '--listenv'], shell=True, capture=True, echo=False)
+        except OSError as err:
+            print_err(str(err))
+            return None
+        if result.returncode != 0:
+            result.print_tail()
+            return None
+
+        variables = {}
+        for line in result.output.split('\n'):
+            key, _, val = line.strip().partition('=')
+            if key != '':
+                variables[key] = val
+        return variables
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
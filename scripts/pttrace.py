@@ -0,0 +1,363 @@
+#-*- coding: utf8 -*-
+
+import contextlib, json, os, sys, threading, time
+from concurrent.futures import ProcessPoolExecutor
+from utils import print_warn, print_err
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+USER_INVOKED = False
+
+# ru_maxrss is in KB on Linux but in bytes on macOS
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+_local = threading.local()
+
+# -----------------------------------------------------------------------
+def main(cli_params):
+    if len(cli_params) != 1:
+        print_err('Usage: pttrace.py <trace file>')
+        return False
+
+    try:
+        with open(cli_params[0]) as tracefile:
+            events = json.load(tracefile)['traceEvents']
+    except (OSError, ValueError, KeyError) as err:
+        print_err('ERROR: Could not read trace file "%s".'%cli_params[0])
+        print_err(str(err))
+        return False
+
+    print(summary(events))
+    return True
+
+
+# -----------------------------------------------------------------------
+class Span:
+    """
+    Resource usage collected while a span is open.
+    """
+    def __init__(self, name):
+        self.name      = name
+        self.child_cpu = 0.0    # seconds, user + system
+        self.peak_rss  = 0      # bytes, largest child process
+        self.counters  = {}
+
+
+# -----------------------------------------------------------------------
+class Tracer:
+    """
+    Records timed, possibly nested spans of a release run and writes them as
+    a Chrome trace (chrome://tracing, Perfetto). Every span has a track, one
+    line in the trace viewer, e.g. one per architecture. Spans of the same
+    track must be opened from the same thread. Thread-safe.
+    """
+    _events = None
+    _tracks = None
+    _origin = None
+    _lock = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self):
+        self._events = []
+        self._tracks = {}
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    @contextlib.contextmanager
+    def span(self, name, track='main'):
+        """
+        Context manager that times the enclosed block. Child processes waited
+        for with wait() (e.g. by ptrun), results taken from a ProcessPool and
+        counters added with count() inside the block are attributed to it and
+        to all spans it is nested in. The peak RSS of a span is that of its
+        largest child, the peak of this process so far is recorded separately
+        as self_peak_rss_mb.
+        """
+        span = Span(name)
+        stack = _span_stack()
+        stack.append(span)
+        start = time.perf_counter()
+
+        try:
+            yield span
+        finally:
+            end = time.perf_counter()
+            stack.remove(span)
+
+            args = {'child_cpu_s':      round(span.child_cpu, 3),
+                    'peak_rss_mb':      round(span.peak_rss / 2**20, 1),
+                    'self_peak_rss_mb': round(process_peak_rss() / 2**20, 1)}
+            args.update(span.counters)
+
+            with self._lock:
+                tid = self._tracks.setdefault(track, len(self._tracks) + 1)
+                self._events.append({
+                    'name': name, 'cat': 'ptrelease', 'ph': 'X', 'pid': 1, 'tid': tid,
+                    'ts':   int((start - self._origin) * 1e6),
+                    'dur':  int((end - start) * 1e6),
+                    'args': args
+                })
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def events(self):
+        """
+        <return>  list  Chrome trace events, including the track names
+        """
+        with self._lock:
+            meta = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'ptrelease'}}]
+            for track, tid in sorted(self._tracks.items(), key=lambda item: item[1]):
+                meta.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': track}})
+                meta.append({'name': 'thread_sort_index', 'ph': 'M', 'pid': 1, 'tid': tid,
+                             'args': {'sort_index': tid}})
+            return meta + list(self._events)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def save(self, path):
+        """
+        Writes the trace file.
+        <return>  bool  True if the file was written
+        """
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, 'w') as tracefile:
+                json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, tracefile)
+            return True
+        except OSError as err:
+            print_warn('WARNING: Could not write trace file "%s".'%path)
+            print_warn(str(err))
+            return False
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def summary(self):
+        return summary(self.events())
+
+
+# -----------------------------------------------------------------------
+class ProcessPool:
+    """
+    ProcessPoolExecutor with submit() and map() whose tasks measure
+    themselves: every task returns the CPU time and peak RSS of its worker
+    process together with its result. Both are added to the spans the
+    thread that takes the result has open, so the usage of the workers ends
+    up in the trace although nobody waits for them with wait().
+    """
+    _pool = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def __init__(self, max_workers=None):
+        self._pool = ProcessPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._pool.shutdown()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def submit(self, func, *args):
+        """
+        <return>  _MeasuredFuture  its result() is the result of func(*args)
+        """
+        return _MeasuredFuture(self._pool.submit(_measured_call, func, *args))
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def map(self, func, *iterables):
+        """
+        Same as Executor.map(): submits all tasks at once.
+        <return>  iterator  results in the order of the arguments
+        """
+        futures = [self.submit(func, *args) for args in zip(*iterables)]
+        return (future.result() for future in futures)
+
+
+# -----------------------------------------------------------------------
+class _MeasuredFuture:
+    def __init__(self, future):
+        self._future = future
+
+    def result(self):
+        result, child_cpu, peak_rss = self._future.result()
+        add_child_usage(child_cpu, peak_rss)
+        return result
+
+
+# -----------------------------------------------------------------------
+def _measured_call(func, *args):
+    """
+    Runs in a pool worker.
+    <return>  tuple  (result of func(*args), CPU seconds of the call, peak RSS of the worker in bytes)
+    """
+    start = time.process_time()
+    result = func(*args)
+    return result, time.process_time() - start, process_peak_rss()
+
+
+# -----------------------------------------------------------------------
+def count(name, value):
+    """
+    Adds value to a counter (e.g. bytes_copied) of all spans the calling
+    thread has open. Does nothing outside of spans.
+    """
+    for span in _span_stack():
+        span.counters[name] = span.counters.get(name, 0) + value
+
+
+# -----------------------------------------------------------------------
+def wait(proc):
+    """
+    Same as proc.wait() for a subprocess.Popen object. Additionally the CPU
+    time and peak RSS of the child are added to all spans the calling thread
+    has open.
+    <return>  int  exit code
+    """
+    returncode, child_cpu, peak_rss = wait_usage(proc)
+    add_child_usage(child_cpu, peak_rss)
+    return returncode
+
+
+# -----------------------------------------------------------------------
+def wait_usage(proc):
+    """
+    Waits for a subprocess.Popen object like wait(), but only returns the
+    resource usage of the child instead of adding it to any span. For
+    waiting in another thread than the one that has the spans open, e.g. in
+    an executor: pass the usage to add_child_usage() in the span's thread.
+    <return>  tuple  (exit code, CPU seconds, peak RSS in bytes)
+    """
+    if hasattr(os, 'wait4'):
+        try:
+            _, status, usage = os.wait4(proc.pid, 0)
+        except ChildProcessError:
+            return proc.wait(), 0.0, 0
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        return proc.returncode, usage.ru_utime + usage.ru_stime, usage.ru_maxrss * RSS_UNIT
+
+    proc.wait()
+    if sys.platform == 'win32':
+        return (proc.returncode,) + win_usage(int(proc._handle))
+    return proc.returncode, 0.0, 0
+
+
+# -----------------------------------------------------------------------
+def add_child_usage(child_cpu, peak_rss):
+    """
+    Adds the resource usage of a finished child process to all spans the
+    calling thread has open, for children that were not waited for with
+    wait() or run in a ProcessPool.
+    child_cpu  float  CPU seconds, user + system
+    peak_rss   int    bytes
+    """
+    for span in _span_stack():
+        span.child_cpu += child_cpu
+        span.peak_rss = max(span.peak_rss, peak_rss)
+
+
+# -----------------------------------------------------------------------
+def process_peak_rss():
+    """
+    <return>  int  peak RSS of the current process since it started in bytes, 0 if unknown
+    """
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+    if sys.platform == 'win32':
+        import ctypes
+        ctypes.windll.kernel32.GetCurrentProcess.restype = ctypes.c_void_p
+        return win_usage(ctypes.windll.kernel32.GetCurrentProcess())[1]
+    return 0
+
+
+# -----------------------------------------------------------------------
+def summary(events):
+    """
+    Formats the complete events of a trace as a table, grouped by track.
+    Nested spans are indented below their parent. Peak RSS is that of the
+    largest child process of a stage, the peak of the traced process itself
+    is printed below the table.
+    <return>  string
+    """
+    tracks = {event['tid']: event['args']['name'] for event in events
+              if event.get('ph') == 'M' and event['name'] == 'thread_name'}
+    spans = sorted((event for event in events if event.get('ph') == 'X'),
+                   key=lambda event: (event['tid'], event['ts'], -event['dur']))
+
+    lines = ['%-30s %9s %9s %9s %9s'%('Stage', 'Wall', 'Child CPU', 'Peak RSS', 'Copied')]
+    current_tid = None
+    open_ends = []
+
+    for event in spans:
+        if event['tid'] != current_tid:
+            current_tid = event['tid']
+            open_ends = []
+            lines.append(tracks.get(current_tid, 'track %d'%current_tid))
+
+        while open_ends and open_ends[-1] <= event['ts']:
+            open_ends.pop()
+        indent = '  ' * (len(open_ends) + 1)
+        open_ends.append(event['ts'] + event['dur'])
+
+        args = event.get('args', {})
+        copied = args.get('bytes_copied')
+        lines.append('%-30s %8.1fs %8.1fs %6.0f MB %9s'%(
+                     (indent + event['name'])[:30], event['dur'] / 1e6, args.get('child_cpu_s', 0),
+                     args.get('peak_rss_mb', 0), '-' if copied is None else '%.0f MB'%(copied / 2**20)))
+
+    self_peak_rss = max([event.get('args', {}).get('self_peak_rss_mb', 0) for event in spans] or [0])
+    if self_peak_rss:
+        lines.append('Peak RSS of the release process: %.0f MB'%self_peak_rss)
+
+    return '\n'.join(lines)
+
+
+# -----------------------------------------------------------------------
+def _span_stack():
+    if not hasattr(_local, 'spans'):
+        _local.spans = []
+    return _local.spans
+
+
+# -----------------------------------------------------------------------
+def win_usage(handle):
+    """
+    <return>  tuple  (CPU seconds, peak working set in bytes) of a Windows process handle
+    """
+    import ctypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [('cb', ctypes.c_ulong), ('PageFaultCount', ctypes.c_ulong)] + \
+                   [(name, ctypes.c_size_t) for name in
+                    ['PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage',
+                     'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage']]
+
+    kernel32 = ctypes.windll.kernel32
+    handle = ctypes.c_void_p(handle)
+
+    # FILETIMEs in 100 ns units
+    creation, exit, kernel, user = [ctypes.c_ulonglong() for i in range(4)]
+    if kernel32.GetProcessTimes(handle, ctypes.byref(creation), ctypes.byref(exit),
+                                ctypes.byref(kernel), ctypes.byref(user)):
+        cpu = (kernel.value + user.value) / 1e7
+    else:
+        cpu = 0.0
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    if kernel32.K32GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+        peak_rss = counters.PeakWorkingSetSize
+    else:
+        peak_rss = 0
+
+    return cpu, peak_rss
+
+
+# -----------------------------------------------------------------------
+if __name__ == '__main__':
+    try:
+        USER_INVOKED = True
+        sys.exit(0 if main(sys.argv[1:]) else 1)
+    except KeyboardInterrupt:
+        print_err('\nAborted by the user.')
+        sys.exit(1)
@@ -1,74 +1,285 @@
 #-*- coding: utf8 -*-
 
-import os, shutil, sys
+import functools, hashlib, os, shutil, sys
 from utils import print_ok, print_warn, print_err
 
 USER_INVOKED = False
 
+MTIME_TOLERANCE = 2.0       # seconds, only for file systems with coarse mtimes (FAT)
+COARSE_MTIME_FS = ('fat', 'fat12', 'fat16', 'fat32', 'vfat', 'msdos')
+HASH_CHUNK_SIZE = 1 << 20
+
 DIR_LIST = [
-    # dir name          # files to ignoe
-    ['ChannelMixers',   None],
-    ['Curves',          None],
-    ['LensfunDatabase', None],
-    ['Presets',         None],
-    ['Profiles',        None],
-    ['Themes',          None],
-    ['Translations',    '*.ts'],
-    ['UISettings',      None]
+    # dir name          # files to ignoe    # packed into one file with ptrelease.py --pack-data
+    ['ChannelMixers',   None,               True],
+    ['Curves',          None,               True],
+    ['LensfunDatabase', None,               True],
+    ['Presets',         None,               True],
+    ['Profiles',        None,               False],     # ICC profiles are opened by path
+    ['Themes',          None,               True],
+    ['Translations',    '*.ts',             False],     # loaded by Qt's QTranslator
+    ['UISettings',      None,               True]
 ]
 
 # -----------------------------------------------------------------------
 def main(cli_params):
-    if len(cli_params) == 0:
+    params = [param for param in cli_params if not param.startswith('--')]
+    options = [param for param in cli_params if param.startswith('--')]
+
+    for option in options:
+        if not option in ['--hash', '--clean']:
+            print_err('Unknown option "%s". Must be --hash or --clean.'%option)
+            return False
+
+    if len(params) == 0:
         print_err('Not implemented yet.')
         return False
-    elif len(cli_params) == 2:
-        srcdir  = os.path.abspath(cli_params[0])
-        destdir = os.path.abspath(cli_params[1])
+    elif len(params) == 2:
+        srcdir  = os.path.abspath(params[0])
+        destdir = os.path.abspath(params[1])
     else:
         print_err('Wrong number of arguments. Must be none or two.')
         return False
 
+    return update_data(srcdir, destdir,
+                       use_hash='--hash' in options,
+                       clean='--clean' in options) is not None
+
+
+# -----------------------------------------------------------------------
+def update_data(srcdir, destdir, use_hash=False, clean=False):
+    """
+    Brings all data dirs from DIR_LIST in destdir up to date with srcdir.
+    Only new and changed files are copied, stale files are deleted.
+    srcdir    string    Photivo repository base dir
+    destdir   string    destination base dir (usually a bin dir)
+    use_hash  bool      compare contents of files with equal size instead of mtimes
+    clean     bool      remove all data dirs first, i.e. do a full copy
+    <return>  SyncStats statistics for all dirs, None on error
+    """
     if not os.path.isdir(srcdir):
         print_err('ERROR: Source base directory "%s" missing.'%srcdir)
-        return False
+        return None
 
     os.makedirs(destdir, exist_ok=True)
     if not os.path.isdir(destdir):
         print_err('ERROR: Destination base "%s" is not a directory.'%destdir)
-        return False
+        return None
 
-    for direntry in DIR_LIST:
-        try:
-            dest_subdir = os.path.join(destdir, direntry[0])
-            if os.path.exists(dest_subdir):
-                shutil.rmtree(dest_subdir)
-        except Exception as err:
-            print_err('ERROR removing existing destination: ' + direntry[0])
-            print_err(str(err))
-            return False
+    if clean:
+        for direntry in DIR_LIST:
+            try:
+                dest_subdir = os.path.join(destdir, direntry[0])
+                if os.path.exists(dest_subdir):
+                    shutil.rmtree(dest_subdir)
+            except Exception as err:
+                print_err('ERROR removing existing destination: ' + direntry[0])
+                print_err(str(err))
+                return None
 
-    for direntry in DIR_LIST:
-        print('Updating:', direntry[0])
+    total = SyncStats()
 
+    for direntry in DIR_LIST:
         try:
             if direntry[1] == None:
                 ignorer = None
             else:
                 ignorer = shutil.ignore_patterns(direntry[1])
 
-            shutil.copytree(os.path.join(srcdir, direntry[0]),
-                            os.path.join(destdir, direntry[0]),
-                            ignore=ignorer)
+            stats = sync_tree(os.path.join(srcdir, direntry[0]),
+                              os.path.join(destdir, direntry[0]),
+                              ignore=ignorer,
+                              use_hash=use_hash)
         except Exception as err:
             print_err('ERROR copying data directory: ' + direntry[0])
             print_err(str(err))
-            return False
+            return None
+
+        print('Updating:', direntry[0], '(%s)'%stats)
+        total.add(stats)
+
+    print_ok('Data files successfully updated (%s).'%total)
+    return total
+
+
+# -----------------------------------------------------------------------
+class SyncStats:
+    """
+    Counters collected by sync_tree().
+    """
+    def __init__(self):
+        self.copied       = 0
+        self.linked       = 0
+        self.deleted      = 0
+        self.unchanged    = 0
+        self.bytes_copied = 0
+
+    def add(self, other):
+        self.copied       += other.copied
+        self.linked       += other.linked
+        self.deleted      += other.deleted
+        self.unchanged    += other.unchanged
+        self.bytes_copied += other.bytes_copied
+
+    def __str__(self):
+        if self.linked > 0:
+            return '%d copied, %d linked, %d deleted, %d unchanged'% \
+                   (self.copied, self.linked, self.deleted, self.unchanged)
+        return '%d copied, %d deleted, %d unchanged'%(self.copied, self.deleted, self.unchanged)
+
+
+# -----------------------------------------------------------------------
+def sync_tree(srcdir, destdir, ignore=None, use_hash=False, stats=None, link=False):
+    """
+    Makes destdir an exact copy of srcdir. Files are copied only when they are
+    new or differ in size or mtime. With use_hash files of equal size are
+    always compared by content. Everything in destdir that is not
+    present in srcdir (or is ignored) is deleted.
+    ignore    callable  same as the ignore argument of shutil.copytree()
+    link      bool      create hard links instead of copies where possible
+    <return>  SyncStats
+    Raises OSError when srcdir is missing or a file operation fails.
+    """
+    if stats is None:
+        stats = SyncStats()
+
+    src_entries = {entry.name: entry for entry in os.scandir(srcdir)}
+    if ignore is not None:
+        for name in ignore(srcdir, list(src_entries)):
+            src_entries.pop(name, None)
+
+    os.makedirs(destdir, exist_ok=True)
+
+    # remove stale files and entries that changed between file and dir
+    for dest_entry in os.scandir(destdir):
+        src_entry = src_entries.get(dest_entry.name)
+        is_dest_dir = dest_entry.is_dir(follow_symlinks=False)
+
+        if src_entry is None or src_entry.is_dir() != is_dest_dir:
+            if is_dest_dir:
+                shutil.rmtree(dest_entry.path)
+            else:
+                os.remove(dest_entry.path)
+            stats.deleted += 1
 
-    print_ok('Data files successfully updated.')
+    for name in sorted(src_entries):
+        src_entry = src_entries[name]
+        destpath = os.path.join(destdir, name)
+
+        if src_entry.is_dir():
+            sync_tree(src_entry.path, destpath, ignore, use_hash, stats, link)
+        elif is_file_current(src_entry.path, destpath, use_hash):
+            stats.unchanged += 1
+        elif link and link_file(src_entry.path, destpath):
+            stats.linked += 1
+        else:
+            shutil.copy2(src_entry.path, destpath)
+            stats.copied += 1
+            stats.bytes_copied += src_entry.stat().st_size
+
+    return stats
+
+
+# -----------------------------------------------------------------------
+def link_file(srcfile, destfile):
+    """
+    Replaces destfile with a hard link to srcfile.
+    <return>  bool  False if the file system does not support hard links
+                    between the two paths. destfile is removed anyway.
+    """
+    if os.path.lexists(destfile):
+        os.remove(destfile)
+    try:
+        os.link(srcfile, destfile)
+        return True
+    except OSError:
+        return False
+
+
+# -----------------------------------------------------------------------
+def is_file_current(srcfile, destfile, use_hash=False):
+    """
+    Tests if destfile is an up to date copy of srcfile.
+    <return>   bool    True if no copy is needed
+    """
+    try:
+        dest_stat = os.stat(destfile)
+    except FileNotFoundError:
+        return False
+
+    src_stat = os.stat(srcfile)
+    if src_stat.st_size != dest_stat.st_size:
+        return False
+
+    # copy2() keeps mtimes exactly. Only FAT rounds them to 2 s, there a
+    # change within the tolerance goes unnoticed without use_hash.
+    same_mtime = src_stat.st_mtime_ns == dest_stat.st_mtime_ns \
+                 or (abs(src_stat.st_mtime - dest_stat.st_mtime) <= MTIME_TOLERANCE
+                     and has_coarse_mtimes(destfile))
+
+    if not use_hash:
+        return same_mtime
+
+    if file_digest(srcfile) != file_digest(destfile):
+        return False
+
+    if not same_mtime:
+        # Same content: fix the mtime so a run without hashing is a cheap stat() again.
+        shutil.copystat(srcfile, destfile)
     return True
 
 
+# -----------------------------------------------------------------------
+def has_coarse_mtimes(path):
+    """
+    <return>  bool  True if path is on a file system that stores mtimes with a
+                    2 s resolution only
+    """
+    return _file_system(_volume_root(os.path.abspath(path))).lower() in COARSE_MTIME_FS
+
+
+# -----------------------------------------------------------------------
+def _volume_root(path):
+    if sys.platform == 'win32':
+        return os.path.splitdrive(path)[0] + '\\'
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+# -----------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def _file_system(root):
+    """
+    <return>  string  file system name of a volume (e.g. 'NTFS', 'ext4'), '' if unknown
+    """
+    if sys.platform == 'win32':
+        import ctypes
+        fs_name = ctypes.create_unicode_buffer(64)
+        if ctypes.windll.kernel32.GetVolumeInformationW(root, None, 0, None, None, None, fs_name, len(fs_name)):
+            return fs_name.value
+        return ''
+
+    try:
+        with open('/proc/self/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) > 2 and fields[1].replace('\\040', ' ') == root:
+                    return fields[2]
+    except OSError:
+        pass
+    return ''
+
+
+# -----------------------------------------------------------------------
+def file_digest(filepath):
+    hasher = hashlib.sha1()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
 # -----------------------------------------------------------------------
 if __name__ == '__main__':
     try:
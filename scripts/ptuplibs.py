@@ -1,10 +1,21 @@
 #-*- coding: utf8 -*-
 
-import glob, os, shutil, sys
+import glob, multiprocessing, os, shutil, sys, time
+from concurrent.futures import ThreadPoolExecutor
 from utils import print_ok, print_warn, print_err
+from ptupdata import is_file_current
+import ptpedeps, pttrace
 
 USER_INVOKED = False
 
+# Upper bound for parallel copy jobs in staging mode. Copying is I/O bound,
+# more threads than this only make the disk seek.
+MAX_COPY_JOBS = 8
+
+# Binaries in the bin dir where --auto starts resolving DLL dependencies
+ROOT_BINARIES = ['photivo.exe', 'ptClear.exe']
+PEDEPS_CACHE_FILE = 'pedeps.json'
+
 FILE_LIST = {
     'win32': {
         'mingw': [
@@ -79,13 +90,26 @@ FILE_LIST = {
 
 # -----------------------------------------------------------------------
 def main(cli_params):
-    if len(cli_params) == 0:
+    params = [param for param in cli_params if not param.startswith('--')]
+    options = []
+    cache_dir = None
+
+    for option in [param for param in cli_params if param.startswith('--')]:
+        if option.startswith('--cache-dir='):
+            cache_dir = option.partition('=')[2]
+        elif option in ['--stage', '--hash', '--auto']:
+            options.append(option)
+        else:
+            print_err('Unknown option "%s". Must be --stage, --hash, --auto or --cache-dir=<dir>.'%option)
+            return False
+
+    if len(params) == 0:
         print_err('Not implemented yet.')
         return False
-    elif len(cli_params) == 3:
-        srcdir  = os.path.abspath(cli_params[0])
-        destdir = os.path.abspath(cli_params[1])
-        arch    = "win" + cli_params[2]
+    elif len(params) == 3:
+        srcdir  = os.path.abspath(params[0])
+        destdir = os.path.abspath(params[1])
+        arch    = "win" + params[2]
     else:
         print_err('Wrong number of arguments. Must be none or three.')
         return False
@@ -103,12 +127,36 @@ def main(cli_params):
         print_err('ERROR: Unknow architecture. Must be "32" or "64".')
         return False
 
-    if not kill_old_libs(destdir):
-        return False
+    if '--auto' in options:
+        cache_path = None if cache_dir is None else os.path.join(cache_dir, PEDEPS_CACHE_FILE)
+        file_list = resolve_file_list(srcdir, destdir, arch, cache_path)
+        if file_list is None:
+            return False
+    else:
+        file_list = build_file_list(srcdir, destdir, arch)
 
-    src_mingw = os.path.join(srcdir, arch, 'bin')
-    src_qt    = os.path.join(srcdir, arch, 'dev', 'qt', 'bin')
-    src_dev   = os.path.join(srcdir, arch, 'dev', 'bin')
+    if '--stage' in options:
+        report = stage_libs(file_list, destdir, use_hash='--hash' in options)
+        print_stage_report(report)
+        if any(entry.action == LibReport.FAILED for entry in report):
+            return False
+    else:
+        if not kill_old_libs(destdir):
+            return False
+        if not copy_libs(file_list):
+            return False
+
+    print_ok('Libraries successfully updated.')
+    return True
+
+
+# -----------------------------------------------------------------------
+def build_file_list(srcdir, destdir, arch):
+    """
+    Returns the [source file, destination] pairs for all libs of an arch.
+    destination is either a dir or the full path of the destination file.
+    """
+    src_mingw, src_qt, src_dev = lib_dirs(srcdir, arch)
     file_dict = FILE_LIST[arch]
 
     file_list = []
@@ -129,11 +177,52 @@ def main(cli_params):
     for file in file_dict['dev']:
         file_list.append([os.path.join(src_dev, file), destdir])
 
-    if not copy_libs(file_list):
-        return False
+    return file_list
 
-    print_ok('Libraries successfully updated.')
-    return True
+
+# -----------------------------------------------------------------------
+def lib_dirs(srcdir, arch):
+    """
+    <return>  list  mingw, qt and dev bin dirs of the toolchain
+    """
+    return [
+        os.path.join(srcdir, arch, 'bin'),
+        os.path.join(srcdir, arch, 'dev', 'qt', 'bin'),
+        os.path.join(srcdir, arch, 'dev', 'bin')
+    ]
+
+
+# -----------------------------------------------------------------------
+def resolve_file_list(srcdir, destdir, arch, cache_path=None):
+    """
+    Like build_file_list() but instead of the hand-kept DLL names in FILE_LIST
+    the DLLs are found by walking the PE import tables of ROOT_BINARIES in destdir.
+    Entries of FILE_LIST with a sub path (plugins) are never imported directly,
+    so they are kept and their imports resolved as well.
+    cache_path  string  cache file for the DLL import lists, None for no cache
+    <return>    list    as build_file_list(), None on error
+    """
+    src_qt = lib_dirs(srcdir, arch)[1]
+    plugins = []
+    for file in FILE_LIST[arch]['qt']:
+        if '\\' in file:
+            plugins.append([os.path.join(os.path.dirname(src_qt), file), os.path.join(destdir, file)])
+            os.makedirs(os.path.dirname(os.path.join(destdir, file)), exist_ok=True)
+
+    roots = [os.path.join(destdir, name) for name in ROOT_BINARIES] + [entry[0] for entry in plugins]
+
+    try:
+        index = ptpedeps.DllIndex(lib_dirs(srcdir, arch), cache_path)
+        resolved, unresolved = ptpedeps.resolve_deps(roots, index)
+    except (OSError, ptpedeps.PEError) as err:
+        print_err('ERROR: Resolving DLL dependencies failed.')
+        print_err(str(err))
+        return None
+
+    print('Resolved %d DLLs. Assumed to be system DLLs: %s'%
+          (len(resolved), ' '.join(sorted(unresolved, key=str.lower))))
+
+    return [[resolved[name], destdir] for name in sorted(resolved, key=str.lower)] + plugins
 
 
 # -----------------------------------------------------------------------
@@ -169,6 +258,94 @@ def kill_old_libs(destdir):
     return status
 
 
+# -----------------------------------------------------------------------
+class LibReport:
+    """
+    Outcome of staging a single lib.
+    """
+    COPIED  = 'copied'
+    SKIPPED = 'skipped'
+    REMOVED = 'removed'
+    FAILED  = 'failed'
+
+    def __init__(self, path, action, size=0, seconds=0.0):
+        self.path    = path
+        self.action  = action
+        self.size    = size
+        self.seconds = seconds
+
+
+# -----------------------------------------------------------------------
+def stage_libs(file_list, destdir, use_hash=False, jobs=None):
+    """
+    Diff-aware alternative to kill_old_libs() + copy_libs(). Libs that are
+    already identical in destdir are left alone, changed ones are copied by a
+    bounded thread pool and DLLs in destdir that are not in file_list are removed.
+    file_list   list    [source file, destination] pairs as for copy_libs()
+    use_hash    bool    compare contents instead of size and mtime
+    jobs        int     number of parallel copy jobs, default depends on CPU count
+    <return>    list    one LibReport per file
+    """
+    if jobs is None:
+        jobs = min(MAX_COPY_JOBS, multiprocessing.cpu_count())
+
+    targets = []
+    for srcfile, dest in file_list:
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(srcfile))
+        targets.append([srcfile, dest])
+
+    wanted = set(os.path.normcase(os.path.abspath(dest)) for _, dest in targets)
+    report = []
+
+    for file in glob.glob(os.path.join(destdir, '*.dll')):
+        if os.path.normcase(os.path.abspath(file)) in wanted:
+            continue
+        try:
+            size = os.path.getsize(file)
+            os.remove(file)
+            report.append(LibReport(file, LibReport.REMOVED, size))
+        except OSError as err:
+            print_err('Could not delete ' + file)
+            print_err(str(err))
+            report.append(LibReport(file, LibReport.FAILED))
+
+    def stage_file(target):
+        srcfile, destfile = target
+        start = time.perf_counter()
+        try:
+            if is_file_current(srcfile, destfile, use_hash):
+                action = LibReport.SKIPPED
+            else:
+                shutil.copy2(srcfile, destfile)
+                action = LibReport.COPIED
+            return LibReport(destfile, action, os.path.getsize(srcfile), time.perf_counter() - start)
+        except OSError as err:
+            print_err(str(err))
+            print_err('Source: ' + srcfile)
+            print_err('Dest  : ' + destfile)
+            return LibReport(destfile, LibReport.FAILED, 0, time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        report.extend(pool.map(stage_file, targets))
+
+    pttrace.count('bytes_copied', sum(entry.size for entry in report if entry.action == LibReport.COPIED))
+    return report
+
+
+# -----------------------------------------------------------------------
+def print_stage_report(report):
+    totals = {}
+    for entry in report:
+        print('%-8s %-32s %10d bytes %7.3fs'%(entry.action, os.path.basename(entry.path),
+                                            entry.size, entry.seconds))
+        count, size = totals.get(entry.action, (0, 0))
+        totals[entry.action] = (count + 1, size + entry.size)
+
+    print(', '.join('%d %s (%d bytes)'%(totals[action][0], action, totals[action][1])
+                    for action in sorted(totals)))
+
+
 # -----------------------------------------------------------------------
 if __name__ == '__main__':
     try:
@@ -0,0 +1,63 @@
+#-*- coding: utf8 -*-
+
+import os, shutil, subprocess, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pthg
+
+pytestmark = pytest.mark.skipif(shutil.which('hg') is None, reason='needs Mercurial')
+
+# -----------------------------------------------------------------------
+def hg(cwd, *args):
+    return subprocess.check_output(['hg'] + list(args), cwd=cwd, universal_newlines=True).strip()
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    # a repository with one commit on branch "stable" and one uncommitted change
+    monkeypatch.setenv('HGRCPATH', '')
+    monkeypatch.setenv('HGUSER', 'test')
+    path = str(tmp_path / 'repo')
+    hg(str(tmp_path), 'init', path)
+    hg(path, 'branch', '--quiet', 'stable')
+    with open(os.path.join(path, 'a.txt'), 'w') as newfile:
+        newfile.write('a')
+    hg(path, 'commit', '--quiet', '--addremove', '--message', 'first')
+    with open(os.path.join(path, 'a.txt'), 'w') as newfile:
+        newfile.write('b')
+    return path
+
+
+@pytest.fixture(params=[True, False], ids=['cmdserver', 'fallback'])
+def info(request, repo):
+    info = pthg.RepoInfo('hg', repo, use_cmdserver=request.param)
+    yield info
+    info.close()
+
+
+# -----------------------------------------------------------------------
+def test_queries(info, repo):
+    assert info.branch() == 'stable'
+    assert info.changeset() == hg(repo, 'identify', '--id')
+    assert info.changeset().endswith('+')
+    assert info.status() == ['M a.txt']
+    assert 'first' in info.branch_log()
+
+
+def test_uses_cmdserver(repo):
+    info = pthg.RepoInfo('hg', repo)
+    try:
+        info.branch()
+        assert info.uses_cmdserver()
+    finally:
+        info.close()
+    assert not info.uses_cmdserver()
+
+
+def test_failed_query_has_stderr(info):
+    with pytest.raises(subprocess.CalledProcessError) as failure:
+        info.query(['log', '-r', 'nosuchrevision'])
+    assert failure.value.returncode != 0
+    assert 'nosuchrevision' in failure.value.stderr
@@ -0,0 +1,85 @@
+#-*- coding: utf8 -*-
+
+import json, os, shutil, sys, threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ptpedeps
+
+# A minimal PE32+ DLL: one .idata section with two normal imports
+# (KERNEL32.dll, libstdc++-6.dll) and one delay-loaded import (libexiv2.dll).
+IMPORTS_DLL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'imports.dll')
+IMPORTS     = ['KERNEL32.dll', 'libstdc++-6.dll', 'libexiv2.dll']
+
+# The same as a 32bit PE32 DLL (ImageBase 0x10000000), whose delay import
+# descriptor is the old kind with a VA instead of an RVA.
+IMPORTS32_DLL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'imports32.dll')
+IMPORTS32     = ['KERNEL32.dll', 'libgcc_s_dw2-1.dll', 'libexiv2.dll']
+
+# -----------------------------------------------------------------------
+def test_read_imports():
+    assert ptpedeps.read_imports(IMPORTS_DLL) == IMPORTS
+
+
+def test_read_imports_pe32():
+    assert ptpedeps.read_imports(IMPORTS32_DLL) == IMPORTS32
+
+
+def test_read_imports_not_pe(tmp_path):
+    path = tmp_path / 'readme.dll'
+    path.write_bytes(b'not a DLL at all')
+    with pytest.raises(ptpedeps.PEError):
+        ptpedeps.read_imports(str(path))
+
+
+def test_read_imports_truncated(tmp_path):
+    path = tmp_path / 'truncated.dll'
+    with open(IMPORTS_DLL, 'rb') as dllfile:
+        path.write_bytes(dllfile.read()[:0x100])
+    with pytest.raises(ptpedeps.PEError):
+        ptpedeps.read_imports(str(path))
+
+
+# -----------------------------------------------------------------------
+def test_index_uses_cache(tmp_path):
+    shutil.copy(IMPORTS_DLL, str(tmp_path / 'a.dll'))
+    cache_path = str(tmp_path / 'cache' / 'imports.json')
+
+    index = ptpedeps.DllIndex([str(tmp_path)], cache_path)
+    assert index.imports(index.find('A.DLL')) == IMPORTS
+    assert index.save()
+
+    # a cached entry is used as long as size and mtime match
+    with open(cache_path) as cachefile:
+        cache = json.load(cachefile)
+    key, = cache
+    cache[key]['imports'] = ['cached.dll']
+    with open(cache_path, 'w') as cachefile:
+        json.dump(cache, cachefile)
+    assert ptpedeps.DllIndex([str(tmp_path)], cache_path).imports(str(tmp_path / 'a.dll')) == ['cached.dll']
+
+
+def test_concurrent_saves_merge(tmp_path):
+    cache_path = str(tmp_path / 'imports.json')
+    names = ['dll%d.dll'%i for i in range(8)]
+    for name in names:
+        shutil.copy(IMPORTS_DLL, str(tmp_path / name))
+
+    # every index starts from the empty cache and parses a different DLL,
+    # like the arch pipelines of a concurrent release
+    indexes = [ptpedeps.DllIndex([str(tmp_path)], cache_path) for name in names]
+    for index, name in zip(indexes, names):
+        index.imports(index.find(name))
+    results = []
+    threads = [threading.Thread(target=lambda index=index: results.append(index.save())) for index in indexes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [True] * len(names)
+    with open(cache_path) as cachefile:
+        cache = json.load(cachefile)
+    assert sorted(os.path.basename(key) for key in cache) == names
+    assert [path.name for path in tmp_path.iterdir() if path.name.endswith('.tmp')] == []
@@ -0,0 +1,31 @@
+#-*- coding: utf8 -*-
+
+import os, re, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ptrelease
+
+README = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'README.txt')
+
+# -----------------------------------------------------------------------
+def readme_batch_example():
+    with open(README, encoding='latin_1') as readme:
+        text = readme.read()
+    section = text[text.index('==Batch job files=='):]
+    return re.search(r'<code>\n(.*?)</code>', section, re.S).group(1)
+
+
+def test_load_readme_batch_example(tmp_path):
+    job_file = tmp_path / 'jobs.ini'
+    job_file.write_text(readme_batch_example())
+
+    both = [ptrelease.Arch.win32, ptrelease.Arch.win64]
+    jobs = ptrelease.load_batch_file(str(job_file))
+    assert jobs is not None
+    assert [(job['name'], job['rev'], job['archs'], job['config'], job['variant']) for job in jobs] == [
+        ('default-nogimp', 'default', both, ['CONFIG+=WithoutGimp', 'CONFIG-=debug'], 'default-nogimp'),
+        ('default-gimp', 'default', both, ['CONFIG-=debug'], 'default-gimp'),
+        ('1.2-stable-nogimp', '1.2-stable', both, ['CONFIG+=WithoutGimp', 'CONFIG-=debug'], '1.2-stable-nogimp'),
+        ('1.2-stable-gimp', '1.2-stable', both, ['CONFIG-=debug'], '1.2-stable-gimp')
+    ]
+    assert ptrelease.PROMPT_ANSWERS == {'branch': 'y', 'dirty': 'n', 'changelog': 'c', 'cleanup': 'n'}
@@ -0,0 +1,65 @@
+#-*- coding: utf8 -*-
+
+import os, subprocess, sys, threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pttrace
+
+BUSY = 'import time\nstart = time.process_time()\nwhile time.process_time() - start < %f: pass'
+
+# -----------------------------------------------------------------------
+def _burn(seconds):
+    exec(BUSY%seconds)
+    return seconds
+
+
+def _span_args(tracer, name):
+    event, = [event for event in tracer.events() if event.get('name') == name]
+    return event['args']
+
+
+# -----------------------------------------------------------------------
+def test_wait_returncode():
+    proc = subprocess.Popen([sys.executable, '-c', 'import sys; sys.exit(3)'])
+    assert pttrace.wait(proc) == 3
+    assert proc.returncode == 3
+
+
+def test_wait_counts_only_own_child():
+    tracer = pttrace.Tracer()
+
+    def other():
+        with tracer.span('other', 'b'):
+            pttrace.wait(subprocess.Popen([sys.executable, '-c', BUSY%0.5]))
+
+    with tracer.span('mine', 'a'):
+        thread = threading.Thread(target=other)
+        thread.start()
+        pttrace.wait(subprocess.Popen([sys.executable, '-c', 'pass']))
+        thread.join()
+
+    assert _span_args(tracer, 'mine')['child_cpu_s'] < 0.4
+    assert _span_args(tracer, 'other')['child_cpu_s'] >= 0.4
+
+
+def test_process_pool_usage():
+    tracer = pttrace.Tracer()
+    with tracer.span('pool'):
+        with pttrace.ProcessPool(max_workers=2) as pool:
+            assert list(pool.map(_burn, [0.2, 0.2])) == [0.2, 0.2]
+            assert pool.submit(_burn, 0.1).result() == 0.1
+
+    args = _span_args(tracer, 'pool')
+    assert args['child_cpu_s'] >= 0.45
+    assert args['peak_rss_mb'] > 0
+
+
+def test_span_rss_is_children_only():
+    tracer = pttrace.Tracer()
+    with tracer.span('no children'):
+        pass
+
+    args = _span_args(tracer, 'no children')
+    assert args['peak_rss_mb'] == 0
+    assert args['self_peak_rss_mb'] > 0
+    assert 'Peak RSS of the release process' in tracer.summary()